@@ -4,3 +4,22 @@ from .vehicle_direction import *
 from .distance import *
 from .contrast import *
 from .brightness import *
+
+# The NumPy contrast engine and the threshold sweeps need pyarrow and pandas, which
+# take longer to import than the rest of the analyzer, so their modules are only
+# imported when one of their names is first used
+_LAZY_NAMES = {
+    "calculate_contrast_numpy": "contrast_numpy",
+    "classify_and_sum_heuristics_numpy": "contrast_numpy",
+    "count_contrast_classes": "contrast_sweep",
+    "label_contrast_thresholds": "contrast_sweep",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    module = importlib.import_module(f".{_LAZY_NAMES[name]}", __name__)
+    return getattr(module, name)
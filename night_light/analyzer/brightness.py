@@ -1,5 +1,8 @@
+from night_light.profiling import profiled
+
 ## Calculate a brightness heuristic
 
+@profiled
 def calculate_percieved_brightness(conn):
     """
     Calculate percieved brightness by adding A + B hueristic together.
@@ -0,0 +1,255 @@
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from night_light.analyzer.contrast import label_contrast
+from night_light.profiling import profiled
+
+## Vectorized alternative to the SQL contrast steps. The (crosswalk center, streetlight)
+## pairs are pulled from DuckDB as flat coordinate arrays through Arrow, the sides,
+## angles and heuristics are computed with NumPy, and the results are written back to
+## the same classified_streetlights, crosswalk_centers_heuristics and
+## crosswalk_centers_contrast tables as calculate_contrast.
+
+
+@profiled
+def calculate_contrast_numpy(con: duckdb.DuckDBPyConnection, threshold: float):
+    """
+    Classify the streetlights of every crosswalk center and compute its heuristics.
+
+    Produces the same `classified_streetlights`, `crosswalk_centers_heuristics` and
+    `crosswalk_centers_contrast` tables as `calculate_contrast`, up to floating point
+    rounding.
+
+    Args:
+        con: Connection to a DuckDB database with the crosswalk_centers_lights and
+            streetlights tables.
+        threshold: Threshold of the contrast heuristic classification.
+    """
+    classify_and_sum_heuristics_numpy(con)
+    label_contrast(con, threshold)
+
+
+@profiled
+def classify_and_sum_heuristics_numpy(con: duckdb.DuckDBPyConnection):
+    """
+    Classify the streetlights of every crosswalk center and sum its heuristics.
+
+    Produces the same `classified_streetlights` and `crosswalk_centers_heuristics`
+    tables as `classify_and_sum_heuristics`, up to floating point rounding.
+
+    Args:
+        con: Connection to a DuckDB database with the crosswalk_centers_lights and
+            streetlights tables.
+    """
+    # Number the distinct centers, so heuristics can be summed with np.bincount
+    con.execute(
+        """
+        CREATE OR REPLACE TEMP TABLE contrast_centers AS
+        SELECT
+            crosswalk_id,
+            center_id,
+            ROW_NUMBER() OVER (ORDER BY crosswalk_id, center_id) - 1 AS center_index
+        FROM (SELECT DISTINCT crosswalk_id, center_id FROM crosswalk_centers_lights);
+        """
+    )
+    try:
+        pairs = _fetch_pairs(con)
+        num_centers = con.execute("SELECT COUNT(*) FROM contrast_centers").fetchone()[0]
+
+        columns = _classify_pairs(pairs)
+        heuristics = _sum_heuristics(pairs, columns, num_centers)
+
+        for name, values in columns.items():
+            pairs = pairs.append_column(name, pa.array(values, from_pandas=True))
+        _write_classified_streetlights(con, pairs)
+        _write_heuristics(con, pa.table(heuristics))
+    finally:
+        con.execute("DROP TABLE IF EXISTS contrast_centers")
+
+
+def _fetch_pairs(con: duckdb.DuckDBPyConnection) -> pa.Table:
+    """
+    Fetch the coordinates of every (crosswalk center, streetlight) pair.
+
+    The A and B points of every crosswalk are picked like in `classify_lights_by_side`.
+    The streetlight lists of the centers are flattened with Arrow rather than with
+    UNNEST, which DuckDB runs one row at a time.
+    """
+    centers = con.execute(
+        """
+        WITH centers AS (
+            SELECT
+                crosswalk_id,
+                MAX(CASE WHEN center_id = 'A' THEN geometry END) AS geom_a,
+                MAX(
+                    CASE
+                        WHEN center_id = 'B' THEN geometry
+                        WHEN is_oneway THEN ST_Point((x1 + x2) / 2.0, (y1 + y2) / 2.0)
+                    END
+                ) AS geom_b
+            FROM crosswalk_centers_lights
+            WHERE center_id IS NOT NULL OR is_oneway = TRUE
+            GROUP BY crosswalk_id
+        )
+        SELECT
+            cl.crosswalk_id,
+            cl.center_id,
+            k.center_index,
+            cl.cx,
+            cl.cy,
+            cl.from_x,
+            cl.from_y,
+            cl.to_x,
+            cl.to_y,
+            ST_X(c.geom_a) AS a_x,
+            ST_Y(c.geom_a) AS a_y,
+            ST_X(c.geom_b) AS b_x,
+            ST_Y(c.geom_b) AS b_y,
+            cl.streetlight_id,
+            cl.streetlight_dist
+        FROM crosswalk_centers_lights cl
+        JOIN centers c USING (crosswalk_id)
+        LEFT JOIN contrast_centers k
+            ON k.crosswalk_id = cl.crosswalk_id AND k.center_id = cl.center_id;
+        """
+    ).arrow()
+    lights = con.execute(
+        """
+        SELECT OBJECTID, ST_X(geometry) AS light_x, ST_Y(geometry) AS light_y
+        FROM streetlights
+        ORDER BY OBJECTID;
+        """
+    ).arrow()
+
+    # One row per element of the streetlight lists
+    streetlight_ids = centers.column("streetlight_id").combine_chunks()
+    center_rows = pc.list_parent_indices(streetlight_ids).to_numpy()
+    pair_ids = pc.list_flatten(streetlight_ids).to_numpy(zero_copy_only=False)
+    pair_dists = pc.list_flatten(centers.column("streetlight_dist").combine_chunks())
+
+    # Look up the streetlights of the pairs; pairs of missing streetlights are dropped
+    light_ids = lights.column("OBJECTID").to_numpy()
+    light_rows = np.searchsorted(light_ids, pair_ids)
+    found = light_rows < len(light_ids)
+    found[found] = light_ids[light_rows[found]] == pair_ids[found]
+    light_rows = light_rows[found]
+
+    pairs = centers.drop_columns(["streetlight_id", "streetlight_dist"]).take(
+        center_rows[found]
+    )
+    pairs = pairs.append_column("streetlight_id", pa.array(pair_ids[found]))
+    pairs = pairs.append_column("dist", pair_dists.filter(pa.array(found)))
+    for name in ["light_x", "light_y"]:
+        pairs = pairs.append_column(name, lights.column(name).take(light_rows))
+    return pairs
+
+
+def _column(table: pa.Table, name: str) -> np.ndarray:
+    """A column of an Arrow table as a float64 array, with NaN for nulls."""
+    return table.column(name).to_numpy().astype(np.float64)
+
+
+def _classify_pairs(pairs: pa.Table) -> dict:
+    """Compute the side, angle and absolute sine of the angle of every pair."""
+    delta_x_ab = _column(pairs, "b_x") - _column(pairs, "a_x")
+    delta_y_ab = _column(pairs, "b_y") - _column(pairs, "a_y")
+    delta_x_ft = _column(pairs, "to_x") - _column(pairs, "from_x")
+    delta_y_ft = _column(pairs, "to_y") - _column(pairs, "from_y")
+    delta_x_cl = _column(pairs, "light_x") - _column(pairs, "cx")
+    delta_y_cl = _column(pairs, "light_y") - _column(pairs, "cy")
+
+    from_to_sign = np.sign(delta_x_ab * delta_y_ft - delta_y_ab * delta_x_ft)
+    center_to_light_sign = np.sign(delta_x_ab * delta_y_cl - delta_y_ab * delta_x_cl)
+    angle_rad = np.arctan2(
+        delta_x_cl * delta_y_ab - delta_y_cl * delta_x_ab,
+        delta_x_cl * delta_x_ab + delta_y_cl * delta_y_ab,
+    )
+    return {
+        # A missing sign compares unequal, so the light is on the "from" side like in SQL
+        "is_to": from_to_sign == center_to_light_sign,
+        "angle_rad": angle_rad,
+        "abs_sin_angle": np.abs(np.sin(angle_rad)),
+    }
+
+
+def _sum_heuristics(pairs: pa.Table, columns: dict, num_centers: int) -> dict:
+    """Sum the contrast and brightness heuristics of every center."""
+    center_index = _column(pairs, "center_index")
+    has_center = ~np.isnan(center_index)
+    center_index = center_index[has_center].astype(np.int64)
+    is_to = columns["is_to"][has_center]
+
+    # dist is a FLOAT column, so 1 / dist² is computed in single precision like in SQL
+    dist = pairs.column("dist").to_numpy().astype(np.float32)[has_center]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dist_squared = dist * dist
+        contrast = columns["abs_sin_angle"][has_center] / dist_squared.astype(np.float64)
+        brightness = (np.float32(1.0) / dist_squared).astype(np.float64)
+
+    def bincount(weights, mask):
+        # Pairs with a missing value are left out of the sums, like NULLs in SUM
+        weights = np.where(mask & ~np.isnan(weights), weights, 0.0)
+        return np.bincount(center_index, weights=weights, minlength=num_centers)
+
+    return {
+        "center_index": np.arange(num_centers),
+        "to_contrast_heuristic": bincount(contrast, is_to),
+        "from_contrast_heuristic": bincount(contrast, ~is_to),
+        "to_brightness_heuristic": bincount(brightness, is_to),
+        "from_brightness_heuristic": bincount(brightness, ~is_to),
+    }
+
+
+def _write_classified_streetlights(con: duckdb.DuckDBPyConnection, pairs: pa.Table):
+    """Create the classified_streetlights table from the classified pairs."""
+    con.register("contrast_pairs", pairs)
+    try:
+        con.execute(
+            """
+            CREATE OR REPLACE TABLE classified_streetlights AS
+            SELECT
+                crosswalk_id,
+                center_id,
+                streetlight_id,
+                ST_MakeLine(ST_Point(cx, cy), ST_Point(light_x, light_y)) AS line_geom,
+                ST_Point(light_x, light_y) AS geometry,
+                CASE WHEN is_to THEN 'to' ELSE 'from' END AS side,
+                angle_rad,
+                abs_sin_angle,
+                ST_MakeLine(ST_Point(a_x, a_y), ST_Point(b_x, b_y)) AS a_to_b,
+                dist
+            FROM contrast_pairs;
+            """
+        )
+    finally:
+        con.unregister("contrast_pairs")
+
+
+def _write_heuristics(con: duckdb.DuckDBPyConnection, heuristics: pa.Table):
+    """Create the crosswalk_centers_heuristics table from the sums of every center."""
+    con.register("contrast_heuristics", heuristics)
+    try:
+        con.execute(
+            """
+            CREATE OR REPLACE TABLE crosswalk_centers_heuristics AS
+            SELECT
+                ac.crosswalk_id,
+                ac.center_id,
+                h.to_contrast_heuristic,
+                h.from_contrast_heuristic,
+                h.to_brightness_heuristic,
+                h.from_brightness_heuristic
+            FROM (
+                SELECT DISTINCT crosswalk_id, center_id, geometry
+                FROM crosswalk_centers_lights
+            ) ac
+            JOIN contrast_centers k
+                ON k.crosswalk_id = ac.crosswalk_id
+                AND k.center_id IS NOT DISTINCT FROM ac.center_id
+            JOIN contrast_heuristics h USING (center_index);
+            """
+        )
+    finally:
+        con.unregister("contrast_heuristics")
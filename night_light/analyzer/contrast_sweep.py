@@ -0,0 +1,129 @@
+from typing import Sequence
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from night_light.analyzer.contrast import CONTRAST_CLASSES, calculate_center_heuristics
+from night_light.profiling import profiled
+from night_light.util_duckdb import table_exists
+
+## Labels the crosswalk centers for many contrast thresholds at once, to calibrate the
+## threshold. The heuristic sums of the centers are read once from the
+## crosswalk_centers_heuristics table, and every threshold is applied to them with
+## NumPy instead of rebuilding crosswalk_centers_contrast.
+
+@profiled
+def count_contrast_classes(
+    con: duckdb.DuckDBPyConnection, thresholds: Sequence[float]
+) -> pd.DataFrame:
+    """
+    Count the crosswalk centers of every contrast class for each threshold.
+
+    The centers are classified like in `label_contrast`. The differences of the
+    heuristics are sorted once per group of centers, so every threshold only costs a
+    few binary searches.
+
+    Args:
+        con: Connection to a DuckDB database with the crosswalk_centers_heuristics
+            table, or the classified_streetlights table to build it from.
+        thresholds: Thresholds of the contrast heuristic classification.
+
+    Returns:
+        DataFrame with one row per threshold and one column per contrast class, in
+        the order of `CONTRAST_CLASSES`.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    difference, one_sided, positive = _compare_heuristics(
+        _fetch_contrast_heuristics(con)
+    )
+
+    counts = np.zeros((len(thresholds), len(CONTRAST_CLASSES)), dtype=np.int64)
+    for is_one_sided, no_limit, weak_limit in [
+        (True, thresholds / 2, thresholds * 3 / 4),
+        (False, thresholds * 3 / 4, thresholds),
+    ]:
+        for is_positive, weak_class, strong_class in [(True, 1, 0), (False, 3, 4)]:
+            # NaN differences sort last, so they are never within a limit
+            group = np.sort(
+                difference[(one_sided == is_one_sided) & (positive == is_positive)]
+            )
+            num_no = np.searchsorted(group, no_limit, side="right")
+            num_weak = np.searchsorted(group, weak_limit, side="right")
+            # A limit can be below the one before it for negative thresholds
+            num_weak = np.maximum(num_weak, num_no)
+            counts[:, 2] += num_no
+            counts[:, weak_class] += num_weak - num_no
+            counts[:, strong_class] += len(group) - num_weak
+    return pd.DataFrame(
+        counts,
+        index=pd.Index(thresholds, name="threshold"),
+        columns=CONTRAST_CLASSES,
+    )
+
+
+@profiled
+def label_contrast_thresholds(
+    con: duckdb.DuckDBPyConnection, thresholds: Sequence[float]
+) -> pd.DataFrame:
+    """
+    Label the contrast class of every crosswalk center for each threshold.
+
+    Args:
+        con: Connection to a DuckDB database with the crosswalk_centers_heuristics
+            table, or the classified_streetlights table to build it from.
+        thresholds: Thresholds of the contrast heuristic classification.
+
+    Returns:
+        DataFrame indexed by crosswalk_id and center_id, with one categorical column
+        of contrast classes per threshold, named by the threshold.
+    """
+    heuristics = _fetch_contrast_heuristics(con)
+    difference, one_sided, positive = _compare_heuristics(heuristics)
+
+    labels = {}
+    for threshold in thresholds:
+        no_contrast = difference <= np.where(
+            one_sided, threshold / 2, threshold * 3 / 4
+        )
+        weak = difference <= np.where(one_sided, threshold * 3 / 4, threshold)
+        codes = np.select(
+            [no_contrast, weak & positive, weak, positive], [2, 1, 3, 0], default=4
+        )
+        labels[threshold] = pd.Categorical.from_codes(codes, CONTRAST_CLASSES)
+    return pd.DataFrame(
+        labels,
+        index=pd.MultiIndex.from_frame(heuristics[["crosswalk_id", "center_id"]]),
+        columns=list(labels),
+    )
+
+
+def _fetch_contrast_heuristics(con: duckdb.DuckDBPyConnection) -> pd.DataFrame:
+    """
+    Read the contrast heuristics of every center, summing them first if they are not
+    cached yet.
+    """
+    if not table_exists(con, "crosswalk_centers_heuristics"):
+        calculate_center_heuristics(con)
+    return con.execute(
+        """
+        SELECT crosswalk_id, center_id, to_contrast_heuristic, from_contrast_heuristic
+        FROM crosswalk_centers_heuristics;
+        """
+    ).df()
+
+
+def _compare_heuristics(heuristics: pd.DataFrame):
+    """
+    Compare the to and from contrast heuristics of every center.
+
+    Returns:
+        Absolute difference of the heuristics, whether the center is lit from one
+        side only, and whether the contrast is positive.
+    """
+    to_contrast = heuristics["to_contrast_heuristic"].to_numpy(dtype=np.float64)
+    from_contrast = heuristics["from_contrast_heuristic"].to_numpy(dtype=np.float64)
+    difference = np.abs(from_contrast - to_contrast)
+    # Centers lit from one side only use tighter thresholds
+    one_sided = (to_contrast == 0) | (from_contrast == 0)
+    return difference, one_sided, from_contrast > to_contrast
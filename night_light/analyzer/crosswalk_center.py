@@ -1,10 +1,19 @@
 import duckdb
 
+from night_light.profiling import profiled
+
 ## Calculates center points for crosswalks, taking into account whether the 
 ## intersecting street is one-way or two-way. Creates the table crosswalk_centers.
 
+@profiled
 def find_crosswalk_centers(con: duckdb.DuckDBPyConnection):
-    """Find the centers of crosswalks."""
+    """
+    Find the centers of crosswalks.
+
+    Along with the geometries, every center stores its coordinates as DOUBLE columns:
+    `x1`, `y1`, `x2`, `y2` for the endpoints of its pedestrian edge, `cx`, `cy` for the
+    center and `street_cx`, `street_cy` for the street center point.
+    """
     # Find the centers of crosswalks for one-way and two-way streets
     _find_crosswalk_centers_oneway(con)
     _find_crosswalk_centers_twoway(con)
@@ -20,7 +29,15 @@ def find_crosswalk_centers(con: duckdb.DuckDBPyConnection):
             street_center_point,
             geometry,
             center_id,
-            is_oneway
+            is_oneway,
+            x1,
+            y1,
+            x2,
+            y2,
+            cx,
+            cy,
+            street_cx,
+            street_cy
         FROM crosswalk_centers_oneway
         
         UNION ALL
@@ -32,7 +49,15 @@ def find_crosswalk_centers(con: duckdb.DuckDBPyConnection):
             street_center_point,
             geometry,
             center_id,
-            is_oneway
+            is_oneway,
+            x1,
+            y1,
+            x2,
+            y2,
+            cx,
+            cy,
+            street_cx,
+            street_cy
         FROM crosswalk_centers_twoway;
         
         DROP TABLE IF EXISTS crosswalk_centers_oneway;
@@ -41,6 +66,7 @@ def find_crosswalk_centers(con: duckdb.DuckDBPyConnection):
     )
 
 
+@profiled
 def _find_crosswalk_centers_oneway(con: duckdb.DuckDBPyConnection):
     """
     Find crosswalk centers for one-way streets.
@@ -57,23 +83,28 @@ def _find_crosswalk_centers_oneway(con: duckdb.DuckDBPyConnection):
             i.crosswalk_id,
             i.street_segment_id,
             p.ped_edge_geom,
-            ST_AsText(i.center_geom) AS street_center_point,
-            ST_AsText(i.center_geom) AS geometry,
+            i.center_geom AS street_center_point,
+            i.center_geom AS geometry,
             TRUE AS is_oneway,
-            'A' AS center_id
+            'A' AS center_id,
+            p.x1,
+            p.y1,
+            p.x2,
+            p.y2,
+            ST_X(i.center_geom) AS cx,
+            ST_Y(i.center_geom) AS cy,
+            ST_X(i.center_geom) AS street_cx,
+            ST_Y(i.center_geom) AS street_cy
         FROM (
             SELECT
                 cw.OBJECTID AS crosswalk_id,
                 s.OBJECTID AS street_segment_id,
                 ST_Centroid(
-                    ST_Intersection(
-                        ST_Boundary(ST_GeomFromText(cw.geometry)),
-                        ST_GeomFromText(s.geometry)
-                    )
+                    ST_Intersection(ST_Boundary(cw.geometry), s.geometry)
                 ) AS center_geom
             FROM crosswalks cw
             JOIN street_segments s
-                ON ST_Intersects(ST_Boundary(ST_GeomFromText(cw.geometry)), ST_GeomFromText(s.geometry))
+                ON ST_Intersects(ST_Boundary(cw.geometry), s.geometry)
             WHERE cw.OBJECTID IN (
                 SELECT DISTINCT crosswalk_id FROM crosswalk_segments WHERE is_oneway = TRUE
             )
@@ -81,7 +112,11 @@ def _find_crosswalk_centers_oneway(con: duckdb.DuckDBPyConnection):
         LEFT JOIN (
             SELECT
                 cs.crosswalk_id,
-                cs.geometry AS ped_edge_geom
+                cs.geometry AS ped_edge_geom,
+                cs.x1,
+                cs.y1,
+                cs.x2,
+                cs.y2
             FROM crosswalk_segments cs
             JOIN (
                 SELECT
@@ -101,6 +136,7 @@ def _find_crosswalk_centers_oneway(con: duckdb.DuckDBPyConnection):
     )
 
 
+@profiled
 def _find_crosswalk_centers_twoway(con: duckdb.DuckDBPyConnection):
     """
     Find crosswalk centers for two-way streets.
@@ -129,28 +165,18 @@ def _find_crosswalk_centers_twoway(con: duckdb.DuckDBPyConnection):
             SELECT
                 cw.OBJECTID AS crosswalk_id,
                 (UNNEST(
-                    ST_Dump(
-                        ST_Intersection(
-                            ST_Boundary(ST_GeomFromText(cw.geometry)),
-                            ST_GeomFromText(s.geometry)
-                        )
-                    )
+                    ST_Dump(ST_Intersection(ST_Boundary(cw.geometry), s.geometry))
                 ).geom) AS intersection_geom
             FROM crosswalks cw
             JOIN street_segments s
-                ON ST_Intersects(
-                    ST_Boundary(ST_GeomFromText(cw.geometry)),
-                    ST_GeomFromText(s.geometry)
-                )
+                ON ST_Intersects(ST_Boundary(cw.geometry), s.geometry)
         ),
         intersection_mid AS (
             SELECT
                 crosswalk_id,
                 -- Average all X’s and Y’s to get one “intersection_center”
-                ST_Point(
-                    AVG(ST_X(intersection_geom)),
-                    AVG(ST_Y(intersection_geom))
-                ) AS intersection_center
+                AVG(ST_X(intersection_geom)) AS street_cx,
+                AVG(ST_Y(intersection_geom)) AS street_cy
             FROM intersection_points
             GROUP BY crosswalk_id
             -- Use >= 2 (not = 2) so you include crosswalks with more than 2 intersection points
@@ -161,16 +187,12 @@ def _find_crosswalk_centers_twoway(con: duckdb.DuckDBPyConnection):
                 crosswalk_id,
                 street_segment_id,
                 geometry as ped_edge_geom,
-                ST_Point(
-                    (
-                        ST_X(ST_PointN(ST_GeomFromText(geometry), 1)) +
-                        ST_X(ST_PointN(ST_GeomFromText(geometry), 2))
-                    ) / 2.0,
-                    (
-                        ST_Y(ST_PointN(ST_GeomFromText(geometry), 1)) +
-                        ST_Y(ST_PointN(ST_GeomFromText(geometry), 2))
-                    ) / 2.0
-                ) AS edge_mid,
+                x1,
+                y1,
+                x2,
+                y2,
+                (x1 + x2) / 2.0 AS mid_x,
+                (y1 + y2) / 2.0 AS mid_y,
                 is_oneway
             FROM crosswalk_segments
             WHERE is_vehicle_edge = FALSE AND is_oneway = FALSE
@@ -180,14 +202,15 @@ def _find_crosswalk_centers_twoway(con: duckdb.DuckDBPyConnection):
                 e.crosswalk_id,
                 e.street_segment_id,
                 e.ped_edge_geom,
-                ST_AsText(i.intersection_center) AS street_center_point,
-                ST_AsText(
-                    ST_Point(
-                        (ST_X(e.edge_mid) + ST_X(i.intersection_center)) / 2.0,
-                        (ST_Y(e.edge_mid) + ST_Y(i.intersection_center)) / 2.0
-                    )
-                ) AS geometry,
-                e.is_oneway
+                e.is_oneway,
+                e.x1,
+                e.y1,
+                e.x2,
+                e.y2,
+                (e.mid_x + i.street_cx) / 2.0 AS cx,
+                (e.mid_y + i.street_cy) / 2.0 AS cy,
+                i.street_cx,
+                i.street_cy
             FROM ped_edge_mid e
             JOIN intersection_mid i USING (crosswalk_id)
         )
@@ -195,19 +218,29 @@ def _find_crosswalk_centers_twoway(con: duckdb.DuckDBPyConnection):
             crosswalk_id,
             street_segment_id,
             ped_edge_geom,
-            street_center_point,
+            ST_Point(street_cx, street_cy) AS street_center_point,
             geometry,
             CASE 
                 WHEN rn = 1 THEN 'A'
                 WHEN rn = 2 THEN 'B'
                 ELSE NULL
             END AS center_id,
-            is_oneway
+            is_oneway,
+            x1,
+            y1,
+            x2,
+            y2,
+            cx,
+            cy,
+            street_cx,
+            street_cy
         FROM (
             SELECT
                 *,
-                ROW_NUMBER() OVER (PARTITION BY crosswalk_id ORDER BY geometry) AS rn
-            FROM centers
+                -- Order by the WKT text so the A/B labels do not depend on the
+                -- binary layout of the stored geometry
+                ROW_NUMBER() OVER (PARTITION BY crosswalk_id ORDER BY ST_AsText(geometry)) AS rn
+            FROM (SELECT *, ST_Point(cx, cy) AS geometry FROM centers)
         ) sub
         WHERE rn <= 2;
         """
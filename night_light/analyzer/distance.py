@@ -2,11 +2,19 @@ import duckdb
 
 import datetime
 import math
+from typing import Optional
+
+import numpy as np
+
+from night_light.profiling import profiled
+from night_light.spatial_index import GridIndex
+from night_light.util_duckdb import find_local_crs, get_local_crs
 
 ## Links streetlights to crosswalk centers by identifying all streetlights within a specified distance of each crosswalk center.
 ## The goal is to populate each crosswalk center with nearby streetlight IDs and their respective distances.
 
 
+@profiled
 def find_streetlights_crosswalk_centers(con: duckdb.DuckDBPyConnection, dist: float):
     """
     Find all of the streetlights within a distance from each crosswalk center.
@@ -15,72 +23,370 @@ def find_streetlights_crosswalk_centers(con: duckdb.DuckDBPyConnection, dist: fl
     - `streetlight_id`: a list of streetlight IDs (ints) within the specified distance from each crosswalk centerpoint
     - `streetlight_dist`: a list of distances (in meters) from the centerpoint to each nearby streetlight.
 
+    Runs `search_streetlights_crosswalk_centers` and
+    `filter_streetlights_crosswalk_centers` with the same distance.
+
     Args:
         con: connection to duckdb table
         dist: float of meters to search for streetlights near each crosswalk centerpoint
     """
-    long_lat_flipper(con, "streetlights")
-    long_lat_flipper(con, "crosswalk_centers_lights")
+    search_streetlights_crosswalk_centers(con, dist)
+    filter_streetlights_crosswalk_centers(con, dist)
+
+
+@profiled
+def search_streetlights_crosswalk_centers(
+    con: duckdb.DuckDBPyConnection, max_dist: float
+):
+    """
+    Find the streetlights within the largest distance of interest from each crosswalk
+    center, so smaller distances can be derived without another spatial join.
+
+    Creates the streetlight_search table with one row per center of crosswalk_centers:
+    - `streetlight_id`: the IDs of the streetlights within `max_dist`, nearest first
+    - `streetlight_dist`: their distances (in meters) from the center
+    - `search_dist`: the distances the search compares to the radius, when they differ
+      from `streetlight_dist`
+    - `max_dist`: the radius of the search
+
+    Tables in EPSG:4326 are searched with spheroidal distances on flipped lat/long
+    coordinates and report spherical distances. Tables projected with
+    `project_to_local_crs` are searched with planar distances, which is much faster
+    for large datasets.
+
+    Args:
+        con: connection to duckdb table
+        max_dist: float of meters to search for streetlights near each crosswalk
+            centerpoint
+    """
+    params = {"dist": max_dist}
+    if get_local_crs(con) is None:
+        long_lat_flipper(con, "streetlights")
+        # A range join on the coordinates first drops the pairs that are more than
+        # `margin` degrees apart. The margin overestimates `max_dist` at the latitude
+        # of the center furthest from the equator, with 1% to spare for the spheroid.
+        # The spheroidal distance of the remaining pairs is computed once and filtered
+        # on, and the spherical one only for the pairs within `max_dist`.
+        latitude = con.execute(
+            "SELECT COALESCE(MAX(ABS(ST_Y(geometry))), 0) FROM crosswalk_centers"
+        ).fetchone()[0]
+        params["margin"] = meters_to_degrees(max_dist, latitude) * 1.01
+        nearby_query = """
+            SELECT
+                crosswalk_id,
+                center_id,
+                street_segment_id,
+                streetlight_id,
+                ST_Distance_Sphere(light_lat_long, center_lat_long) AS dist,
+                search_dist
+            FROM (
+                SELECT
+                    c.crosswalk_id,
+                    c.center_id,
+                    c.street_segment_id,
+                    s.OBJECTID AS streetlight_id,
+                    s.geometry_lat_long AS light_lat_long,
+                    c.geometry_lat_long AS center_lat_long,
+                    ST_Distance_Spheroid(s.geometry_lat_long, c.geometry_lat_long)
+                        AS search_dist
+                FROM (
+                    SELECT
+                        *,
+                        ST_X(geometry) AS x,
+                        ST_Y(geometry) AS y,
+                        ST_FlipCoordinates(geometry) AS geometry_lat_long
+                    FROM crosswalk_centers
+                ) c
+                JOIN (
+                    SELECT
+                        OBJECTID,
+                        geometry_lat_long,
+                        ST_X(geometry) AS x,
+                        ST_Y(geometry) AS y
+                    FROM streetlights
+                ) s
+                    ON s.x BETWEEN c.x - $margin AND c.x + $margin
+                    AND s.y BETWEEN c.y - $margin AND c.y + $margin
+            )
+            WHERE search_dist <= $dist
+        """
+    else:
+        # The tables are projected to meters, so streetlights are hashed into a grid
+        # of `dist`-sized cells and every center only checks the 3x3 cells around it
+        nearby_query = """
+            WITH light_cells AS (
+                SELECT
+                    OBJECTID,
+                    geometry,
+                    CAST(FLOOR(ST_X(geometry) / $dist) AS BIGINT) AS cell_x,
+                    CAST(FLOOR(ST_Y(geometry) / $dist) AS BIGINT) AS cell_y
+                FROM streetlights
+            ),
+            center_cells AS (
+                SELECT
+                    c.crosswalk_id,
+                    c.center_id,
+                    c.street_segment_id,
+                    c.geometry,
+                    CAST(FLOOR(ST_X(c.geometry) / $dist) AS BIGINT) + dx AS cell_x,
+                    CAST(FLOOR(ST_Y(c.geometry) / $dist) AS BIGINT) + dy AS cell_y
+                FROM crosswalk_centers c
+                CROSS JOIN (SELECT UNNEST([-1, 0, 1]) AS dx)
+                CROSS JOIN (SELECT UNNEST([-1, 0, 1]) AS dy)
+            )
+            SELECT
+                c.crosswalk_id,
+                c.center_id,
+                c.street_segment_id,
+                l.OBJECTID AS streetlight_id,
+                ST_Distance(l.geometry, c.geometry) AS dist,
+                NULL::DOUBLE AS search_dist
+            FROM center_cells c
+            JOIN light_cells l
+                ON c.cell_x = l.cell_x
+                AND c.cell_y = l.cell_y
+                AND ST_DWithin(l.geometry, c.geometry, $dist)
+        """
 
     print(
         datetime.datetime.now(),
         "Calculating distances between streetlights and crosswalks. This might take awhile...",
     )
 
-    query = """
-    WITH 
-    -- 1. Precast geometries to avoid redundant parsing
-    geom_inputs AS (
-        SELECT 
-            cl.crosswalk_id,
-            ST_GeomFromText(cl.geometry_lat_long) AS cross_geom
-        FROM crosswalk_centers_lights cl
-    ),
-    geom_lights AS (
-        SELECT 
-            s.OBJECTID AS streetlight_id,
-            ST_GeomFromText(s.geometry_lat_long) AS light_geom
-        FROM streetlights s
-    ),
-    -- 2. Add pre-filtering with bounding boxes for better performance
-    filtered_pairs AS (
-        SELECT 
-            gi.crosswalk_id,
-            gi.cross_geom,
-            gl.streetlight_id,
-            gl.light_geom
-        FROM geom_inputs gi
-        JOIN geom_lights gl
-            ON ST_DWithin_Spheroid(gl.light_geom, gi.cross_geom, ?)
+    # Centers without nearby streetlights get empty lists, so every center has a row.
+    # street_segment_id is part of the key because a one-way crosswalk crossing two
+    # streets has two "A" centers.
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE streetlight_search AS
+        WITH nearby AS (
+            -- Sorting lists of structs is much faster than ordered aggregates
+            SELECT
+                crosswalk_id,
+                center_id,
+                street_segment_id,
+                list_sort(
+                    array_agg(
+                        struct_pack(
+                            sort_dist := COALESCE(search_dist, dist),
+                            streetlight_id := streetlight_id,
+                            dist := dist,
+                            search_dist := search_dist
+                        )
+                    )
+                ) AS lights,
+                COUNT(search_dist) > 0 AS has_search_dist
+            FROM ({nearby_query})
+            GROUP BY crosswalk_id, center_id, street_segment_id
+        ),
+        nearby_lists AS (
+            SELECT
+                crosswalk_id,
+                center_id,
+                street_segment_id,
+                list_transform(lights, l -> l.streetlight_id) AS streetlight_id,
+                list_transform(lights, l -> l.dist) AS streetlight_dist,
+                CASE WHEN has_search_dist THEN
+                    list_transform(lights, l -> l.search_dist)
+                END AS search_dist
+            FROM nearby
+        )
+        SELECT
+            c.crosswalk_id,
+            c.center_id,
+            c.street_segment_id,
+            COALESCE(n.streetlight_id, []) AS streetlight_id,
+            COALESCE(n.streetlight_dist, []) AS streetlight_dist,
+            n.search_dist,
+            CAST($dist AS DOUBLE) AS max_dist
+        FROM (
+            SELECT DISTINCT crosswalk_id, center_id, street_segment_id
+            FROM crosswalk_centers
+        ) c
+        LEFT JOIN nearby_lists n
+            ON c.crosswalk_id = n.crosswalk_id
+            AND c.center_id IS NOT DISTINCT FROM n.center_id
+            AND c.street_segment_id IS NOT DISTINCT FROM n.street_segment_id;
+        """,
+        params,
     )
-    -- 3. Aggregate distances and IDs
-    SELECT
-        crosswalk_id,
-        ST_AsText(cross_geom) AS crosswalk_geometry,
-        array_agg(streetlight_id) AS streetlight_ids,
-        array_agg(ST_Distance_Sphere(light_geom, cross_geom)) AS streetlight_dists
-    FROM filtered_pairs
-    GROUP BY crosswalk_id, cross_geom;
-    """
-
-    # Execute the query
-    crosswalks_streetlights = con.execute(query, [dist]).fetchall()
-    # Update crosswalk_centers_lights with the streetlight data
-    for crosswalk in crosswalks_streetlights:
-        crosswalk_geometry = crosswalk[1]
-        streetlight_ids = crosswalk[2]
-        streetlight_dists = crosswalk[3]
 
+
+@profiled
+def find_nearest_streetlights_crosswalk_centers(
+    con: duckdb.DuckDBPyConnection, k: int, max_dist: Optional[float] = None
+):
+    """
+    Find the k nearest streetlights of each crosswalk center.
+
+    Fills in the same `streetlight_id` and `streetlight_dist` columns as
+    `find_streetlights_crosswalk_centers`, nearest first. Runs
+    `search_nearest_streetlights_crosswalk_centers` and
+    `filter_streetlights_crosswalk_centers`.
+
+    Args:
+        con: connection to duckdb table
+        k: number of streetlights to find for each crosswalk centerpoint
+        max_dist: only find streetlights within this many meters. Default is no
+            limit.
+    """
+    search_nearest_streetlights_crosswalk_centers(con, k, max_dist)
+    filter_streetlights_crosswalk_centers(con, np.inf if max_dist is None else max_dist)
+
+
+@profiled
+def search_nearest_streetlights_crosswalk_centers(
+    con: duckdb.DuckDBPyConnection, k: int, max_dist: Optional[float] = None
+):
+    """
+    Find the k nearest streetlights of each crosswalk center with a grid index.
+
+    Creates the same streetlight_search table as
+    `search_streetlights_crosswalk_centers`, with at most k streetlights per center,
+    so `filter_streetlights_crosswalk_centers` picks the k nearest within any
+    smaller distance. The coordinates are read once and searched with a
+    `GridIndex` instead of a spatial join.
+
+    Tables in EPSG:4326 are projected to the local UTM zone for the search, and the
+    distances are planar distances in that zone, which differ from spherical ones
+    by well under 1% within a city.
+
+    Args:
+        con: connection to duckdb table
+        k: number of streetlights to find for each crosswalk centerpoint
+        max_dist: only find streetlights within this many meters. Default is no
+            limit.
+    """
+    # Imported here rather than at the top so that runs without `nearest` never load
+    # pyarrow
+    import pyarrow as pa
+
+    if get_local_crs(con) is None:
+        crs = find_local_crs(con, "streetlights")
+        geometry = f"ST_Transform(geometry, 'EPSG:4326', '{crs}', always_xy := true)"
+    else:
+        geometry = "geometry"
+    lights = con.execute(
+        f"""
+        SELECT OBJECTID, ST_X(point) AS x, ST_Y(point) AS y
+        FROM (SELECT OBJECTID, {geometry} AS point FROM streetlights)
+        ORDER BY OBJECTID;
+        """
+    ).fetchnumpy()
+    centers = con.execute(
+        f"""
+        SELECT
+            crosswalk_id,
+            center_id,
+            street_segment_id,
+            ST_X(point) AS x,
+            ST_Y(point) AS y
+        FROM (
+            SELECT DISTINCT
+                crosswalk_id, center_id, street_segment_id, {geometry} AS point
+            FROM crosswalk_centers
+        );
+        """
+    ).arrow()
+
+    print(
+        datetime.datetime.now(),
+        "Finding the nearest streetlights of every crosswalk center.",
+    )
+    index = GridIndex(lights["x"], lights["y"])
+    rows, dists = index.nearest(
+        centers.column("x").to_numpy(zero_copy_only=False),
+        centers.column("y").to_numpy(zero_copy_only=False),
+        k,
+        max_dist,
+    )
+
+    # Store the neighbors of every center as lists, nearest first
+    found = rows >= 0
+    offsets = np.concatenate([[0], np.cumsum(found.sum(axis=1))]).astype(np.int32)
+    nearest = centers.drop_columns(["x", "y"])
+    nearest = nearest.append_column(
+        "streetlight_id",
+        pa.ListArray.from_arrays(offsets, pa.array(lights["OBJECTID"][rows[found]])),
+    )
+    nearest = nearest.append_column(
+        "streetlight_dist", pa.ListArray.from_arrays(offsets, pa.array(dists[found]))
+    )
+    con.register("nearest_streetlights", nearest)
+    try:
         con.execute(
             """
-            UPDATE crosswalk_centers_lights
-            SET streetlight_id = ?, streetlight_dist = ?
-            WHERE geometry_lat_long = ?
-        """,
-            (streetlight_ids, streetlight_dists, crosswalk_geometry),
+            CREATE OR REPLACE TABLE streetlight_search AS
+            SELECT
+                crosswalk_id,
+                center_id,
+                street_segment_id,
+                CAST(streetlight_id AS INTEGER[]) AS streetlight_id,
+                streetlight_dist,
+                NULL::DOUBLE[] AS search_dist,
+                CAST($dist AS DOUBLE) AS max_dist
+            FROM nearest_streetlights;
+            """,
+            {"dist": np.inf if max_dist is None else max_dist},
         )
+    finally:
+        con.unregister("nearest_streetlights")
+
+
+@profiled
+def filter_streetlights_crosswalk_centers(
+    con: duckdb.DuckDBPyConnection, dist: float
+):
+    """
+    Fill in the nearby streetlights of every crosswalk center from the
+    streetlight_search table, keeping the ones within `dist`.
+
+    The lists of the search are sorted by distance, so they are cut at the first
+    streetlight beyond `dist` and no spatial predicate is evaluated. Centers without a
+    streetlight within `dist` are left with NULL lists.
+
+    Args:
+        con: connection to duckdb table
+        dist: float of meters to search for streetlights near each crosswalk
+            centerpoint. Must not exceed the distance of the search.
+    """
+    max_dist = con.execute("SELECT MIN(max_dist) FROM streetlight_search").fetchone()[0]
+    if max_dist is not None and dist > max_dist:
+        raise ValueError(
+            f"Cannot filter streetlights within {dist} meters from a search within "
+            f"{max_dist} meters. Search again with a larger distance."
+        )
+    if get_local_crs(con) is None:
+        long_lat_flipper(con, "crosswalk_centers_lights")
+
+    con.execute(
+        """
+        UPDATE crosswalk_centers_lights
+        SET
+            streetlight_id = CASE WHEN s.num_lights > 0 THEN s.streetlight_id[1:s.num_lights] END,
+            streetlight_dist = CASE WHEN s.num_lights > 0 THEN s.streetlight_dist[1:s.num_lights] END
+        FROM (
+            SELECT
+                crosswalk_id,
+                center_id,
+                street_segment_id,
+                streetlight_id,
+                streetlight_dist,
+                len(
+                    list_filter(COALESCE(search_dist, streetlight_dist), d -> d <= $dist)
+                ) AS num_lights
+            FROM streetlight_search
+        ) s
+        WHERE crosswalk_centers_lights.crosswalk_id = s.crosswalk_id
+        AND crosswalk_centers_lights.center_id IS NOT DISTINCT FROM s.center_id
+        AND crosswalk_centers_lights.street_segment_id
+            IS NOT DISTINCT FROM s.street_segment_id;
+        """,
+        {"dist": dist},
+    )
 
 
+@profiled
 def long_lat_flipper(con: duckdb.DuckDBPyConnection, table: str):
     """
     Flips the coordinate so that they are in lat, long order instead of long, lat
@@ -89,16 +395,15 @@ def long_lat_flipper(con: duckdb.DuckDBPyConnection, table: str):
         Name (string) of table of database
     """
     query = f"""
-    ALTER TABLE {table} ADD COLUMN IF NOT EXISTS geometry_lat_long TEXT;
+    ALTER TABLE {table} ADD COLUMN IF NOT EXISTS geometry_lat_long GEOMETRY;
     
     UPDATE {table}
-    SET geometry_lat_long = ST_AsText(
-        ST_Point(ST_Y(ST_GeomFromText(geometry)), ST_X(ST_GeomFromText(geometry)))
-    );
+    SET geometry_lat_long = ST_FlipCoordinates(geometry);
     """
     con.execute(query)
 
 
+@profiled
 def create_crosswalk_centers_lights(con: duckdb.DuckDBPyConnection):
     """
     Create a table called crosswalk_centers_lights.
@@ -112,7 +417,7 @@ def create_crosswalk_centers_lights(con: duckdb.DuckDBPyConnection):
     # Copy crosswalk_centers into a new table
     con.execute(
         """
-        CREATE TABLE IF NOT EXISTS crosswalk_centers_lights AS
+        CREATE OR REPLACE TABLE crosswalk_centers_lights AS
         SELECT * FROM crosswalk_centers
     """
     )
@@ -1,6 +1,6 @@
 import duckdb
 
-from night_light.util_duckdb import query_table_to_gdf
+from night_light.profiling import profiled
 
 
 ## Processes crosswalk geometry data stored in a DuckDB database. It simplifies
@@ -8,32 +8,32 @@ from night_light.util_duckdb import query_table_to_gdf
 ## based on whether they intersect streets (and if those streets are one-way).
 
 
+@profiled
 def simplify_crosswalk_polygon_to_box(con: duckdb.DuckDBPyConnection):
     """
     Converts each crosswalk polygon into its minimum bounding rectangle (oriented).
+
+    The rectangles are computed in bulk inside DuckDB and replace the crosswalks
+    table in one statement.
     """
-    gdf = query_table_to_gdf(con, "crosswalks", "SELECT * FROM crosswalks")
-    # Get oriented bounding rectangles
-    gdf["oriented_env"] = gdf["geometry"].apply(
-        lambda geom: geom.minimum_rotated_rectangle
-    )
-    # Write the result back to DuckDB
-    gdf["geometry"] = gdf["oriented_env"].to_wkt()
-    con.register("temp_gdf", gdf[["OBJECTID", "geometry"]])
     con.execute(
         """
-            UPDATE crosswalks
-            SET geometry = (
-                SELECT t.geometry
-                FROM temp_gdf t
-                WHERE t.OBJECTID = crosswalks.OBJECTID
-            )
+        CREATE OR REPLACE TABLE crosswalks AS
+        SELECT * REPLACE (ST_MinimumRotatedRectangle(geometry) AS geometry)
+        FROM crosswalks;
         """
     )
 
 
+@profiled
 def decompose_crosswalk_edges(con: duckdb.DuckDBPyConnection):
-    """Decompose crosswalks polygons into separate edges."""
+    """
+    Decompose crosswalks polygons into separate edges.
+
+    Besides the edge geometry, the coordinates of its start point (`x1`, `y1`) and end
+    point (`x2`, `y2`) are stored as DOUBLE columns, so later steps can work on them
+    with plain arithmetic instead of extracting them from the geometry every time.
+    """
     con.execute(
         """
         -- Create or replace the table of crosswalk edges (line segments)
@@ -41,17 +41,15 @@ def decompose_crosswalk_edges(con: duckdb.DuckDBPyConnection):
         WITH boundaries AS (
             SELECT
                 cw.OBJECTID AS crosswalk_id,
-                (UNNEST(ST_Dump(ST_Boundary(ST_GeomFromText(cw.geometry)))).geom) AS boundary_geom
+                (UNNEST(ST_Dump(ST_Boundary(cw.geometry))).geom) AS boundary_geom
             FROM crosswalks cw
         ),
         segments AS (
             SELECT
                 crosswalk_id,
                 g.i AS edge_id,
-                ST_AsText(ST_MakeLine(
-                    ST_PointN(boundary_geom, CAST(g.i AS INT)),
-                    ST_PointN(boundary_geom, CAST(g.i + 1 AS INT))
-                )) AS segment_geom
+                ST_PointN(boundary_geom, CAST(g.i AS INT)) AS start_point,
+                ST_PointN(boundary_geom, CAST(g.i + 1 AS INT)) AS end_point
             FROM boundaries
             -- Generate a series 1..(npoints-1), label it g(i)
             CROSS JOIN generate_series(1, ST_NPoints(boundary_geom) - 1) AS g(i)
@@ -59,66 +57,80 @@ def decompose_crosswalk_edges(con: duckdb.DuckDBPyConnection):
         SELECT
             crosswalk_id,
             edge_id,
-            segment_geom AS geometry
+            ST_MakeLine(start_point, end_point) AS geometry,
+            ST_X(start_point) AS x1,
+            ST_Y(start_point) AS y1,
+            ST_X(end_point) AS x2,
+            ST_Y(end_point) AS y2
         FROM segments;
         """
     )
 
 
+@profiled
 def classify_edges_by_intersection(con: duckdb.DuckDBPyConnection):
-    """Classify edges based on intersection with street segments and oneway status."""
+    """
+    Classify edges based on intersection with street segments and oneway status.
+
+    All three columns are filled in by a single spatial join between the crosswalk
+    edges and the street segments. DuckDB plans the ``ST_Intersects`` join as a
+    range join over the bounding boxes of both sides, so each edge is only tested
+    against the streets whose extents overlap it.
+
+    - `is_vehicle_edge`: whether the edge intersects any street segment.
+    - `street_segment_id`: the street segment the crosswalk crosses, shared by all
+      edges of the crosswalk.
+    - `is_oneway`: whether that street segment is one-way.
+
+    The endpoint coordinates of the edges are carried over.
+    """
     con.execute(
         """
-        -- 1. Ensure necessary columns exist
-        ALTER TABLE crosswalk_segments 
-        ADD COLUMN IF NOT EXISTS is_vehicle_edge BOOLEAN DEFAULT FALSE;
-        
-        ALTER TABLE crosswalk_segments
-        ADD COLUMN IF NOT EXISTS street_segment_id INT;
-        
-        ALTER TABLE crosswalk_segments
-        ADD COLUMN IF NOT EXISTS is_oneway BOOLEAN DEFAULT FALSE;
-        
-        -- 2. Update crosswalk segments to find intersecting street segments
-        UPDATE crosswalk_segments
-        SET 
-        is_vehicle_edge = COALESCE((
-            SELECT COUNT(*) > 0
-            FROM street_segments s
-            WHERE ST_Intersects(ST_GeomFromText(crosswalk_segments.geometry), ST_GeomFromText(s.geometry))
-        ), FALSE), -- Default to FALSE if no intersection is found
-        street_segment_id = (
-            SELECT COALESCE(MAX(t.street_segment_id), NULL) -- Ensure NULL safety
-            FROM (
-                SELECT cs2.crosswalk_id,
-                       (SELECT s.OBJECTID
-                        FROM street_segments s
-                        WHERE ST_Intersects(
-                                 ST_GeomFromText(cs2.geometry),
-                                 ST_GeomFromText(s.geometry)
-                              )
-                        ORDER BY s.OBJECTID LIMIT 1 -- Get the first intersecting street segment
-                       ) AS street_segment_id
-                FROM crosswalk_segments cs2
-                WHERE cs2.crosswalk_id = crosswalk_segments.crosswalk_id
-            ) t
-        );
-        
-        -- 3. Determine if the intersecting street segment is one-way
-        UPDATE crosswalk_segments
-        SET is_oneway = x.oneway
-        FROM (
+        CREATE OR REPLACE TABLE crosswalk_segments AS
+        WITH edge_streets AS (
+            -- 1. Find the first intersecting street segment of every edge
             SELECT
-                crosswalk_id,
-                MAX(CASE 
-                    WHEN s.ONEWAY = 'FT' THEN TRUE
-                    ELSE FALSE
-                END) AS oneway
+                cs.crosswalk_id,
+                cs.edge_id,
+                MIN(s.OBJECTID) AS street_segment_id
             FROM crosswalk_segments cs
-            JOIN street_segments s ON s.OBJECTID = cs.street_segment_id
-            WHERE cs.is_vehicle_edge = TRUE
-            GROUP BY crosswalk_id
-        ) x
-        WHERE crosswalk_segments.crosswalk_id = x.crosswalk_id;
+            JOIN street_segments s
+                ON ST_Intersects(cs.geometry, s.geometry)
+            GROUP BY cs.crosswalk_id, cs.edge_id
+        ),
+        classified_edges AS (
+            -- 2. Edges without a street are pedestrian edges; every edge of a crosswalk
+            --    shares the street segment picked for the crosswalk
+            SELECT
+                cs.crosswalk_id,
+                cs.edge_id,
+                cs.geometry,
+                cs.x1,
+                cs.y1,
+                cs.x2,
+                cs.y2,
+                e.edge_id IS NOT NULL AS is_vehicle_edge,
+                MAX(e.street_segment_id) OVER (
+                    PARTITION BY cs.crosswalk_id
+                ) AS street_segment_id
+            FROM crosswalk_segments cs
+            LEFT JOIN edge_streets e
+                ON cs.crosswalk_id = e.crosswalk_id AND cs.edge_id = e.edge_id
+        )
+        -- 3. Determine if the intersecting street segment is one-way
+        SELECT
+            ce.crosswalk_id,
+            ce.edge_id,
+            ce.geometry,
+            ce.is_vehicle_edge,
+            CAST(ce.street_segment_id AS INT) AS street_segment_id,
+            COALESCE(s.ONEWAY = 'FT', FALSE) AS is_oneway,
+            ce.x1,
+            ce.y1,
+            ce.x2,
+            ce.y2
+        FROM classified_edges ce
+        LEFT JOIN street_segments s ON s.OBJECTID = ce.street_segment_id
+        ORDER BY ce.crosswalk_id, ce.edge_id;
         """
     )
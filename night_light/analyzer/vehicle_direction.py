@@ -1,9 +1,12 @@
 import duckdb
 
+from night_light.profiling import profiled
+
 ## Determines the direction of vehicle flow relative to pedestrian crosswalks and stores
 ## this direction using from_coord and to_coord in the crosswalk_centers table.
 
 
+@profiled
 def identify_vehicle_direction(con: duckdb.DuckDBPyConnection):
     """
     Identify the direction of the vehicle for each side of the road segment.
@@ -46,155 +49,118 @@ def identify_vehicle_direction(con: duckdb.DuckDBPyConnection):
 
       * For from_coord, choose the vertex with the smaller X.
       * For to_coord, choose the vertex with the larger X.
+
+    The vertices are chosen with plain arithmetic on the coordinate columns of the
+    centers; `from_x`, `from_y`, `to_x` and `to_y` store the result, and `from_coord`
+    and `to_coord` are built from them.
     """
     con.execute(
         """
         -- Add columns to store the from/to direction
         ALTER TABLE crosswalk_centers DROP COLUMN IF EXISTS from_coord;
         ALTER TABLE crosswalk_centers DROP COLUMN IF EXISTS to_coord;
+        ALTER TABLE crosswalk_centers DROP COLUMN IF EXISTS from_x;
+        ALTER TABLE crosswalk_centers DROP COLUMN IF EXISTS from_y;
+        ALTER TABLE crosswalk_centers DROP COLUMN IF EXISTS to_x;
+        ALTER TABLE crosswalk_centers DROP COLUMN IF EXISTS to_y;
         
-        ALTER TABLE crosswalk_centers ADD COLUMN from_coord VARCHAR;
-        ALTER TABLE crosswalk_centers ADD COLUMN to_coord VARCHAR;
+        ALTER TABLE crosswalk_centers ADD COLUMN from_coord GEOMETRY;
+        ALTER TABLE crosswalk_centers ADD COLUMN to_coord GEOMETRY;
+        ALTER TABLE crosswalk_centers ADD COLUMN from_x DOUBLE;
+        ALTER TABLE crosswalk_centers ADD COLUMN from_y DOUBLE;
+        ALTER TABLE crosswalk_centers ADD COLUMN to_x DOUBLE;
+        ALTER TABLE crosswalk_centers ADD COLUMN to_y DOUBLE;
         """
     )
     _identify_vehicle_direction_oneway(con)
     _identify_vehicle_direction_twoway(con)
+    con.execute(
+        """
+        UPDATE crosswalk_centers
+        SET
+            from_coord = ST_Point(from_x, from_y),
+            to_coord = ST_Point(to_x, to_y)
+        WHERE from_x IS NOT NULL;
+        """
+    )
 
 
+@profiled
 def _identify_vehicle_direction_oneway(con: duckdb.DuckDBPyConnection):
     """Identify the direction of the vehicle for one-way streets."""
     con.execute(
         """
         -- One-way streets
         UPDATE crosswalk_centers cc
-        SET 
-            from_coord = CASE
-                -- Compare the distance from the street's first point to the two endpoints of ped_edge_geom
-                WHEN ST_Distance(
-                        ST_PointN(ST_GeomFromText(s.geometry), 1),
-                        ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 1)
-                    )
-                    <
-                    ST_Distance(
-                        ST_PointN(ST_GeomFromText(s.geometry), 1),
-                        ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 2)
-                    )
-                THEN ST_AsText(ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 1))
-                ELSE ST_AsText(ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 2))
-            END,
-            to_coord = CASE
-                WHEN ST_Distance(
-                        ST_PointN(ST_GeomFromText(s.geometry), 1),
-                        ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 1)
-                    )
-                    <
-                    ST_Distance(
-                        ST_PointN(ST_GeomFromText(s.geometry), 1),
-                        ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 2)
-                    )
-                THEN ST_AsText(ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 2))
-                ELSE ST_AsText(ST_PointN(ST_GeomFromText(cc.ped_edge_geom), 1))
-            END
-        FROM street_segments s
-        WHERE cc.street_segment_id = s.OBJECTID
+        SET
+            -- The vertex of ped_edge_geom closer to the street's first point is the "from"
+            from_x = CASE WHEN d.first_is_closer THEN cc.x1 ELSE cc.x2 END,
+            from_y = CASE WHEN d.first_is_closer THEN cc.y1 ELSE cc.y2 END,
+            to_x = CASE WHEN d.first_is_closer THEN cc.x2 ELSE cc.x1 END,
+            to_y = CASE WHEN d.first_is_closer THEN cc.y2 ELSE cc.y1 END
+        FROM (
+            -- Compare the squared distances from the street's first point to the two
+            -- endpoints of ped_edge_geom
+            SELECT
+                c.crosswalk_id,
+                c.street_segment_id,
+                (s.start_x - c.x1) ** 2 + (s.start_y - c.y1) ** 2
+                    < (s.start_x - c.x2) ** 2 + (s.start_y - c.y2) ** 2
+                    AS first_is_closer
+            FROM crosswalk_centers c
+            JOIN (
+                SELECT
+                    OBJECTID,
+                    ST_X(ST_PointN(geometry, 1)) AS start_x,
+                    ST_Y(ST_PointN(geometry, 1)) AS start_y
+                FROM street_segments
+            ) s ON c.street_segment_id = s.OBJECTID
+            WHERE c.is_oneway = TRUE
+        ) d
+        WHERE cc.crosswalk_id = d.crosswalk_id
+        AND cc.street_segment_id = d.street_segment_id
         AND cc.is_oneway = TRUE;
         """
     )
 
 
+@profiled
 def _identify_vehicle_direction_twoway(con: duckdb.DuckDBPyConnection):
-    """Identify the direction of the vehicle for two-way streets."""
+    """
+    Identify the direction of the vehicle for two-way streets.
+
+    `direction` is positive when the vehicle moves from the first vertex of the
+    pedestrian edge to the second, negative when it moves the other way, and zero when
+    both vertices are level along the axis that decides. It is NULL when the center
+    and the street center point coincide.
+    """
     con.execute(
         """
         -- Two-way streets
-        UPDATE crosswalk_centers
+        UPDATE crosswalk_centers cc
         SET
-            from_coord = CASE
-                WHEN is_oneway = FALSE THEN
-                    CASE
-                        WHEN ST_X(ST_GeomFromText(geometry)) > ST_X(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     < ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        WHEN ST_X(ST_GeomFromText(geometry)) < ST_X(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     > ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        WHEN ST_Y(ST_GeomFromText(geometry)) > ST_Y(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     > ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        WHEN ST_Y(ST_GeomFromText(geometry)) < ST_Y(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     < ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        ELSE 'undefined'
-                    END
-                ELSE from_coord
-            END,
-            
-            to_coord = CASE
-                WHEN is_oneway = FALSE THEN
-                    CASE
-                        WHEN ST_X(ST_GeomFromText(geometry)) > ST_X(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     > ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        WHEN ST_X(ST_GeomFromText(geometry)) < ST_X(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     < ST_Y(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        WHEN ST_Y(ST_GeomFromText(geometry)) > ST_Y(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     < ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        WHEN ST_Y(ST_GeomFromText(geometry)) < ST_Y(ST_GeomFromText(street_center_point))
-                        THEN (
-                            CASE 
-                                WHEN ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 1)) 
-                                     > ST_X(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                                THEN ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 1))
-                                ELSE ST_AsText(ST_PointN(ST_GeomFromText(ped_edge_geom), 2))
-                            END
-                        )
-                        ELSE 'undefined'
-                    END
-                ELSE to_coord
-            END;
+            from_x = CASE WHEN d.direction > 0 THEN cc.x1 WHEN d.direction <= 0 THEN cc.x2 END,
+            from_y = CASE WHEN d.direction > 0 THEN cc.y1 WHEN d.direction <= 0 THEN cc.y2 END,
+            to_x = CASE WHEN d.direction < 0 THEN cc.x1 WHEN d.direction >= 0 THEN cc.x2 END,
+            to_y = CASE WHEN d.direction < 0 THEN cc.y1 WHEN d.direction >= 0 THEN cc.y2 END
+        FROM (
+            SELECT
+                crosswalk_id,
+                center_id,
+                CASE
+                    -- East of the street center, vehicles move from the smaller Y to the
+                    -- larger Y; west of it, the reverse
+                    WHEN cx <> street_cx THEN SIGN(cx - street_cx) * (y2 - y1)
+                    -- North of the street center, vehicles move from the larger X to the
+                    -- smaller X; south of it, the reverse
+                    WHEN cy <> street_cy THEN SIGN(cy - street_cy) * (x1 - x2)
+                    ELSE NULL
+                END AS direction
+            FROM crosswalk_centers
+            WHERE is_oneway = FALSE
+        ) d
+        WHERE cc.crosswalk_id = d.crosswalk_id
+        AND cc.center_id = d.center_id
+        AND cc.is_oneway = FALSE;
         """
     )
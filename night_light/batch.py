@@ -0,0 +1,245 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from night_light.analyzer import CONTRAST_CLASSES
+from night_light.pipeline import run_pipeline, save_results
+from night_light.util_duckdb import (
+    ConnectionProfile,
+    connect_to_duckdb,
+    persist_tables,
+)
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+## Runs the pipeline for many regions at once. Regions are listed in a JSON manifest,
+## and each one is processed in a worker process with its own DuckDB file:
+##
+## {
+##     "output_dir": "output",
+##     "defaults": {"dist": 20, "threshold": 0.01, "local_crs": true},
+##     "regions": [
+##         {
+##             "name": "boston",
+##             "crosswalks": "datasets/boston_crosswalks.geojson",
+##             "streetlights": "datasets/boston_streetlights.geojson",
+##             "street_segments": "datasets/boston_street_segments.geojson",
+##             "threshold": 0.02
+##         }
+##     ]
+## }
+##
+## Relative paths are resolved against the directory of the manifest.
+
+DATASET_TABLES = ["crosswalks", "streetlights", "street_segments"]
+REGION_PARAMS = {
+    "dist": 20,
+    "threshold": 0.01,
+    "local_crs": False,
+    "contrast_engine": "sql",
+    "search_dist": None,
+    "nearest": None,
+}
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Any]:
+    """
+    Read a batch manifest and fill in the defaults of every region.
+
+    Args:
+        manifest_path: Path to the JSON manifest.
+
+    Returns:
+        The manifest, with absolute paths and every region parameter set.
+    """
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    defaults = {**REGION_PARAMS, **manifest.get("defaults", {})}
+    regions = []
+    names = set()
+    for region in manifest["regions"]:
+        missing = [key for key in ["name"] + DATASET_TABLES if key not in region]
+        if missing:
+            raise ValueError(
+                f"Region {region.get('name', len(regions))} is missing: "
+                f"{', '.join(missing)}"
+            )
+        if region["name"] in names:
+            raise ValueError(f"Region name '{region['name']}' is used twice.")
+        names.add(region["name"])
+
+        region = {**defaults, **region}
+        for table_name in DATASET_TABLES:
+            region[table_name] = os.path.normpath(
+                os.path.join(base_dir, region[table_name])
+            )
+        regions.append(region)
+
+    return {
+        "output_dir": os.path.join(base_dir, manifest.get("output_dir", "output")),
+        "regions": regions,
+    }
+
+
+def run_region(
+    region: Dict[str, Any],
+    output_dir: str,
+    profile: Optional[ConnectionProfile] = None,
+    in_memory: bool = False,
+) -> Dict[str, Any]:
+    """
+    Run the pipeline for one region and save its results.
+
+    The region gets its own database, `<output_dir>/<name>.db`, and output directory,
+    `<output_dir>/<name>/`. Errors are caught and reported in the summary, so one
+    broken region does not stop a batch.
+
+    Args:
+        region: A region of the manifest, see `load_manifest`.
+        output_dir: Directory of the databases and outputs of every region.
+        profile: Settings of the region's connection. A temp directory gets a
+            subdirectory per region, so regions running at once do not share spill
+            files. Default is DuckDB's defaults.
+        in_memory: Run the pipeline in an in-memory database and copy its tables to
+            the region's database only at the end. Every stage then runs, even if
+            the database is up to date.
+
+    Returns:
+        Summary of the run: status, duration, row counts and the number of
+        crosswalk centers of every contrast class.
+    """
+    start = time.time()
+    summary = {"region": region["name"], "status": "ok"}
+    con = None
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        db_path = os.path.join(output_dir, f"{region['name']}.db")
+        profile = profile or ConnectionProfile()
+        if profile.temp_directory is not None:
+            profile = replace(
+                profile,
+                temp_directory=os.path.join(profile.temp_directory, region["name"]),
+            )
+        con = connect_to_duckdb(":memory:" if in_memory else db_path, profile)
+
+        datasets = [(region[table_name], table_name) for table_name in DATASET_TABLES]
+        summary["stages_run"] = len(
+            run_pipeline(
+                con,
+                datasets,
+                dist=region["dist"],
+                threshold=region["threshold"],
+                local_crs=region["local_crs"],
+                contrast_engine=region["contrast_engine"],
+                search_dist=region["search_dist"],
+                nearest=region["nearest"],
+            )
+        )
+        save_results(con, os.path.join(output_dir, region["name"]))
+        if in_memory:
+            persist_tables(con, db_path)
+
+        for table_name in ["crosswalks", "streetlights", "crosswalk_centers_contrast"]:
+            summary[table_name] = con.execute(
+                f"SELECT COUNT(*) FROM {table_name}"
+            ).fetchone()[0]
+        counts = dict(
+            con.execute(
+                """
+                SELECT contrast_heuristic, COUNT(*)
+                FROM crosswalk_centers_contrast
+                GROUP BY contrast_heuristic
+                """
+            ).fetchall()
+        )
+        for contrast_class in CONTRAST_CLASSES:
+            summary[contrast_class] = counts.get(contrast_class, 0)
+    except Exception as error:
+        summary["status"] = "failed"
+        summary["error"] = f"{type(error).__name__}: {error}"
+    finally:
+        if con is not None:
+            con.close()
+    summary["seconds"] = round(time.time() - start, 2)
+    return summary
+
+
+def run_batch(
+    manifest_path: str,
+    max_workers: Optional[int] = None,
+    profile: ConnectionProfile = ConnectionProfile(threads=1),
+    in_memory: bool = False,
+) -> "DataFrame":
+    """
+    Run the pipeline for every region of a manifest in a pool of worker processes.
+
+    A combined summary with one row per region is written to
+    `<output_dir>/summary.csv`.
+
+    Args:
+        manifest_path: Path to the JSON manifest.
+        max_workers: Number of regions processed at once. Default is the number of
+            CPUs.
+        profile: Settings of each region's connection. Set a memory limit so that
+            `max_workers` regions fit in memory at once. Default is 1 thread.
+        in_memory: Run every region in an in-memory database, see `run_region`.
+
+    Returns:
+        DataFrame: The combined summary.
+    """
+    manifest = load_manifest(manifest_path)
+    output_dir = manifest["output_dir"]
+    regions = manifest["regions"]
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+        summaries: List[Dict[str, Any]] = list(
+            executor.map(
+                run_region,
+                regions,
+                [output_dir] * len(regions),
+                [profile] * len(regions),
+                [in_memory] * len(regions),
+            )
+        )
+
+    from pandas import DataFrame
+
+    summary = DataFrame(summaries).convert_dtypes()
+    os.makedirs(output_dir, exist_ok=True)
+    summary.to_csv(os.path.join(output_dir, "summary.csv"), index=False)
+    return summary
+
+
+if __name__ == "__main__":
+    from night_light.cli import add_profile_arguments, profile_from_args
+
+    parser = argparse.ArgumentParser(
+        description="Run the night-light pipeline for every region of a manifest."
+    )
+    parser.add_argument("manifest", help="path to the JSON manifest")
+    parser.add_argument("--workers", type=int, help="regions processed at once")
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="run in memory and write each region's database at the end",
+    )
+    add_profile_arguments(parser)
+    # Every region gets one thread unless told otherwise, as regions run in parallel
+    parser.set_defaults(threads=1)
+    args = parser.parse_args()
+
+    result = run_batch(
+        args.manifest, args.workers, profile_from_args(args), args.in_memory
+    )
+    print(result.to_string(index=False))
+    if (result["status"] != "ok").any():
+        raise SystemExit(1)
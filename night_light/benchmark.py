@@ -0,0 +1,484 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import duckdb
+import numpy as np
+
+from night_light.analyzer import (
+    calculate_contrast_heuristics,
+    calculate_percieved_brightness,
+    classify_edges_by_intersection,
+    classify_lights_by_side,
+    create_crosswalk_centers_lights,
+    decompose_crosswalk_edges,
+    find_crosswalk_centers,
+    find_streetlights_crosswalk_centers,
+    identify_vehicle_direction,
+    label_contrast,
+    simplify_crosswalk_polygon_to_box,
+)
+from night_light.pipeline import CONTRAST_ENGINES
+from night_light.profiling import PeakMemory
+from night_light.synthetic import generate_city, write_city
+from night_light.util_duckdb import (
+    connect_to_duckdb,
+    load_multiple_datasets,
+    project_to_local_crs,
+)
+
+## Measures how the analyzer scales. Synthetic cities of increasing size are run
+## through every analyzer step, and the wall time, peak memory and output row count of
+## each step are written to a JSON report, along with how fast each step grows with the
+## number of crosswalks. The report also records how long a fresh interpreter takes to
+## import the package and to start the `night-light` command.
+
+DATASET_TABLES = ["crosswalks", "streetlights", "street_segments"]
+
+# (name, function, output table) of every analyzer step, in order. Functions are
+# called with the connection, the search distance and the contrast threshold.
+BENCHMARK_STAGES: List[Tuple[str, Callable, str]] = [
+    (
+        "simplify_crosswalk_polygon_to_box",
+        lambda con, dist, threshold: simplify_crosswalk_polygon_to_box(con),
+        "crosswalks",
+    ),
+    (
+        "decompose_crosswalk_edges",
+        lambda con, dist, threshold: decompose_crosswalk_edges(con),
+        "crosswalk_segments",
+    ),
+    (
+        "classify_edges_by_intersection",
+        lambda con, dist, threshold: classify_edges_by_intersection(con),
+        "crosswalk_segments",
+    ),
+    (
+        "find_crosswalk_centers",
+        lambda con, dist, threshold: find_crosswalk_centers(con),
+        "crosswalk_centers",
+    ),
+    (
+        "identify_vehicle_direction",
+        lambda con, dist, threshold: identify_vehicle_direction(con),
+        "crosswalk_centers",
+    ),
+    (
+        "create_crosswalk_centers_lights",
+        lambda con, dist, threshold: create_crosswalk_centers_lights(con),
+        "crosswalk_centers_lights",
+    ),
+    (
+        "find_streetlights_crosswalk_centers",
+        lambda con, dist, threshold: find_streetlights_crosswalk_centers(con, dist),
+        "crosswalk_centers_lights",
+    ),
+    (
+        "classify_lights_by_side",
+        lambda con, dist, threshold: classify_lights_by_side(con),
+        "classified_streetlights",
+    ),
+    (
+        "calculate_contrast_heuristics",
+        lambda con, dist, threshold: calculate_contrast_heuristics(con, threshold),
+        "crosswalk_centers_contrast",
+    ),
+    (
+        "calculate_percieved_brightness",
+        lambda con, dist, threshold: calculate_percieved_brightness(con),
+        "crosswalk_centers_contrast",
+    ),
+]
+
+
+def _count_rows(con: duckdb.DuckDBPyConnection, table_name: str) -> int:
+    """Count the rows of a table."""
+    return con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+
+
+def benchmark_stages(
+    con: duckdb.DuckDBPyConnection, dist: float = 20, threshold: float = 0.01
+) -> List[Dict[str, Any]]:
+    """
+    Run every analyzer step on loaded tables and measure it.
+
+    Args:
+        con: Connection to a DuckDB database with the crosswalks, streetlights and
+            street_segments tables.
+        dist: Meters to search for streetlights near each crosswalk center.
+        threshold: Threshold of the contrast heuristic classification.
+
+    Returns:
+        One record per step: name, wall time in seconds, peak resident memory of the
+        process in MB, and row count of the step's output table.
+    """
+    records = []
+    for name, stage, output_table in BENCHMARK_STAGES:
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            stage(con, dist, threshold)
+            seconds = time.perf_counter() - start
+        records.append(
+            {
+                "name": name,
+                "seconds": round(seconds, 4),
+                "peak_memory_mb": round(memory.peak / 2**20, 1),
+                "rows": _count_rows(con, output_table),
+            }
+        )
+    return records
+
+
+# Columns compared between the contrast engines, with floats rounded to 1e-9
+CONTRAST_PARITY_COLUMNS = {
+    "classified_streetlights": """
+        crosswalk_id, center_id, streetlight_id, side, dist,
+        ST_AsText(line_geom), ST_AsText(geometry), ST_AsText(a_to_b),
+        ROUND(angle_rad, 9), ROUND(abs_sin_angle, 9)
+    """,
+    "crosswalk_centers_heuristics": """
+        crosswalk_id, center_id,
+        ROUND(to_contrast_heuristic, 9), ROUND(from_contrast_heuristic, 9),
+        ROUND(to_brightness_heuristic, 9), ROUND(from_brightness_heuristic, 9)
+    """,
+    "crosswalk_centers_contrast": """
+        crosswalk_id, center_id, contrast_heuristic,
+        ROUND(to_contrast_heuristic, 9), ROUND(from_contrast_heuristic, 9),
+        ROUND(to_brightness_heuristic, 9), ROUND(from_brightness_heuristic, 9)
+    """,
+}
+
+
+def compare_contrast_engines(
+    con: duckdb.DuckDBPyConnection, threshold: float = 0.01
+) -> Dict[str, Any]:
+    """
+    Run every contrast engine on the same tables and compare their outputs.
+
+    The first engine of `CONTRAST_ENGINES` is the reference. Rows are compared as
+    multisets, so a table matches when the other engine produced exactly the same
+    rows, in any order.
+
+    Args:
+        con: Connection to a DuckDB database on which the lights stage has run.
+        threshold: Threshold of the contrast heuristic classification.
+
+    Returns:
+        Wall time in seconds of every engine, and for every other engine the number
+        of rows of each table that differ from the reference.
+    """
+    seconds = {}
+    mismatches = {}
+    reference = None
+    for engine, classify_and_sum in CONTRAST_ENGINES.items():
+        start = time.perf_counter()
+        classify_and_sum(con)
+        seconds[engine] = round(time.perf_counter() - start, 4)
+        label_contrast(con, threshold)
+
+        if reference is None:
+            reference = engine
+            for table_name in CONTRAST_PARITY_COLUMNS:
+                con.execute(
+                    f"""
+                    CREATE OR REPLACE TEMP TABLE {reference}_{table_name} AS
+                    SELECT * FROM {table_name}
+                    """
+                )
+            continue
+
+        mismatches[engine] = {}
+        for table_name, columns in CONTRAST_PARITY_COLUMNS.items():
+            expected = f"SELECT {columns} FROM {reference}_{table_name}"
+            actual = f"SELECT {columns} FROM {table_name}"
+            mismatches[engine][table_name] = con.execute(
+                f"""
+                SELECT COUNT(*) FROM (
+                    ({expected} EXCEPT ALL {actual})
+                    UNION ALL
+                    ({actual} EXCEPT ALL {expected})
+                )
+                """
+            ).fetchone()[0]
+
+    for table_name in CONTRAST_PARITY_COLUMNS:
+        con.execute(f"DROP TABLE IF EXISTS {reference}_{table_name}")
+    return {"reference": reference, "seconds": seconds, "mismatches": mismatches}
+
+
+def benchmark_city(
+    num_crosswalks: int,
+    work_dir: str,
+    dist: float = 20,
+    threshold: float = 0.01,
+    local_crs: bool = True,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """
+    Generate a synthetic city and benchmark the analyzer on it.
+
+    Args:
+        num_crosswalks: Approximate number of crosswalks of the city.
+        work_dir: Directory of the generated GeoParquet files.
+        dist: Meters to search for streetlights near each crosswalk center.
+        threshold: Threshold of the contrast heuristic classification.
+        local_crs: Whether to project the city to its UTM zone before the steps run.
+        seed: Seed of the city generator.
+
+    Returns:
+        Record of the run: input row counts, the load time, the records of every
+        step, see `benchmark_stages`, and the comparison of the contrast engines, see
+        `compare_contrast_engines`.
+    """
+    paths = write_city(
+        generate_city(num_crosswalks, seed=seed),
+        os.path.join(work_dir, f"city_{num_crosswalks}"),
+    )
+    con = connect_to_duckdb(":memory:")
+    con.execute("SET enable_progress_bar = false")
+
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        load_multiple_datasets(
+            con, [(paths[table_name], table_name) for table_name in DATASET_TABLES]
+        )
+        if local_crs:
+            project_to_local_crs(con, DATASET_TABLES)
+        load_seconds = time.perf_counter() - start
+
+    inputs = {table_name: _count_rows(con, table_name) for table_name in DATASET_TABLES}
+    stages = [
+        {
+            "name": "load_datasets",
+            "seconds": round(load_seconds, 4),
+            "peak_memory_mb": round(memory.peak / 2**20, 1),
+            "rows": sum(inputs.values()),
+        }
+    ] + benchmark_stages(con, dist, threshold)
+    contrast_engines = compare_contrast_engines(con, threshold)
+    con.close()
+
+    return {
+        "num_crosswalks": inputs["crosswalks"],
+        "inputs": inputs,
+        "local_crs": local_crs,
+        "total_seconds": round(sum(stage["seconds"] for stage in stages), 4),
+        "stages": stages,
+        "contrast_engines": contrast_engines,
+    }
+
+
+# Modules whose import time is measured, from DuckDB alone to the full pipeline
+STARTUP_MODULES = [
+    "duckdb",
+    "night_light.util_duckdb",
+    "night_light.cli",
+    "night_light.analyzer",
+    "night_light.pipeline",
+]
+
+# Dependencies that commands running only SQL should not import
+HEAVY_MODULES = ["pandas", "geopandas", "shapely", "pyarrow"]
+
+
+def _run_python(args: List[str]) -> subprocess.CompletedProcess:
+    """Run a fresh interpreter that can import the package."""
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package_root, env.get("PYTHONPATH")])
+    )
+    return subprocess.run(
+        [sys.executable, *args], env=env, capture_output=True, text=True, check=True
+    )
+
+
+def measure_startup(repeat: int = 3) -> Dict[str, Any]:
+    """
+    Measure the import time of the package and the startup time of the command.
+
+    Every measurement runs in a new interpreter, so no module is imported yet, and
+    the fastest of `repeat` runs is kept.
+
+    Args:
+        repeat: Number of runs of every measurement.
+
+    Returns:
+        Seconds to import every module of `STARTUP_MODULES`, as reported by
+        `python -X importtime`, the wall time in seconds of `night-light --help`, and
+        the modules of `HEAVY_MODULES` that importing the command loads.
+    """
+    import_seconds = {}
+    for module in STARTUP_MODULES:
+        runs = []
+        for _ in range(repeat):
+            lines = _run_python(["-X", "importtime", "-c", f"import {module}"]).stderr
+            # Lines read "import time: self [us] | cumulative | module", and the
+            # module itself is the last one to finish importing
+            cumulative = [
+                int(line.split("|")[1])
+                for line in lines.splitlines()
+                if line.startswith("import time:")
+                and line.split("|")[2].strip() == module
+            ]
+            runs.append(cumulative[-1] / 1e6)
+        import_seconds[module] = round(min(runs), 4)
+
+    help_seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _run_python(["-m", "night_light.cli", "--help"])
+        help_seconds.append(time.perf_counter() - start)
+
+    loaded = _run_python(
+        [
+            "-c",
+            "import sys, night_light.cli; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+        ]
+    ).stdout.strip()
+    return {
+        "import_seconds": import_seconds,
+        "cli_help_seconds": round(min(help_seconds), 4),
+        "cli_heavy_modules": loaded.split(",") if loaded else [],
+    }
+
+
+def scaling_exponents(runs: List[Dict[str, Any]]) -> Dict[str, Optional[float]]:
+    """
+    Estimate how fast the wall time of every step grows with the number of crosswalks.
+
+    The exponent is the slope of a least-squares fit of log(time) against
+    log(crosswalks): about 1 for a step that scales linearly and 2 for one that
+    scales quadratically.
+
+    Args:
+        runs: Records of `benchmark_city` runs with different sizes.
+
+    Returns:
+        Dict[str, Optional[float]]: Exponent of every step, or None with fewer than
+            two sizes.
+    """
+    sizes = np.log([run["num_crosswalks"] for run in runs])
+    exponents = {}
+    for index, stage in enumerate(runs[0]["stages"]):
+        # Floor the times so steps that take no measurable time do not break the log
+        seconds = np.log([max(run["stages"][index]["seconds"], 1e-4) for run in runs])
+        if len(set(sizes)) < 2:
+            exponents[stage["name"]] = None
+        else:
+            exponents[stage["name"]] = round(float(np.polyfit(sizes, seconds, 1)[0]), 2)
+    return exponents
+
+
+def run_benchmarks(
+    sizes: List[int] = (1000, 10000, 100000),
+    dist: float = 20,
+    threshold: float = 0.01,
+    local_crs: bool = True,
+    output: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Benchmark the analyzer on synthetic cities of increasing size.
+
+    Args:
+        sizes: Approximate numbers of crosswalks of the cities.
+        dist: Meters to search for streetlights near each crosswalk center.
+        threshold: Threshold of the contrast heuristic classification.
+        local_crs: Whether to project the cities to their UTM zone before the steps
+            run. Set to False to benchmark the EPSG:4326 code paths.
+        output: Path of the JSON report. Default is to not write a file.
+
+    Returns:
+        The report: environment, the record of every city, and the scaling exponent
+        of every step.
+    """
+    with tempfile.TemporaryDirectory(prefix="night_light_benchmark_") as work_dir:
+        runs = []
+        for num_crosswalks in sizes:
+            print(f"Benchmarking a city with about {num_crosswalks} crosswalks...")
+            runs.append(
+                benchmark_city(num_crosswalks, work_dir, dist, threshold, local_crs)
+            )
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "duckdb_version": duckdb.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "dist": dist,
+        "threshold": threshold,
+        "startup": measure_startup(),
+        "runs": runs,
+        "scaling_exponents": scaling_exponents(runs),
+    }
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    """
+    Print the largest city of a report of `run_benchmarks`, and the startup times.
+
+    Args:
+        report: The report.
+    """
+    largest = report["runs"][-1]
+    print(f"{'step':40s} {'seconds':>10s} {'exponent':>10s}")
+    for stage in largest["stages"]:
+        exponent = report["scaling_exponents"][stage["name"]]
+        print(f"{stage['name']:40s} {stage['seconds']:10.3f} {str(exponent):>10s}")
+    engines = largest["contrast_engines"]
+    for engine, seconds in engines["seconds"].items():
+        print(f"{'contrast engine ' + engine:40s} {seconds:10.3f}")
+    for engine, tables in engines["mismatches"].items():
+        for table_name, count in tables.items():
+            print(f"{engine} rows differing from {engines['reference']} in {table_name}: {count}")
+    startup = report["startup"]
+    for module, seconds in startup["import_seconds"].items():
+        print(f"{'import ' + module:40s} {seconds:10.3f}")
+    print(f"{'night-light --help':40s} {startup['cli_help_seconds']:10.3f}")
+    if startup["cli_heavy_modules"]:
+        print(f"night-light imports {', '.join(startup['cli_heavy_modules'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the night-light analyzer on synthetic cities."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="approximate numbers of crosswalks of the cities",
+    )
+    parser.add_argument("--dist", type=float, default=20, help="search distance")
+    parser.add_argument(
+        "--threshold", type=float, default=0.01, help="contrast threshold"
+    )
+    parser.add_argument(
+        "--geographic",
+        action="store_true",
+        help="run the steps on EPSG:4326 coordinates instead of the UTM zone",
+    )
+    parser.add_argument(
+        "--output", default="benchmark.json", help="path of the JSON report"
+    )
+    args = parser.parse_args()
+
+    result = run_benchmarks(
+        args.sizes, args.dist, args.threshold, not args.geographic, args.output
+    )
+    print_report(result)
+    print(f"Report written to {args.output}")
@@ -0,0 +1,334 @@
+import argparse
+import os
+import sys
+from typing import List, Optional
+
+from night_light.util_duckdb import ConnectionProfile
+
+## The `night-light` command. Every subcommand imports the modules it needs when it
+## runs, so `night-light query`, `export`, `tiles` and `serve` never load the analyzer
+## or geopandas. Short scheduled invocations then start in a fraction of a second.
+
+# Keys of `night_light.pipeline.CONTRAST_ENGINES`, listed here so that parsing the
+# arguments does not import the analyzer
+CONTRAST_ENGINE_NAMES = ["sql", "numpy"]
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the options of a `ConnectionProfile` to a parser.
+
+    Args:
+        parser: Parser of a command that opens DuckDB connections.
+    """
+    group = parser.add_argument_group("connection")
+    group.add_argument("--threads", type=int, help="DuckDB threads")
+    group.add_argument("--memory-limit", help='DuckDB memory limit, e.g. "4GB"')
+    group.add_argument(
+        "--temp-directory", help="directory DuckDB spills to beyond the memory limit"
+    )
+    group.add_argument(
+        "--no-insertion-order",
+        action="store_true",
+        help="let DuckDB reorder rows to use less memory",
+    )
+    group.add_argument(
+        "--extension-directory", help="directory of the DuckDB spatial extension"
+    )
+    group.add_argument(
+        "--offline",
+        action="store_true",
+        help="never download the spatial extension",
+    )
+
+
+def profile_from_args(
+    args: argparse.Namespace, read_only: bool = False
+) -> ConnectionProfile:
+    """
+    Build the connection profile of parsed `add_profile_arguments` options.
+
+    Args:
+        args: Parsed arguments.
+        read_only: Whether to open the database read-only.
+
+    Returns:
+        ConnectionProfile: Profile of the options.
+    """
+    return ConnectionProfile(
+        threads=args.threads,
+        memory_limit=args.memory_limit,
+        temp_directory=args.temp_directory,
+        preserve_insertion_order=False if args.no_insertion_order else None,
+        extension_directory=args.extension_directory,
+        offline=args.offline,
+        read_only=read_only,
+    )
+
+
+def _run(args: argparse.Namespace):
+    """Run the pipeline on three datasets."""
+    from night_light.pipeline import run_pipeline
+    from night_light.util_duckdb import connect_to_duckdb, persist_tables, save_results
+
+    in_memory = args.in_memory and args.db != ":memory:"
+    con = connect_to_duckdb(
+        ":memory:" if in_memory else args.db, profile_from_args(args)
+    )
+    stages_run = run_pipeline(
+        con,
+        [
+            (args.crosswalks, "crosswalks"),
+            (args.streetlights, "streetlights"),
+            (args.street_segments, "street_segments"),
+        ],
+        dist=args.dist,
+        threshold=args.threshold,
+        local_crs=args.local_crs,
+        contrast_engine=args.engine,
+        search_dist=args.search_dist,
+        nearest=args.nearest,
+        force=args.force,
+    )
+    print(f"Stages run: {', '.join(stages_run) or 'none, the results are current'}")
+    if args.output is not None:
+        save_results(con, args.output)
+    if in_memory:
+        persist_tables(con, args.db)
+    con.close()
+
+
+def _export(args: argparse.Namespace):
+    """Save result tables of a database to files."""
+    from night_light.util_duckdb import connect_to_duckdb, save_results, save_tables
+
+    con = connect_to_duckdb(args.db, profile_from_args(args, read_only=True))
+    if args.tables:
+        os.makedirs(args.output, exist_ok=True)
+        save_tables(
+            con,
+            [
+                (table_name, os.path.join(args.output, f"{table_name}.{args.format}"))
+                for table_name in args.tables
+            ],
+            spatial_sort=args.spatial_sort,
+        )
+    else:
+        save_results(con, args.output, spatial_sort=args.spatial_sort)
+    con.close()
+
+
+def _bench(args: argparse.Namespace):
+    """Benchmark the analyzer on synthetic cities."""
+    from night_light.benchmark import print_report, run_benchmarks
+
+    report = run_benchmarks(
+        args.sizes, args.dist, args.threshold, not args.geographic, args.output
+    )
+    print_report(report)
+    print(f"Report written to {args.output}")
+
+
+def _query(args: argparse.Namespace):
+    """Run a SQL query against a database and print the result."""
+    from night_light.util_duckdb import connect_to_duckdb
+
+    con = connect_to_duckdb(args.db, profile_from_args(args, read_only=True))
+    result = con.sql(args.sql)
+    # Statements without a result, e.g. SET, return None
+    if result is not None:
+        result.show(max_rows=args.max_rows)
+    con.close()
+
+
+def _tiles(args: argparse.Namespace):
+    """Export the results of a database as vector tiles."""
+    from night_light.util_duckdb import connect_to_duckdb
+    from night_light.vector_tiles import export_vector_tiles
+
+    con = connect_to_duckdb(args.db, profile_from_args(args, read_only=True))
+    num_tiles = export_vector_tiles(
+        con, args.output, args.min_zoom, args.max_zoom, args.workers
+    )
+    print(f"{num_tiles} tiles written to {args.output}")
+    con.close()
+
+
+def _serve(args: argparse.Namespace):
+    """Serve the results of a database over HTTP."""
+    from night_light.service import serve
+
+    serve(
+        args.db,
+        args.host,
+        args.port,
+        args.pool_size,
+        args.cache_size,
+        profile_from_args(args),
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Build the parser of the `night-light` command and its subcommands.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(
+        prog="night-light",
+        description="Analyze the streetlight contrast at crosswalks.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run the pipeline on three datasets")
+    run.add_argument("--crosswalks", required=True, help="crosswalks dataset")
+    run.add_argument("--streetlights", required=True, help="streetlights dataset")
+    run.add_argument("--street-segments", required=True, help="street segments dataset")
+    run.add_argument(
+        "--db",
+        default=":memory:",
+        help="DuckDB database of the run; stages that are current are skipped",
+    )
+    run.add_argument("--output", help="directory to save the results to")
+    run.add_argument("--dist", type=float, default=20, help="search distance")
+    run.add_argument("--threshold", type=float, default=0.01, help="contrast threshold")
+    run.add_argument(
+        "--local-crs",
+        action="store_true",
+        help="project the datasets to their UTM zone",
+    )
+    run.add_argument(
+        "--engine", choices=CONTRAST_ENGINE_NAMES, default="sql", help="contrast engine"
+    )
+    run.add_argument(
+        "--search-dist",
+        type=float,
+        help="search distance of the stored search, at least --dist",
+    )
+    run.add_argument(
+        "--nearest", type=int, help="only keep the nearest streetlights of a center"
+    )
+    run.add_argument("--force", action="store_true", help="run every stage")
+    run.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="run in memory and write the tables to --db at the end",
+    )
+    run.add_argument("--profile", help="write a Chrome trace of the run to this file")
+    add_profile_arguments(run)
+    run.set_defaults(handler=_run)
+
+    export = subparsers.add_parser(
+        "export", help="save the result tables of a database to files"
+    )
+    export.add_argument("db", help="DuckDB database of a run")
+    export.add_argument("output", help="directory of the output files")
+    export.add_argument(
+        "--tables",
+        nargs="+",
+        help="tables to save; default is the results of `save_results`",
+    )
+    export.add_argument(
+        "--format",
+        choices=["parquet", "csv", "geojson"],
+        default="parquet",
+        help="file format of --tables",
+    )
+    export.add_argument(
+        "--spatial-sort",
+        action="store_true",
+        help="sort parquet rows along a Hilbert curve and add a bbox column",
+    )
+    add_profile_arguments(export)
+    export.set_defaults(handler=_export)
+
+    bench = subparsers.add_parser(
+        "bench", help="benchmark the analyzer on synthetic cities"
+    )
+    bench.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="approximate numbers of crosswalks of the cities",
+    )
+    bench.add_argument("--dist", type=float, default=20, help="search distance")
+    bench.add_argument(
+        "--threshold", type=float, default=0.01, help="contrast threshold"
+    )
+    bench.add_argument(
+        "--geographic",
+        action="store_true",
+        help="run the steps on EPSG:4326 coordinates instead of the UTM zone",
+    )
+    bench.add_argument(
+        "--output", default="benchmark.json", help="path of the JSON report"
+    )
+    bench.add_argument(
+        "--profile", help="write a Chrome trace of the benchmark to this file"
+    )
+    bench.set_defaults(handler=_bench)
+
+    query = subparsers.add_parser("query", help="run a SQL query against a database")
+    query.add_argument("db", help="DuckDB database, opened read-only")
+    query.add_argument("sql", help="SQL query")
+    query.add_argument("--max-rows", type=int, default=40, help="rows to print at most")
+    add_profile_arguments(query)
+    query.set_defaults(handler=_query)
+
+    tiles = subparsers.add_parser(
+        "tiles", help="export the results of a database as vector tiles"
+    )
+    tiles.add_argument("db", help="DuckDB database of a run, opened read-only")
+    tiles.add_argument(
+        "output", help="MBTiles file if it ends with .mbtiles, else a directory"
+    )
+    tiles.add_argument("--min-zoom", type=int, default=10, help="lowest zoom level")
+    tiles.add_argument("--max-zoom", type=int, default=16, help="deepest zoom level")
+    tiles.add_argument("--workers", type=int, help="worker processes; default is CPUs")
+    add_profile_arguments(tiles)
+    tiles.set_defaults(handler=_tiles)
+
+    serve = subparsers.add_parser(
+        "serve", help="serve the results of a database over HTTP as GeoJSON"
+    )
+    serve.add_argument("db", help="DuckDB database of a run, opened read-only")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    serve.add_argument("--port", type=int, default=8000, help="port to listen on")
+    serve.add_argument(
+        "--pool-size", type=int, default=4, help="connections to the database"
+    )
+    serve.add_argument(
+        "--cache-size", type=int, default=1024, help="responses cached per route"
+    )
+    add_profile_arguments(serve)
+    serve.set_defaults(handler=_serve)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Run the `night-light` command.
+
+    Args:
+        argv: Arguments of the command. Default is `sys.argv[1:]`.
+
+    Returns:
+        int: Exit status of the command.
+    """
+    args = build_parser().parse_args(argv)
+    if getattr(args, "profile", None) is None:
+        args.handler(args)
+    else:
+        from night_light.profiling import profile_run
+
+        with profile_run(args.profile):
+            args.handler(args)
+        print(f"Trace written to {args.profile}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+from typing import TYPE_CHECKING, List, Optional, Union
+
+import duckdb
+
+from night_light.analyzer import (
+    calculate_contrast,
+    calculate_percieved_brightness,
+    classify_edges_by_intersection,
+    create_crosswalk_centers_lights,
+    decompose_crosswalk_edges,
+    find_crosswalk_centers,
+    find_streetlights_crosswalk_centers,
+    identify_vehicle_direction,
+    meters_to_degrees,
+)
+from night_light.util_duckdb import (
+    get_local_crs,
+    load_data_to_table,
+    project_to_local_crs,
+)
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
+
+## Patches the results of a pipeline run with edits to the streetlights or street
+## segments datasets. Only the crosswalks near the edited features are recomputed: they
+## are copied into a scratch in-memory database, run through the analyzer steps there,
+## and their rows in the result tables are replaced. The streetlight_search table of
+## the run may cover a larger distance than `dist`, so it is dropped rather than
+## patched, and the next pipeline run searches again.
+
+SCRATCH_DATABASE = "night_light_delta"
+
+LIGHT_TABLES = [
+    "crosswalk_centers_lights",
+    "classified_streetlights",
+    "crosswalk_centers_heuristics",
+    "crosswalk_centers_contrast",
+]
+STREET_TABLES = ["crosswalk_segments", "crosswalk_centers"] + LIGHT_TABLES
+
+
+def apply_streetlight_delta(
+    con: duckdb.DuckDBPyConnection,
+    upserts: Optional[Union[str, "GeoDataFrame"]] = None,
+    deleted_ids: Optional[List[int]] = None,
+    dist: float = 20,
+    threshold: float = 0.01,
+) -> List[int]:
+    """
+    Apply inserted, moved and deleted streetlights to the results of a pipeline run.
+
+    The `streetlights` table is updated, and the rows of `crosswalk_centers_lights`,
+    `classified_streetlights`, `crosswalk_centers_heuristics` and
+    `crosswalk_centers_contrast` are recomputed for the
+    crosswalks with a center within `dist` meters of an old or new streetlight
+    position. Every other row is left untouched.
+
+    Args:
+        con: Connection to the DuckDB database of a finished pipeline run.
+        upserts: Path to a spatial file or a GeoDataFrame of streetlights in
+            EPSG:4326. Streetlights whose OBJECTID is already in the table are moved,
+            the others are inserted.
+        deleted_ids: OBJECTIDs of the streetlights to delete.
+        dist: Meters to search for streetlights near each crosswalk center. Must match
+            the distance of the pipeline run.
+        threshold: Threshold of the contrast heuristic classification. Must match the
+            threshold of the pipeline run.
+
+    Returns:
+        IDs of the recomputed crosswalks.
+    """
+    database = _attach_scratch_database(con)
+    try:
+        _load_delta(con, database, "streetlights", upserts, deleted_ids)
+        margin = _search_margin(con, database, dist)
+
+        # Crosswalks with a center near the old or new position of a changed light
+        con.execute(
+            f"""
+            CREATE TABLE affected_crosswalks AS
+            WITH changed AS (
+                SELECT geometry FROM delta_upserts
+                UNION ALL
+                SELECT s.geometry
+                FROM {database}.streetlights s
+                JOIN delta_ids d USING (OBJECTID)
+            )
+            SELECT DISTINCT c.crosswalk_id
+            FROM {database}.crosswalk_centers c
+            JOIN changed ch
+                -- The envelope test lets DuckDB plan a range join on the extents
+                ON ST_Intersects(
+                    c.geometry,
+                    ST_MakeEnvelope(
+                        ST_XMin(ch.geometry) - $margin,
+                        ST_YMin(ch.geometry) - $margin,
+                        ST_XMax(ch.geometry) + $margin,
+                        ST_YMax(ch.geometry) + $margin
+                    )
+                )
+                AND ST_DWithin(c.geometry, ch.geometry, $margin)
+            """,
+            {"margin": margin},
+        )
+        con.execute(
+            f"""
+            CREATE TABLE crosswalk_centers AS
+            SELECT * FROM {database}.crosswalk_centers
+            WHERE crosswalk_id IN (SELECT crosswalk_id FROM affected_crosswalks)
+            """
+        )
+        _copy_nearby_streetlights(con, database, margin, updated=True)
+        _recompute_lights(con, dist, threshold)
+        return _replace_rows(con, database, "streetlights", LIGHT_TABLES)
+    finally:
+        _detach_scratch_database(con, database)
+
+
+def apply_street_segment_delta(
+    con: duckdb.DuckDBPyConnection,
+    upserts: Optional[Union[str, "GeoDataFrame"]] = None,
+    deleted_ids: Optional[List[int]] = None,
+    dist: float = 20,
+    threshold: float = 0.01,
+) -> List[int]:
+    """
+    Apply inserted, edited and deleted street segments to the results of a pipeline run.
+
+    The `street_segments` table is updated, and the crosswalks that intersect an old or
+    new street geometry are run through every step from the edge classification on.
+    Their rows of `crosswalk_segments`, `crosswalk_centers` and the streetlight and
+    contrast tables are replaced.
+
+    Args:
+        con: Connection to the DuckDB database of a finished pipeline run.
+        upserts: Path to a spatial file or a GeoDataFrame of street segments in
+            EPSG:4326. Segments whose OBJECTID is already in the table are replaced,
+            the others are inserted.
+        deleted_ids: OBJECTIDs of the street segments to delete.
+        dist: Meters to search for streetlights near each crosswalk center. Must match
+            the distance of the pipeline run.
+        threshold: Threshold of the contrast heuristic classification. Must match the
+            threshold of the pipeline run.
+
+    Returns:
+        IDs of the recomputed crosswalks.
+    """
+    database = _attach_scratch_database(con)
+    try:
+        _load_delta(con, database, "street_segments", upserts, deleted_ids)
+        margin = _search_margin(con, database, dist)
+
+        # Crosswalks crossed by the old or new geometry of a changed street
+        con.execute(
+            f"""
+            CREATE TABLE affected_crosswalks AS
+            WITH changed AS (
+                SELECT geometry FROM delta_upserts
+                UNION ALL
+                SELECT s.geometry
+                FROM {database}.street_segments s
+                JOIN delta_ids d USING (OBJECTID)
+            )
+            SELECT DISTINCT cw.OBJECTID AS crosswalk_id
+            FROM {database}.crosswalks cw
+            JOIN changed ch ON ST_Intersects(cw.geometry, ch.geometry)
+            """
+        )
+        con.execute(
+            f"""
+            CREATE TABLE crosswalks AS
+            SELECT * FROM {database}.crosswalks
+            WHERE OBJECTID IN (SELECT crosswalk_id FROM affected_crosswalks);
+
+            CREATE TABLE street_segments AS
+            WITH updated AS {_updated_rows(database, "street_segments")}
+            SELECT s.*
+            FROM updated s
+            SEMI JOIN crosswalks cw ON ST_Intersects(cw.geometry, s.geometry);
+            """
+        )
+        decompose_crosswalk_edges(con)
+        classify_edges_by_intersection(con)
+        find_crosswalk_centers(con)
+        identify_vehicle_direction(con)
+        _copy_nearby_streetlights(con, database, margin)
+        _recompute_lights(con, dist, threshold)
+        return _replace_rows(con, database, "street_segments", STREET_TABLES)
+    finally:
+        _detach_scratch_database(con, database)
+
+
+def _attach_scratch_database(con: duckdb.DuckDBPyConnection) -> str:
+    """Attach an in-memory database, make it the default, and return the old one."""
+    database = con.execute("SELECT current_database()").fetchone()[0]
+    con.execute(f"ATTACH ':memory:' AS {SCRATCH_DATABASE}")
+    con.execute(f"USE {SCRATCH_DATABASE}")
+    return database
+
+
+def _detach_scratch_database(con: duckdb.DuckDBPyConnection, database: str):
+    """Switch back to the pipeline database and drop the scratch database."""
+    con.execute(f"USE {database}")
+    con.execute(f"DETACH DATABASE IF EXISTS {SCRATCH_DATABASE}")
+
+
+def _load_delta(
+    con: duckdb.DuckDBPyConnection,
+    database: str,
+    table_name: str,
+    upserts: Optional[Union[str, "GeoDataFrame"]],
+    deleted_ids: Optional[List[int]],
+):
+    """
+    Load the changed features into `delta_upserts` and `delta_ids`.
+
+    `delta_upserts` holds the new features, projected like the pipeline tables, and
+    `delta_ids` the OBJECTIDs whose current rows are removed from `table_name`.
+    """
+    if upserts is None:
+        con.execute(
+            f"CREATE TABLE delta_upserts AS SELECT * FROM {database}.{table_name} LIMIT 0"
+        )
+    else:
+        load_data_to_table(con, upserts, "delta_upserts")
+
+    crs = con.execute(
+        f"SELECT crs FROM {database}.pipeline_crs"
+        if _has_local_crs(con, database)
+        else "SELECT NULL"
+    ).fetchone()[0]
+    if crs is not None:
+        # Also records the CRS in the scratch database for the analyzer steps
+        project_to_local_crs(con, ["delta_upserts"], crs)
+
+    con.execute(
+        """
+        CREATE TABLE delta_ids AS
+        SELECT DISTINCT OBJECTID FROM (
+            SELECT OBJECTID FROM delta_upserts
+            UNION ALL
+            SELECT UNNEST(CAST(? AS BIGINT[])) AS OBJECTID
+        )
+        """,
+        [list(deleted_ids or [])],
+    )
+
+
+def _has_local_crs(con: duckdb.DuckDBPyConnection, database: str) -> bool:
+    """Check whether the tables of `database` are projected to a local CRS."""
+    return (
+        con.execute(
+            """
+            SELECT 1
+            FROM information_schema.tables
+            WHERE table_catalog = ? AND table_name = 'pipeline_crs'
+            """,
+            [database],
+        ).fetchone()
+        is not None
+    )
+
+
+def _search_margin(
+    con: duckdb.DuckDBPyConnection, database: str, dist: float
+) -> float:
+    """
+    Convert the search distance to the units of the tables.
+
+    Tables in EPSG:4326 are measured in degrees, so the margin is an overestimate at
+    the latitude of the crosswalks furthest from the equator. That only adds
+    crosswalks whose results do not change.
+    """
+    if get_local_crs(con) is not None:
+        return dist
+    latitude = con.execute(
+        f"SELECT MAX(GREATEST(ABS(ST_YMin(geometry)), ABS(ST_YMax(geometry)))) "
+        f"FROM {database}.crosswalks"
+    ).fetchone()[0]
+    return meters_to_degrees(dist, latitude)
+
+
+def _apply_delta(con: duckdb.DuckDBPyConnection, database: str, table_name: str):
+    """Delete the changed rows of a pipeline table and insert their new versions."""
+    target_columns = {
+        row[0] for row in con.execute(f"DESCRIBE {database}.{table_name}").fetchall()
+    }
+    columns = [
+        f'"{row[0]}"'
+        for row in con.execute("DESCRIBE delta_upserts").fetchall()
+        if row[0] in target_columns
+    ]
+    con.execute(
+        f"""
+        DELETE FROM {database}.{table_name}
+        WHERE OBJECTID IN (SELECT OBJECTID FROM delta_ids);
+
+        INSERT INTO {database}.{table_name} ({", ".join(columns)})
+        SELECT {", ".join(columns)} FROM delta_upserts;
+        """
+    )
+    if "geometry_lat_long" in target_columns:
+        # Streetlights searched in EPSG:4326 keep a flipped copy of their geometry
+        con.execute(
+            f"""
+            UPDATE {database}.{table_name}
+            SET geometry_lat_long = ST_FlipCoordinates(geometry)
+            WHERE OBJECTID IN (SELECT OBJECTID FROM delta_upserts)
+            """
+        )
+
+
+def _updated_rows(database: str, table_name: str) -> str:
+    """Build a subquery of a pipeline table with the delta applied."""
+    return f"""(
+        SELECT * FROM {database}.{table_name}
+        WHERE OBJECTID NOT IN (SELECT OBJECTID FROM delta_ids)
+        UNION ALL BY NAME
+        SELECT * FROM delta_upserts
+    )"""
+
+
+def _copy_nearby_streetlights(
+    con: duckdb.DuckDBPyConnection, database: str, margin: float, updated=False
+):
+    """
+    Copy the streetlights that can be within range of the affected crosswalks.
+
+    If `updated` is True, the streetlight delta is applied to the copy.
+    """
+    source = (
+        _updated_rows(database, "streetlights")
+        if updated
+        else f"(SELECT * FROM {database}.streetlights)"
+    )
+    con.execute(
+        f"""
+        CREATE TABLE streetlights AS
+        WITH search_areas AS (
+            SELECT ST_MakeEnvelope(
+                ST_XMin(geometry) - $margin,
+                ST_YMin(geometry) - $margin,
+                ST_XMax(geometry) + $margin,
+                ST_YMax(geometry) + $margin
+            ) AS area
+            FROM {database}.crosswalks
+            WHERE OBJECTID IN (SELECT crosswalk_id FROM affected_crosswalks)
+        )
+        SELECT s.*
+        FROM {source} s
+        SEMI JOIN search_areas a ON ST_Intersects(s.geometry, a.area)
+        """,
+        {"margin": margin},
+    )
+
+
+def _recompute_lights(con: duckdb.DuckDBPyConnection, dist: float, threshold: float):
+    """Run the streetlight and contrast steps on the scratch database."""
+    create_crosswalk_centers_lights(con)
+    find_streetlights_crosswalk_centers(con, dist)
+    calculate_contrast(con, threshold)
+    calculate_percieved_brightness(con)
+
+
+def _replace_rows(
+    con: duckdb.DuckDBPyConnection,
+    database: str,
+    delta_table: str,
+    table_names: List[str],
+) -> List[int]:
+    """
+    Apply the delta to `delta_table` and replace the rows of the affected crosswalks
+    in the result tables, in one transaction.
+    """
+    con.execute("BEGIN TRANSACTION")
+    try:
+        _apply_delta(con, database, delta_table)
+        for table_name in table_names:
+            con.execute(
+                f"""
+                DELETE FROM {database}.{table_name}
+                WHERE crosswalk_id IN (SELECT crosswalk_id FROM affected_crosswalks);
+
+                INSERT INTO {database}.{table_name} BY NAME
+                SELECT * FROM {table_name};
+                """
+            )
+        con.execute(f"DROP TABLE IF EXISTS {database}.streetlight_search")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return [
+        row[0]
+        for row in con.execute(
+            "SELECT crosswalk_id FROM affected_crosswalks ORDER BY crosswalk_id"
+        ).fetchall()
+    ]
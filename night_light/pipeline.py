@@ -0,0 +1,378 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
+
+import duckdb
+
+from night_light.analyzer import (
+    calculate_percieved_brightness,
+    classify_and_sum_heuristics,
+    classify_edges_by_intersection,
+    create_crosswalk_centers_lights,
+    decompose_crosswalk_edges,
+    filter_streetlights_crosswalk_centers,
+    find_crosswalk_centers,
+    identify_vehicle_direction,
+    label_contrast,
+    search_nearest_streetlights_crosswalk_centers,
+    search_streetlights_crosswalk_centers,
+    simplify_crosswalk_polygon_to_box,
+)
+from night_light.profiling import span
+from night_light.util_duckdb import (
+    is_geodataframe,
+    load_multiple_datasets,
+    project_to_local_crs,
+    table_exists,
+)
+
+# Re-exported, since callers import save_results from here with run_pipeline
+from night_light.util_duckdb import save_results  # noqa: F401
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
+
+## Runs the analyzer steps as a DAG of stages. Every stage records a fingerprint of its
+## parameters and of the stages it depends on, and is skipped when the fingerprint is
+## unchanged since the last run against the same database.
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A step of the pipeline.
+
+    Attributes:
+        name: Name of the stage, used as its key in the `pipeline_state` table.
+        run: Function called with the connection and the pipeline parameters.
+        depends_on: Names of the stages whose outputs this stage reads.
+        params: Names of the pipeline parameters that change the stage's output.
+        outputs: Tables the stage creates; the stage re-runs if one is missing.
+        version: Bumped whenever the stage's code changes the tables it writes, so
+            databases checkpointed by older code re-run it.
+    """
+
+    name: str
+    run: Callable[[duckdb.DuckDBPyConnection, Dict[str, Any]], None]
+    depends_on: Tuple[str, ...] = ()
+    params: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    version: int = 1
+
+
+def _ingest(con: duckdb.DuckDBPyConnection, params: Dict[str, Any]):
+    """Reload the input datasets from scratch and optionally project them."""
+    datasets = params["datasets"]
+    for _, table_name in datasets:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    con.execute("DROP TABLE IF EXISTS pipeline_crs")
+    load_multiple_datasets(con, datasets)
+    if params["local_crs"]:
+        project_to_local_crs(con, [table_name for _, table_name in datasets])
+
+
+def _search_streetlights(con: duckdb.DuckDBPyConnection, params: Dict[str, Any]):
+    """
+    Search the streetlights within `search_dist` meters of each crosswalk center, or
+    only the `nearest` ones.
+    """
+    if params["nearest"] is None:
+        search_streetlights_crosswalk_centers(con, params["search_dist"])
+    else:
+        search_nearest_streetlights_crosswalk_centers(
+            con, params["nearest"], params["search_dist"]
+        )
+
+
+def _find_streetlights(con: duckdb.DuckDBPyConnection, params: Dict[str, Any]):
+    """Link the streetlights within `dist` meters to each crosswalk center."""
+    create_crosswalk_centers_lights(con)
+    filter_streetlights_crosswalk_centers(con, params["dist"])
+
+
+# Implementations of the contrast stage, selected with the contrast_engine parameter
+def _classify_and_sum_heuristics_numpy(con: duckdb.DuckDBPyConnection):
+    # The NumPy engine is imported on first use, see night_light.analyzer
+    from night_light.analyzer import classify_and_sum_heuristics_numpy
+
+    classify_and_sum_heuristics_numpy(con)
+
+
+CONTRAST_ENGINES: Dict[str, Callable[[duckdb.DuckDBPyConnection], None]] = {
+    "sql": classify_and_sum_heuristics,
+    "numpy": _classify_and_sum_heuristics_numpy,
+}
+
+
+def _calculate_contrast(con: duckdb.DuckDBPyConnection, params: Dict[str, Any]):
+    """Classify the nearby streetlights and sum the heuristics of every center."""
+    CONTRAST_ENGINES[params["contrast_engine"]](con)
+
+
+STAGES = [
+    Stage(
+        "ingest",
+        _ingest,
+        params=("datasets", "local_crs"),
+        outputs=("crosswalks", "streetlights", "street_segments"),
+    ),
+    Stage(
+        "simplify",
+        lambda con, params: simplify_crosswalk_polygon_to_box(con),
+        depends_on=("ingest",),
+    ),
+    Stage(
+        "decompose",
+        lambda con, params: decompose_crosswalk_edges(con),
+        depends_on=("simplify",),
+        outputs=("crosswalk_segments",),
+        version=2,
+    ),
+    Stage(
+        "classify_edges",
+        lambda con, params: classify_edges_by_intersection(con),
+        depends_on=("ingest", "decompose"),
+        outputs=("crosswalk_segments",),
+        version=2,
+    ),
+    Stage(
+        "centers",
+        lambda con, params: find_crosswalk_centers(con),
+        depends_on=("simplify", "classify_edges"),
+        outputs=("crosswalk_centers",),
+        version=2,
+    ),
+    Stage(
+        "direction",
+        lambda con, params: identify_vehicle_direction(con),
+        depends_on=("centers",),
+        outputs=("crosswalk_centers",),
+        version=2,
+    ),
+    Stage(
+        "search",
+        _search_streetlights,
+        depends_on=("ingest", "direction"),
+        params=("search_dist", "nearest"),
+        outputs=("streetlight_search",),
+    ),
+    Stage(
+        "lights",
+        _find_streetlights,
+        depends_on=("direction", "search"),
+        params=("dist",),
+        outputs=("crosswalk_centers_lights",),
+        version=2,
+    ),
+    Stage(
+        "contrast",
+        _calculate_contrast,
+        depends_on=("lights",),
+        params=("contrast_engine",),
+        outputs=("classified_streetlights", "crosswalk_centers_heuristics"),
+        version=4,
+    ),
+    # Only labels the cached heuristics, so a new threshold takes seconds
+    Stage(
+        "label",
+        lambda con, params: label_contrast(con, params["threshold"]),
+        depends_on=("contrast",),
+        params=("threshold",),
+        outputs=("crosswalk_centers_contrast",),
+    ),
+    Stage(
+        "brightness",
+        lambda con, params: calculate_percieved_brightness(con),
+        depends_on=("label",),
+        outputs=("crosswalk_centers_contrast",),
+        version=2,
+    ),
+]
+
+
+def hash_data_source(data_source: Union[str, "GeoDataFrame"]) -> str:
+    """
+    Compute a content hash of a dataset.
+
+    Args:
+        data_source: Path to a spatial file or a GeoDataFrame.
+
+    Returns:
+        Hex digest of the SHA-256 of the file contents or of the GeoDataFrame rows.
+    """
+    digest = hashlib.sha256()
+    if is_geodataframe(data_source):
+        from pandas.util import hash_pandas_object
+
+        rows = hash_pandas_object(data_source.to_wkb(), index=True)
+        digest.update(rows.values.tobytes())
+    else:
+        with open(data_source, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fingerprint_params(
+    stage: Stage, params: Dict[str, Any], fingerprints: Dict[str, str]
+) -> Dict[str, Any]:
+    """Collect everything that determines the output of a stage."""
+    values = {}
+    for name in stage.params:
+        if name == "datasets":
+            # Key the datasets on their contents rather than their paths
+            values[name] = [
+                (hash_data_source(source), table_name)
+                for source, table_name in params[name]
+            ]
+        else:
+            values[name] = params[name]
+    return {
+        "stage": stage.name,
+        "version": stage.version,
+        "params": values,
+        "depends_on": {name: fingerprints[name] for name in stage.depends_on},
+    }
+
+
+def stage_fingerprint(
+    stage: Stage, params: Dict[str, Any], fingerprints: Dict[str, str]
+) -> str:
+    """
+    Compute the fingerprint of a stage.
+
+    Args:
+        stage: The stage to fingerprint.
+        params: Parameters of the pipeline run.
+        fingerprints: Fingerprints of the stages computed so far, by name.
+
+    Returns:
+        Hex digest that changes whenever the stage's parameters or the fingerprint
+        of a stage it depends on change.
+    """
+    payload = json.dumps(
+        _fingerprint_params(stage, params, fingerprints), sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _stored_fingerprints(con: duckdb.DuckDBPyConnection) -> Dict[str, str]:
+    """Read the fingerprints recorded by previous runs."""
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            stage VARCHAR PRIMARY KEY,
+            fingerprint VARCHAR,
+            completed_at TIMESTAMP
+        )
+        """
+    )
+    return dict(con.execute("SELECT stage, fingerprint FROM pipeline_state").fetchall())
+
+
+def _tables_exist(con: duckdb.DuckDBPyConnection, tables: Tuple[str, ...]) -> bool:
+    """Check that every table in the list exists."""
+    return all(table_exists(con, table) for table in tables)
+
+
+def run_pipeline(
+    con: duckdb.DuckDBPyConnection,
+    datasets: List[Tuple[Union[str, "GeoDataFrame"], str]],
+    dist: float = 20,
+    threshold: float = 0.01,
+    local_crs: bool = False,
+    contrast_engine: str = "sql",
+    search_dist: Optional[float] = None,
+    nearest: Optional[int] = None,
+    force: bool = False,
+    stages: List[Stage] = None,
+) -> List[str]:
+    """
+    Run the analyzer stages, skipping the ones that are up to date.
+
+    A stage is up to date when its fingerprint matches the one recorded in the
+    `pipeline_state` table, its output tables exist and none of the stages it
+    depends on re-ran. Changing a parameter, like
+    the contrast threshold, only re-runs the stages that use it and the stages
+    downstream of them. Changing the contents of a source file re-runs everything.
+
+    Args:
+        con: Connection to the DuckDB database.
+        datasets: List of (data_source, table_name) tuples, see
+            `load_multiple_datasets`.
+        dist: Meters to search for streetlights near each crosswalk center.
+        threshold: Threshold of the contrast heuristic classification.
+        local_crs: Whether to project the datasets to the local UTM zone.
+        contrast_engine: Implementation of the contrast stage: "sql" or "numpy".
+            Both produce the same tables; "numpy" computes the sides and heuristics
+            on arrays fetched through Arrow. The threshold is applied by the next
+            stage, so changing it never re-runs this one.
+        search_dist: Meters of the spatial join that finds the streetlights near each
+            crosswalk center. The streetlights within `dist` are then picked from its
+            results, so runs with any `dist` up to `search_dist` reuse the same join.
+            Default is `dist`.
+        nearest: Only link the `nearest` closest streetlights within `dist` to each
+            crosswalk center. They are found with an in-memory grid index instead of
+            a spatial join. Default is every streetlight within `dist`.
+        force: Run every stage even if it is up to date.
+        stages: Stages to run, in dependency order. Default is `STAGES`.
+
+    Returns:
+        Names of the stages that ran.
+    """
+    if contrast_engine not in CONTRAST_ENGINES:
+        raise ValueError(
+            f"Unknown contrast engine '{contrast_engine}'. "
+            f"Choose one of: {', '.join(CONTRAST_ENGINES)}"
+        )
+    if search_dist is None:
+        search_dist = dist
+    elif search_dist < dist:
+        raise ValueError(f"search_dist ({search_dist}) must be at least dist ({dist})")
+    stages = STAGES if stages is None else stages
+    params = {
+        "datasets": datasets,
+        "dist": dist,
+        "search_dist": search_dist,
+        "nearest": nearest,
+        "threshold": threshold,
+        "local_crs": local_crs,
+        "contrast_engine": contrast_engine,
+    }
+    stored = _stored_fingerprints(con)
+    fingerprints = {}
+    ran = []
+    for stage in stages:
+        missing = [name for name in stage.depends_on if name not in fingerprints]
+        if missing:
+            raise ValueError(
+                f"Stage '{stage.name}' depends on stages that do not run before it: "
+                f"{', '.join(missing)}"
+            )
+        fingerprint = stage_fingerprint(stage, params, fingerprints)
+        fingerprints[stage.name] = fingerprint
+        # A stage also re-runs when a stage it depends on re-ran, since that stage
+        # may have rebuilt tables this stage modifies in place
+        if (
+            not force
+            and stored.get(stage.name) == fingerprint
+            and not any(name in ran for name in stage.depends_on)
+            and _tables_exist(con, stage.outputs)
+        ):
+            print(f"Stage '{stage.name}' is up to date. Skipping.")
+            continue
+
+        # Forget the stage's checkpoint first, so a stage that is interrupted after
+        # rewriting part of its tables re-runs next time, whatever its parameters
+        con.execute("DELETE FROM pipeline_state WHERE stage = ?", [stage.name])
+        with span(f"stage {stage.name}"):
+            stage.run(con, params)
+        con.execute(
+            """
+            INSERT OR REPLACE INTO pipeline_state VALUES (?, ?, current_timestamp)
+            """,
+            [stage.name, fingerprint],
+        )
+        ran.append(stage.name)
+    return ran
@@ -0,0 +1,394 @@
+import functools
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import duckdb
+
+## Instruments the analyzer and the I/O helpers. While `profile_run` is active, every
+## decorated function and every SQL statement it executes is recorded with its start
+## and end time, rows read and written, and peak memory. The events are written as a
+## Chrome trace, which opens in chrome://tracing, Perfetto or speedscope.
+##
+## Outside of `profile_run` the decorator only checks a global, so it costs nothing.
+
+# Profiler of the active profile_run, if any
+_active_profiler = None
+
+# Root operators that write their input somewhere instead of returning it
+_SINK_OPERATORS = {
+    "CREATE_TABLE_AS",
+    "INSERT",
+    "UPDATE",
+    "DELETE_OPERATOR",
+    "COPY_TO_FILE",
+    "BATCH_COPY_TO_FILE",
+}
+
+
+class PeakMemory:
+    """
+    Track the peak resident memory of the process while a block runs.
+
+    The resident set size is sampled every few milliseconds from /proc. On systems
+    without /proc, the peak resident set size of the whole process is reported.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.peak = current_memory()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_memory())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_memory())
+
+
+def current_memory() -> int:
+    """Resident memory of the process, in bytes."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == "Darwin" else maxrss * 1024
+
+
+class Profiler:
+    """
+    Collect trace events of functions and SQL statements.
+
+    Args:
+        explain: Whether to attach the operator tree of every SQL statement, as shown
+            by `EXPLAIN ANALYZE`, to its event.
+    """
+
+    def __init__(self, explain: bool = False):
+        self.explain = explain
+        self.events: List[Dict[str, Any]] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profile_dir = tempfile.mkdtemp(prefix="night_light_profile_")
+        self._connections: Dict[int, duckdb.DuckDBPyConnection] = {}
+
+    def _now(self) -> float:
+        """Microseconds since the profiler was created."""
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _stack(self) -> List[Dict[str, Any]]:
+        """Arguments of the spans open on the current thread, innermost last."""
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add_rows(self, args: Dict[str, Any], rows_in: int, rows_out: int):
+        """Add rows to the arguments of a span, which other threads may also update."""
+        with self._lock:
+            args["rows_in"] += rows_in
+            args["rows_out"] += rows_out
+
+    def in_current_span(self, func: Callable) -> Callable:
+        """
+        Wrap `func` so that its spans on other threads nest in the current span.
+
+        Args:
+            func: Function run on worker threads, e.g. by a ThreadPoolExecutor.
+
+        Returns:
+            Callable: The wrapped function.
+        """
+        parents = list(self._stack())
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = self._stack()
+            self._local.stack = list(parents)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = previous
+
+        return wrapper
+
+    def _add_event(
+        self, name: str, category: str, start: float, args: Dict[str, Any]
+    ):
+        """Record a complete event that started at `start` and ends now."""
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round(start, 1),
+            "dur": round(self._now() - start, 1),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, category: str = "stage", **args):
+        """
+        Record the block as an event, with the rows of the SQL statements run in it.
+
+        Args:
+            name: Name of the event.
+            category: Category of the event, e.g. "stage" or "function".
+            **args: Extra arguments shown with the event.
+        """
+        args = {**args, "rows_in": 0, "rows_out": 0}
+        stack = self._stack()
+        stack.append(args)
+        start = self._now()
+        try:
+            with PeakMemory() as memory:
+                yield args
+        except Exception as error:
+            args["error"] = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            stack.pop()
+            args["peak_memory_mb"] = round(memory.peak / 2**20, 1)
+            if stack:
+                self._add_rows(stack[-1], args["rows_in"], args["rows_out"])
+            self._add_event(name, category, start, args)
+
+    def execute(
+        self,
+        con: duckdb.DuckDBPyConnection,
+        query: str,
+        parameters: Optional[Any] = None,
+    ):
+        """Execute one SQL statement on `con` and record it."""
+        profile_path = self._enable_profiling(con)
+        if os.path.exists(profile_path):
+            os.remove(profile_path)
+
+        args = {"sql": query.strip()}
+        start = self._now()
+        try:
+            if parameters is None:
+                con.execute(query)
+            else:
+                con.execute(query, parameters)
+        except Exception as error:
+            args["error"] = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            # DuckDB only writes a profile for statements with a plan, and writes the
+            # profile of a SELECT once its result is fetched
+            if os.path.exists(profile_path):
+                with open(profile_path) as file:
+                    profile = json.load(file)
+            else:
+                profile = {}
+            # Closing the result of an earlier SELECT can write its profile instead
+            if profile.get("query_name", "").strip() == query.strip():
+                args.update(_statement_rows(profile))
+                if self.explain:
+                    args["operators"] = _operator_tree(profile)
+                stack = self._stack()
+                if stack:
+                    self._add_rows(stack[-1], args["rows_in"], args["rows_out"])
+            self._add_event(_statement_name(query), "sql", start, args)
+
+    def _enable_profiling(self, con: duckdb.DuckDBPyConnection) -> str:
+        """Make DuckDB write the profile of every statement on `con` to a file."""
+        profile_path = os.path.join(self._profile_dir, f"{id(con)}.json")
+        # Cursors of the same database are profiled from several threads at once
+        with self._lock:
+            if id(con) not in self._connections:
+                con.execute("SET enable_profiling = 'json'")
+                con.execute(f"SET profiling_output = '{profile_path}'")
+                # Keeping the cursor also keeps its id from being reused
+                self._connections[id(con)] = con
+        return profile_path
+
+    def close(self):
+        """Turn off DuckDB profiling and delete the profile files."""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for con in connections:
+            try:
+                con.execute("RESET enable_profiling")
+                con.execute("RESET profiling_output")
+            except duckdb.Error:
+                # The connection or cursor was closed
+                pass
+        shutil.rmtree(self._profile_dir, ignore_errors=True)
+
+    def write(self, path: str):
+        """Write the events as a Chrome trace JSON file."""
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+
+class _TracedConnection:
+    """Connection wrapper that records every statement passed to `execute`."""
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, profiler: Profiler):
+        self._con = con
+        self._profiler = profiler
+
+    def execute(self, query, parameters=None):
+        if not isinstance(query, str):
+            return self._con.execute(query, parameters)
+        # DuckDB only profiles the last statement of a script, so run them one by one.
+        # Parameters are only allowed in scripts with a single statement.
+        statements = [query]
+        if parameters is None:
+            statements = [
+                statement.query for statement in self._con.extract_statements(query)
+            ]
+        for statement in statements:
+            self._profiler.execute(self._con, statement, parameters)
+        return self._con
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+def profiled(func: Callable) -> Callable:
+    """
+    Record every call of `func` while a `profile_run` is active.
+
+    The first argument of `func` must be a DuckDB connection. The SQL statements that
+    `func` executes on it are recorded as child events.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active_profiler
+        if profiler is None:
+            return func(*args, **kwargs)
+        if args and isinstance(args[0], duckdb.DuckDBPyConnection):
+            args = (_TracedConnection(args[0], profiler),) + args[1:]
+        with profiler.span(f"{func.__module__}.{func.__name__}", "function"):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def in_current_span(func: Callable) -> Callable:
+    """
+    Wrap a function run on worker threads so its events nest in the current span.
+
+    The spans of the threads of a pool are otherwise recorded without a parent, and
+    their rows are missing from the span that started the pool. Returns `func` itself
+    if no `profile_run` is active.
+
+    Args:
+        func: Function run on worker threads, e.g. by a ThreadPoolExecutor.
+
+    Returns:
+        Callable: The wrapped function.
+    """
+    if _active_profiler is None:
+        return func
+    return _active_profiler.in_current_span(func)
+
+
+@contextmanager
+def span(name: str, category: str = "stage", **args):
+    """
+    Record a block as an event if a `profile_run` is active.
+
+    Args:
+        name: Name of the event.
+        category: Category of the event.
+        **args: Extra arguments shown with the event.
+    """
+    if _active_profiler is None:
+        yield None
+    else:
+        with _active_profiler.span(name, category, **args) as event_args:
+            yield event_args
+
+
+@contextmanager
+def profile_run(trace_path: str, explain: bool = False):
+    """
+    Profile every instrumented function called in the block.
+
+    Example:
+        with profile_run("trace.json", explain=True):
+            run_pipeline(con, datasets)
+
+    Args:
+        trace_path: Path of the Chrome trace JSON file written when the block exits.
+        explain: Whether to attach the operator tree of every SQL statement, with
+            the time and rows of every operator, to its event.
+
+    Yields:
+        Profiler: The profiler collecting the events.
+    """
+    global _active_profiler
+    previous = _active_profiler
+    profiler = Profiler(explain)
+    _active_profiler = profiler
+    try:
+        with profiler.span("run", "run"):
+            yield profiler
+    finally:
+        _active_profiler = previous
+        profiler.close()
+        profiler.write(trace_path)
+
+
+def _statement_name(query: str) -> str:
+    """Short name of a statement: its first line of SQL."""
+    for line in query.strip().splitlines():
+        line = line.strip()
+        if line and not line.startswith("--"):
+            return line[:80]
+    return query.strip()[:80]
+
+
+def _statement_rows(profile: Dict[str, Any]) -> Dict[str, int]:
+    """Rows read by a statement and rows it returned or wrote."""
+    rows_in = profile.get("cumulative_rows_scanned", 0)
+    children = profile.get("children", [])
+    if not children:
+        return {"rows_in": rows_in, "rows_out": profile.get("rows_returned", 0)}
+    root = children[0]
+    if root["operator_type"] in _SINK_OPERATORS and root.get("children"):
+        root = root["children"][0]
+    return {"rows_in": rows_in, "rows_out": root["operator_cardinality"]}
+
+
+def _operator_tree(operator: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep the name, time, rows and details of every operator of a profile."""
+    children = [_operator_tree(child) for child in operator.get("children", [])]
+    if "operator_type" not in operator:
+        # The root of a profile is the query itself
+        return children[0] if len(children) == 1 else {"children": children}
+    return {
+        "operator": operator["operator_name"].strip(),
+        "seconds": operator.get("operator_timing", 0),
+        "rows": operator.get("operator_cardinality", 0),
+        "rows_scanned": operator.get("operator_rows_scanned", 0),
+        "details": operator.get("extra_info", {}),
+        "children": children,
+    }
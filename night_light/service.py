@@ -0,0 +1,539 @@
+import functools
+import json
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import duckdb
+import numpy as np
+
+from night_light.spatial_index import GridIndex
+from night_light.util_duckdb import (
+    ConnectionPool,
+    ConnectionProfile,
+    find_local_crs,
+    get_local_crs,
+)
+
+## Serves the results of a run as GeoJSON over HTTP, for dashboards and field apps.
+## The crosswalk centers and their contrast classes are loaded once into grid indexes,
+## so viewport and nearest-center queries never touch the database. Crosswalk details
+## come from a pool of read-only DuckDB connections. Responses are kept in an LRU cache
+## keyed by the request, e.g. the bounding box and zoom of a viewport.
+
+# Columns of crosswalk_centers_contrast served as properties of every center
+CENTER_PROPERTIES = [
+    "crosswalk_id",
+    "center_id",
+    "contrast_heuristic",
+    "to_contrast_heuristic",
+    "from_contrast_heuristic",
+    "light_heuristic",
+]
+
+# Columns of classified_streetlights served as properties of every streetlight
+STREETLIGHT_PROPERTIES = ["streetlight_id", "center_id", "side", "dist", "angle_rad"]
+
+# Zoom level from which viewports list every center rather than clusters of them
+DETAIL_ZOOM = 15
+
+# Clusters per side of a 256-pixel map tile, below DETAIL_ZOOM
+CLUSTERS_PER_TILE = 8
+
+# Most centers a nearest-center query returns
+MAX_NEAREST_K = 100
+
+# Meters a nearest-center query searches at most
+MAX_NEAREST_DIST = 5000
+
+
+class ContrastService:
+    """
+    Queries over the crosswalk centers and streetlights of a finished run.
+
+    Every query returns a JSON document encoded as bytes, with coordinates in
+    EPSG:4326, so responses can be cached and sent as they are.
+
+    Attributes:
+        num_centers: Number of crosswalk centers served.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        pool_size: int = 4,
+        cache_size: int = 1024,
+        profile: Optional[ConnectionProfile] = None,
+    ):
+        """
+        Load the crosswalk centers of a database and index them.
+
+        Args:
+            db_path: Path to the DuckDB database of a run. It is opened read-only.
+            pool_size: Number of connections to the database.
+            cache_size: Number of responses kept of every kind of query.
+            profile: Settings of the connections.
+        """
+        self._pool = ConnectionPool(db_path, pool_size, profile)
+        with self._pool.connection() as con:
+            self._crs = get_local_crs(con)
+            # Nearest centers are searched in meters, in the local UTM zone
+            self._planar_crs = self._crs or find_local_crs(con)
+            centers = self._load_centers(con)
+
+        self.num_centers = len(centers["lon"])
+        self._lon = centers["lon"]
+        self._lat = centers["lat"]
+        self._crosswalk_ids = centers["crosswalk_id"]
+        self._lonlat_index = GridIndex(self._lon, self._lat)
+        self._planar_index = GridIndex(centers["x"], centers["y"])
+        classes, self._class_codes = np.unique(
+            centers["contrast_heuristic"].astype(str), return_inverse=True
+        )
+        self._classes = classes.tolist()
+
+        columns = {name: centers[name].tolist() for name in CENTER_PROPERTIES}
+        self._properties = [
+            {name: _json_value(columns[name][row]) for name in CENTER_PROPERTIES}
+            for row in range(self.num_centers)
+        ]
+        # Encode every center once, so responses only join the encoded features
+        self._features = [
+            _encode_feature(self._lon[row], self._lat[row], self._properties[row])
+            for row in range(self.num_centers)
+        ]
+
+        # lru_cache is thread-safe, so the caches are shared by the server threads
+        self._cached_viewport = functools.lru_cache(cache_size)(self._viewport)
+        self._cached_crosswalk = functools.lru_cache(cache_size)(self._crosswalk)
+
+    def _lonlat_sql(self, column: str) -> str:
+        """SQL expression of a geometry column in EPSG:4326."""
+        if self._crs is None:
+            return column
+        return (
+            f"ST_Transform({column}, '{self._crs}', 'EPSG:4326', always_xy := true)"
+        )
+
+    def _load_centers(self, con: duckdb.DuckDBPyConnection) -> Dict[str, np.ndarray]:
+        """Fetch the properties and coordinates of every crosswalk center."""
+        if self._crs is None:
+            planar = (
+                f"ST_Transform(g.geometry, 'EPSG:4326', '{self._planar_crs}', "
+                "always_xy := true)"
+            )
+        else:
+            planar = "g.geometry"
+        centers = con.execute(
+            f"""
+            WITH center_points AS (
+                SELECT crosswalk_id, center_id, ANY_VALUE(geometry) AS geometry
+                FROM crosswalk_centers_lights
+                GROUP BY crosswalk_id, center_id
+            ),
+            points AS (
+                SELECT
+                    {", ".join(f"c.{name}" for name in CENTER_PROPERTIES)},
+                    {self._lonlat_sql("g.geometry")} AS lonlat,
+                    {planar} AS planar
+                FROM crosswalk_centers_contrast c
+                JOIN center_points g
+                    ON g.crosswalk_id = c.crosswalk_id
+                    AND g.center_id IS NOT DISTINCT FROM c.center_id
+            )
+            SELECT
+                * EXCLUDE (lonlat, planar),
+                ST_X(lonlat) AS lon,
+                ST_Y(lonlat) AS lat,
+                ST_X(planar) AS x,
+                ST_Y(planar) AS y
+            FROM points
+            ORDER BY crosswalk_id, center_id;
+            """
+        ).fetchnumpy()
+        for name in ["lon", "lat", "x", "y"]:
+            centers[name] = np.asarray(centers[name], dtype=np.float64)
+        return centers
+
+    def centers_in_bbox(
+        self, bbox: Tuple[float, float, float, float], zoom: Optional[int] = None
+    ) -> bytes:
+        """
+        Find the crosswalk centers in a bounding box.
+
+        Below `DETAIL_ZOOM`, nearby centers are merged into clusters, with the number
+        of centers of every contrast class, so zoomed out maps stay light.
+
+        Args:
+            bbox: (min longitude, min latitude, max longitude, max latitude).
+            zoom: Zoom level of the map, from 0. Default is to list every center.
+
+        Returns:
+            GeoJSON FeatureCollection of the centers or clusters.
+        """
+        bbox = tuple(float(value) for value in bbox)
+        if zoom is not None:
+            zoom = None if zoom >= DETAIL_ZOOM else max(int(zoom), 0)
+        return self._cached_viewport(bbox, zoom)
+
+    def _viewport(
+        self, bbox: Tuple[float, float, float, float], zoom: Optional[int]
+    ) -> bytes:
+        """Encode the centers or clusters of a viewport, see `centers_in_bbox`."""
+        rows = self._lonlat_index.within(*bbox)
+        if zoom is None:
+            return _encode_collection([self._features[row] for row in rows])
+        return _encode_collection(self._clusters(rows, zoom))
+
+    def _clusters(self, rows: np.ndarray, zoom: int) -> List[str]:
+        """Merge centers into the cells of a grid sized for the zoom level."""
+        if len(rows) == 0:
+            return []
+        cell_size = 360 / 2**zoom / CLUSTERS_PER_TILE
+        cells = np.floor(
+            np.column_stack([self._lon[rows], self._lat[rows]]) / cell_size
+        ).astype(np.int64)
+        _, cluster = np.unique(cells, axis=0, return_inverse=True)
+        cluster = cluster.reshape(-1)
+        counts = np.bincount(cluster)
+        lon = np.bincount(cluster, weights=self._lon[rows]) / counts
+        lat = np.bincount(cluster, weights=self._lat[rows]) / counts
+        num_classes = len(self._classes)
+        class_counts = np.bincount(
+            cluster * num_classes + self._class_codes[rows],
+            minlength=len(counts) * num_classes,
+        ).reshape(len(counts), num_classes)
+        return [
+            _encode_feature(
+                lon[index],
+                lat[index],
+                {
+                    "count": int(counts[index]),
+                    "contrast": {
+                        name: int(count)
+                        for name, count in zip(self._classes, class_counts[index])
+                        if count
+                    },
+                },
+            )
+            for index in range(len(counts))
+        ]
+
+    def nearest_centers(
+        self, lon: float, lat: float, k: int = 1, max_dist: Optional[float] = None
+    ) -> bytes:
+        """
+        Find the crosswalk centers nearest to a location.
+
+        Args:
+            lon: Longitude of the location.
+            lat: Latitude of the location.
+            k: Number of centers to find, at most `MAX_NEAREST_K`.
+            max_dist: Only find centers within this many meters, at most
+                `MAX_NEAREST_DIST`. Default is `MAX_NEAREST_DIST`.
+
+        Returns:
+            GeoJSON FeatureCollection of the centers, nearest first, with their
+            distance in meters in the `dist` property.
+        """
+        # A search without limits would scan the whole index from far locations
+        k = min(k, MAX_NEAREST_K, self.num_centers)
+        if k < 1:
+            # Nothing to search, e.g. a database without centers
+            return _encode_collection([])
+        if max_dist is None:
+            max_dist = MAX_NEAREST_DIST
+        max_dist = min(max_dist, MAX_NEAREST_DIST)
+        with self._pool.connection() as con:
+            x, y = con.execute(
+                f"""
+                SELECT ST_X(point), ST_Y(point)
+                FROM (
+                    SELECT ST_Transform(
+                        ST_Point(?, ?), 'EPSG:4326', '{self._planar_crs}',
+                        always_xy := true
+                    ) AS point
+                );
+                """,
+                [lon, lat],
+            ).fetchone()
+        rows, dists = self._planar_index.nearest([x], [y], k, max_dist)
+        return _encode_collection(
+            [
+                _encode_feature(
+                    self._lon[row],
+                    self._lat[row],
+                    {**self._properties[row], "dist": round(float(dist), 3)},
+                )
+                for row, dist in zip(rows[0], dists[0])
+                if row >= 0
+            ]
+        )
+
+    def crosswalk(self, crosswalk_id: int) -> bytes:
+        """
+        Get the centers of a crosswalk and the streetlights classified around them.
+
+        Args:
+            crosswalk_id: ID of the crosswalk.
+
+        Returns:
+            JSON object with the crosswalk ID and two GeoJSON FeatureCollections: the
+            centers, and the streetlights of every center with their side and
+            distance.
+
+        Raises:
+            LookupError: If the crosswalk has no centers.
+        """
+        return self._cached_crosswalk(int(crosswalk_id))
+
+    def _crosswalk(self, crosswalk_id: int) -> bytes:
+        """Encode the centers and streetlights of a crosswalk, see `crosswalk`."""
+        rows = np.flatnonzero(self._crosswalk_ids == crosswalk_id)
+        if len(rows) == 0:
+            raise LookupError(f"Crosswalk {crosswalk_id} has no centers.")
+        with self._pool.connection() as con:
+            streetlights = con.execute(
+                f"""
+                SELECT
+                    {", ".join(STREETLIGHT_PROPERTIES)},
+                    ST_X(point) AS lon,
+                    ST_Y(point) AS lat
+                FROM (
+                    SELECT *, {self._lonlat_sql("geometry")} AS point
+                    FROM classified_streetlights
+                    WHERE crosswalk_id = ?
+                )
+                ORDER BY center_id, dist, streetlight_id;
+                """,
+                [crosswalk_id],
+            ).fetchall()
+        centers = _encode_collection([self._features[row] for row in rows])
+        lights = _encode_collection(
+            [
+                _encode_feature(
+                    light[-2],
+                    light[-1],
+                    dict(zip(STREETLIGHT_PROPERTIES, map(_json_value, light))),
+                )
+                for light in streetlights
+            ]
+        )
+        return (
+            f'{{"crosswalk_id":{crosswalk_id},"centers":'.encode()
+            + centers
+            + b',"streetlights":'
+            + lights
+            + b"}"
+        )
+
+    def stats(self) -> bytes:
+        """
+        Describe the service: the number of centers and the use of the caches.
+
+        Returns:
+            JSON object of the statistics.
+        """
+        caches = {
+            "viewport": self._cached_viewport.cache_info(),
+            "crosswalk": self._cached_crosswalk.cache_info(),
+        }
+        return json.dumps(
+            {
+                "num_centers": self.num_centers,
+                "crs": self._crs or "EPSG:4326",
+                "caches": {
+                    name: {
+                        "hits": info.hits,
+                        "misses": info.misses,
+                        "size": info.currsize,
+                    }
+                    for name, info in caches.items()
+                },
+            }
+        ).encode()
+
+    def handle(self, path: str, params: Dict[str, str]) -> Tuple[int, bytes]:
+        """
+        Answer a request, without any HTTP server.
+
+        The routes are:
+
+        - `/centers?bbox=min_lon,min_lat,max_lon,max_lat&zoom=z`, see
+          `centers_in_bbox`;
+        - `/nearest?lon=x&lat=y&k=1&max_dist=m`, see `nearest_centers`;
+        - `/crosswalk?id=n`, see `crosswalk`;
+        - `/stats`, see `stats`.
+
+        Invalid parameters get a 400 response, unknown paths and crosswalks a 404,
+        and any other error a 500, all with a JSON body.
+
+        Args:
+            path: Path of the request.
+            params: Query parameters of the request.
+
+        Returns:
+            HTTP status code and JSON body of the response.
+        """
+        try:
+            if path == "/centers":
+                bbox = _parse_floats(params, "bbox", 4)
+                zoom = _parse_int(params, "zoom")
+                if zoom is not None and zoom < 0:
+                    raise ValueError("Parameter 'zoom' must be at least 0.")
+                return 200, self.centers_in_bbox(bbox, zoom)
+            if path == "/nearest":
+                (lon,) = _parse_floats(params, "lon", 1)
+                (lat,) = _parse_floats(params, "lat", 1)
+                max_dist = None
+                if "max_dist" in params:
+                    (max_dist,) = _parse_floats(params, "max_dist", 1)
+                    if not 0 <= max_dist <= MAX_NEAREST_DIST:
+                        raise ValueError(
+                            "Parameter 'max_dist' must be from 0 to "
+                            f"{MAX_NEAREST_DIST}."
+                        )
+                k = _parse_int(params, "k")
+                if k is None:
+                    k = 1
+                if not 1 <= k <= MAX_NEAREST_K:
+                    raise ValueError(
+                        f"Parameter 'k' must be from 1 to {MAX_NEAREST_K}."
+                    )
+                return 200, self.nearest_centers(lon, lat, k, max_dist)
+            if path == "/crosswalk":
+                crosswalk_id = _parse_int(params, "id")
+                if crosswalk_id is None:
+                    raise ValueError("Missing parameter 'id'.")
+                return 200, self.crosswalk(crosswalk_id)
+            if path == "/stats":
+                return 200, self.stats()
+            raise LookupError(f"Unknown path {path}.")
+        except ValueError as error:
+            return 400, json.dumps({"error": str(error)}).encode()
+        except LookupError as error:
+            return 404, json.dumps({"error": str(error)}).encode()
+        except Exception as error:
+            # The client still gets a response, e.g. if the database is unreachable
+            return 500, json.dumps({"error": type(error).__name__}).encode()
+
+    def close(self):
+        """Close the connections to the database."""
+        self._pool.close()
+
+
+def _json_value(value: Any) -> Any:
+    """A value as JSON allows it: NaN and infinite floats become null."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _encode_feature(lon: float, lat: float, properties: Dict[str, Any]) -> str:
+    """Encode a GeoJSON Point feature."""
+    return json.dumps(
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+            "properties": properties,
+        },
+        separators=(",", ":"),
+    )
+
+
+def _encode_collection(features: List[str]) -> bytes:
+    """Encode a GeoJSON FeatureCollection of encoded features."""
+    return (
+        '{"type":"FeatureCollection","features":[' + ",".join(features) + "]}"
+    ).encode()
+
+
+def _parse_floats(params: Dict[str, str], name: str, count: int) -> List[float]:
+    """Parse a parameter of comma-separated finite numbers."""
+    if name not in params:
+        raise ValueError(f"Missing parameter '{name}'.")
+    try:
+        values = [float(value) for value in params[name].split(",")]
+    except ValueError:
+        raise ValueError(f"Parameter '{name}' must be {count} numbers.")
+    if len(values) != count or not all(map(math.isfinite, values)):
+        raise ValueError(f"Parameter '{name}' must be {count} numbers.")
+    return values
+
+
+def _parse_int(params: Dict[str, str], name: str) -> Optional[int]:
+    """Parse an optional integer parameter."""
+    if name not in params:
+        return None
+    try:
+        return int(params[name])
+    except ValueError:
+        raise ValueError(f"Parameter '{name}' must be an integer.")
+
+
+def make_server(
+    service: ContrastService, host: str = "127.0.0.1", port: int = 8000
+) -> ThreadingHTTPServer:
+    """
+    Create an HTTP server of a service. Every request is answered in its own thread.
+
+    Args:
+        service: The service to answer the requests.
+        host: Address to listen on.
+        port: Port to listen on, or 0 for any free port.
+
+    Returns:
+        ThreadingHTTPServer: The server; call `serve_forever` to start it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            status, body = service.handle(url.path, params)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            # Dashboards are served from other origins
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(
+    db_path: str,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    pool_size: int = 4,
+    cache_size: int = 1024,
+    profile: Optional[ConnectionProfile] = None,
+):
+    """
+    Serve the results of a database over HTTP until interrupted.
+
+    Args:
+        db_path: Path to the DuckDB database of a run.
+        host: Address to listen on.
+        port: Port to listen on.
+        pool_size: Number of connections to the database.
+        cache_size: Number of responses kept of every kind of query.
+        profile: Settings of the connections.
+    """
+    service = ContrastService(db_path, pool_size, cache_size, profile)
+    server = make_server(service, host, port)
+    print(
+        f"Serving {service.num_centers} crosswalk centers on "
+        f"http://{server.server_address[0]}:{server.server_address[1]}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,404 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+## In-memory spatial index over point coordinates. Points are bucketed into a uniform
+## grid of square cells and sorted by cell, so the points of a cell are one slice of
+## the sorted arrays. Queries are vectorized over many query points at once.
+
+
+class GridIndex:
+    """
+    Uniform grid index over 2D points, for k-nearest-neighbor and rectangle queries.
+
+    Coordinates must be planar, e.g. meters in a projected CRS.
+
+    Attributes:
+        cell_size: Side of the square cells, in coordinate units.
+    """
+
+    def __init__(
+        self, x: np.ndarray, y: np.ndarray, cell_size: Optional[float] = None
+    ):
+        """
+        Build the index.
+
+        Args:
+            x: X coordinates of the points.
+            y: Y coordinates of the points.
+            cell_size: Side of the square cells. Default is the side that holds about
+                two points per cell on average.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.num_points = len(x)
+        if self.num_points == 0:
+            self.origin_x = self.origin_y = 0.0
+        else:
+            self.origin_x = x.min()
+            self.origin_y = y.min()
+        if cell_size is None:
+            cell_size = _default_cell_size(x, y)
+        self.cell_size = float(cell_size)
+
+        cell_x, cell_y = self._cells(x, y)
+        self.num_cols = int(cell_x.max()) + 1 if self.num_points else 0
+        self.num_rows = int(cell_y.max()) + 1 if self.num_points else 0
+        keys = cell_y * self.num_cols + cell_x
+
+        # Sort the points by cell and keep where every non-empty cell starts
+        self.order = np.argsort(keys, kind="stable")
+        self.x = x[self.order]
+        self.y = y[self.order]
+        self.cell_keys, self.cell_starts = np.unique(
+            keys[self.order], return_index=True
+        )
+        self.cell_ends = np.append(self.cell_starts[1:], self.num_points)
+
+    def nearest(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        k: int,
+        max_dist: Optional[float] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest points of every query point.
+
+        The cells around every query point are counted in rings of growing size until
+        they hold k points, and the k nearest points of those cells are picked. The
+        cells farther out are then searched only as far as the k-th of them, for
+        the query points where a closer point may still be there. Points at the same
+        distance are ordered by their index.
+
+        Args:
+            x: X coordinates of the query points.
+            y: Y coordinates of the query points.
+            k: Number of neighbors to find.
+            max_dist: Only find points within this distance. Default is no limit.
+
+        Returns:
+            Indices of the neighbors into the indexed points and their distances,
+            both of shape (number of query points, k), nearest first. Missing
+            neighbors have index -1 and distance inf.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        best_rows = np.full((len(x), k), -1, dtype=np.int64)
+        best_dists = np.full((len(x), k), np.inf)
+        # Query points without coordinates have no neighbors
+        queries = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        if self.num_points == 0 or k <= 0 or len(queries) == 0:
+            return best_rows, best_dists
+
+        x, y = x[queries], y[queries]
+        cell_x, cell_y = self._cells(x, y)
+        limit = np.inf if max_dist is None else max_dist
+        # Ring beyond which the square of rings covers the whole grid
+        last_ring = np.maximum(
+            np.maximum(cell_x, self.num_cols - 1 - cell_x),
+            np.maximum(cell_y, self.num_rows - 1 - cell_y),
+        )
+        if max_dist is not None:
+            last_ring = np.minimum(last_ring, int(np.ceil(max_dist / self.cell_size)))
+
+        rings = self._rings_holding(cell_x, cell_y, k, last_ring)
+        everything = np.arange(len(x))
+        pair_queries, rows, dists = self._candidates(
+            x, y, cell_x, cell_y, everything, -1, rings, limit
+        )
+        rows, dists = _k_smallest(pair_queries, rows, dists, len(x), k, self.num_points)
+
+        # Points outside the square of rings are at least `boundary` away, so the
+        # query points whose k-th point is farther search the rings up to it
+        boundary = np.minimum.reduce(
+            [
+                x - self.origin_x - (cell_x - rings) * self.cell_size,
+                self.origin_x + (cell_x + rings + 1) * self.cell_size - x,
+                y - self.origin_y - (cell_y - rings) * self.cell_size,
+                self.origin_y + (cell_y + rings + 1) * self.cell_size - y,
+            ]
+        )
+        reach = np.minimum(dists[:, -1], limit)
+        outer = np.where(
+            np.isfinite(reach),
+            np.ceil(reach / self.cell_size),
+            last_ring,
+        ).astype(np.int64)
+        outer = np.minimum(outer, last_ring)
+        farther = np.flatnonzero((dists[:, -1] >= boundary) & (outer > rings))
+        if len(farther):
+            pair_queries, new_rows, new_dists = self._candidates(
+                x, y, cell_x, cell_y, farther, rings[farther], outer[farther], reach
+            )
+            # Merge the new candidates with the k nearest points found so far
+            found = rows[farther] >= 0
+            kept_queries = np.repeat(np.arange(len(farther)), k)[found.ravel()]
+            rows[farther], dists[farther] = _k_smallest(
+                np.concatenate([kept_queries, pair_queries]),
+                np.concatenate([rows[farther][found], new_rows]),
+                np.concatenate([dists[farther][found], new_dists]),
+                len(farther),
+                k,
+                self.num_points,
+            )
+
+        best_rows[queries] = rows
+        best_dists[queries] = dists
+        return best_rows, best_dists
+
+    def within(
+        self, min_x: float, min_y: float, max_x: float, max_y: float
+    ) -> np.ndarray:
+        """
+        Find the points inside a rectangle, edges included.
+
+        The cells of a row of the grid are consecutive in the sorted points, so the
+        points of the rectangle's cells are one slice per row of cells, and only
+        those are compared with the rectangle.
+
+        Args:
+            min_x: Smallest X coordinate of the rectangle.
+            min_y: Smallest Y coordinate of the rectangle.
+            max_x: Largest X coordinate of the rectangle.
+            max_y: Largest Y coordinate of the rectangle.
+
+        Returns:
+            Indices of the points into the indexed points, in ascending order.
+        """
+        # Clip the rectangle to the grid, so far away or infinite edges stay valid
+        grid_max_x = self.origin_x + self.num_cols * self.cell_size
+        grid_max_y = self.origin_y + self.num_rows * self.cell_size
+        low_x, high_x = max(min_x, self.origin_x), min(max_x, grid_max_x)
+        low_y, high_y = max(min_y, self.origin_y), min(max_y, grid_max_y)
+        if self.num_points == 0 or not (low_x <= high_x and low_y <= high_y):
+            return np.zeros(0, dtype=np.int64)
+
+        cell_x, cell_y = self._cells(
+            np.array([low_x, high_x]), np.array([low_y, high_y])
+        )
+        cell_x = np.minimum(cell_x, self.num_cols - 1)
+        cell_y = np.minimum(cell_y, self.num_rows - 1)
+        row_keys = np.arange(cell_y[0], cell_y[1] + 1) * self.num_cols
+        first = np.searchsorted(self.cell_keys, row_keys + cell_x[0])
+        last = np.searchsorted(self.cell_keys, row_keys + cell_x[1], side="right")
+        has_cells = first < last
+        starts = self.cell_starts[first[has_cells]]
+        ends = self.cell_ends[last[has_cells] - 1]
+
+        _, rows = _expand_ranges(np.zeros(len(starts), dtype=np.int64), starts, ends)
+        inside = (
+            (self.x[rows] >= min_x)
+            & (self.x[rows] <= max_x)
+            & (self.y[rows] >= min_y)
+            & (self.y[rows] <= max_y)
+        )
+        return np.sort(self.order[rows[inside]])
+
+    def _rings_holding(
+        self, cell_x: np.ndarray, cell_y: np.ndarray, k: int, last_ring: np.ndarray
+    ) -> np.ndarray:
+        """
+        Number of rings of cells around every query point that hold k points, or
+        `last_ring` if there are fewer.
+
+        The rings are doubled until they hold k points and then bisected, so a query
+        point far from the points needs a few counts rather than one per ring.
+        """
+        # The answer of every query point is between low and high
+        low = np.zeros(len(cell_x), dtype=np.int64)
+        high = last_ring.copy()
+        probe = np.zeros(len(cell_x), dtype=np.int64)
+        active = np.arange(len(cell_x))
+        while len(active):
+            counts = self._count_square(cell_x[active], cell_y[active], probe[active])
+            holds = counts >= k
+            high[active[holds]] = probe[active[holds]]
+            low[active[~holds]] = probe[active[~holds]] + 1
+            active = active[~holds & (probe[active] < last_ring[active])]
+            probe[active] = np.minimum(
+                np.maximum(2 * probe[active], 1), last_ring[active]
+            )
+
+        active = np.flatnonzero(low < high)
+        while len(active):
+            middle = (low[active] + high[active]) // 2
+            holds = self._count_square(cell_x[active], cell_y[active], middle) >= k
+            high[active[holds]] = middle[holds]
+            low[active[~holds]] = middle[~holds] + 1
+            active = active[low[active] < high[active]]
+        return high
+
+    def _count_square(
+        self, cell_x: np.ndarray, cell_y: np.ndarray, rings: np.ndarray
+    ) -> np.ndarray:
+        """Number of points in the square of rings of cells around every cell."""
+        pairs, starts, ends = self._square_ranges(
+            cell_x, cell_y, np.full(len(cell_x), -1), rings
+        )
+        return np.bincount(pairs, weights=ends - starts, minlength=len(cell_x))
+
+    def _square_ranges(
+        self,
+        cell_x: np.ndarray,
+        cell_y: np.ndarray,
+        inner: np.ndarray,
+        outer: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Slices of the sorted points in the rings of cells after `inner` up to `outer`
+        around every cell, clipped to the grid.
+
+        The cells of a row of the grid are consecutive in the sorted points, so a row
+        of the square is at most two slices, left and right of the `inner` rings.
+        The work then grows with the rows of the square inside the grid, not with its
+        cells.
+
+        Returns:
+            Positions of the cells, and the starts and ends of their slices.
+        """
+        low_y = np.maximum(cell_y - outer, 0)
+        high_y = np.minimum(cell_y + outer, self.num_rows - 1)
+        heights = np.maximum(high_y - low_y + 1, 0)
+        pairs = np.repeat(np.arange(len(cell_x)), heights)
+        row = (
+            np.arange(len(pairs))
+            - np.repeat(np.cumsum(heights) - heights, heights)
+            + low_y[pairs]
+        )
+        low_x = np.maximum(cell_x - outer, 0)[pairs]
+        high_x = np.minimum(cell_x + outer, self.num_cols - 1)[pairs]
+        # Rows that cross the inner square skip its columns
+        crosses = np.abs(row - cell_y[pairs]) <= inner[pairs]
+        left_end = np.where(
+            crosses, np.minimum(high_x, cell_x[pairs] - inner[pairs] - 1), high_x
+        )
+        right_start = np.where(
+            crosses, np.maximum(low_x, cell_x[pairs] + inner[pairs] + 1), high_x + 1
+        )
+
+        first_x = np.concatenate([low_x, right_start])
+        last_x = np.concatenate([left_end, high_x])
+        slices = np.flatnonzero(first_x <= last_x)
+        row_keys = np.tile(row, 2)[slices] * self.num_cols
+        first = np.searchsorted(self.cell_keys, row_keys + first_x[slices])
+        last = np.searchsorted(
+            self.cell_keys, row_keys + last_x[slices], side="right"
+        )
+        # Where the slice of every cell starts, and where the last one ends
+        bounds = np.append(self.cell_starts, self.num_points)
+        return np.tile(pairs, 2)[slices], bounds[first], bounds[last]
+
+    def _candidates(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        cell_x: np.ndarray,
+        cell_y: np.ndarray,
+        queries: np.ndarray,
+        inner: np.ndarray,
+        outer: np.ndarray,
+        limit: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Pair the query points with the points of the rings of cells after `inner` up
+        to `outer` around them, within `limit`.
+
+        Returns:
+            Positions of the query points in `queries`, indices of the points and
+            their distances.
+        """
+        inner = np.broadcast_to(inner, queries.shape)
+        outer = np.broadcast_to(outer, queries.shape)
+        limit = np.broadcast_to(limit, x.shape)[queries]
+        pair_queries, starts, ends = self._square_ranges(
+            cell_x[queries], cell_y[queries], inner, outer
+        )
+
+        pair_queries, rows = _expand_ranges(pair_queries, starts, ends)
+        dists = np.hypot(
+            self.x[rows] - x[queries][pair_queries],
+            self.y[rows] - y[queries][pair_queries],
+        )
+        within = dists <= limit[pair_queries]
+        return pair_queries[within], self.order[rows[within]], dists[within]
+
+    def _cells(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Column and row of the cells of the points."""
+        return (
+            np.floor((x - self.origin_x) / self.cell_size).astype(np.int64),
+            np.floor((y - self.origin_y) / self.cell_size).astype(np.int64),
+        )
+
+
+def _default_cell_size(x: np.ndarray, y: np.ndarray) -> float:
+    """Side of the square cells that hold about two points each on average."""
+    if len(x) < 2:
+        return 1.0
+    area = (x.max() - x.min()) * (y.max() - y.min())
+    if area <= 0:
+        # The points are on a line, so spread them over cells along it
+        length = max(x.max() - x.min(), y.max() - y.min())
+        return length / len(x) * 2 if length > 0 else 1.0
+    return float(np.sqrt(area / len(x) * 2))
+
+
+def _expand_ranges(
+    queries: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Pair every query with each row of its [start, end) range."""
+    counts = ends - starts
+    total = counts.sum()
+    offsets = np.cumsum(counts) - counts
+    rows = np.arange(total) - np.repeat(offsets - starts, counts)
+    return np.repeat(queries, counts), rows
+
+
+def _k_smallest(
+    queries: np.ndarray,
+    rows: np.ndarray,
+    dists: np.ndarray,
+    num_queries: int,
+    k: int,
+    num_points: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pick the k candidates of every query with the smallest distances.
+
+    The candidates are sorted by query and row, then spread into a matrix with one
+    row per query, so the distances are sorted row by row rather than all at once.
+    """
+    nearest_rows = np.full((num_queries, k), -1, dtype=np.int64)
+    nearest_dists = np.full((num_queries, k), np.inf)
+    if len(queries) == 0:
+        return nearest_rows, nearest_dists
+
+    order = np.argsort(queries * num_points + rows)
+    queries, rows, dists = queries[order], rows[order], dists[order]
+    counts = np.bincount(queries, minlength=num_queries)
+    starts = np.cumsum(counts) - counts
+    positions = np.arange(len(queries)) - np.repeat(starts, counts)
+    width = int(counts.max())
+
+    # Sort a few million matrix cells at a time. The candidates are sorted by query,
+    # so the candidates of a chunk of queries are one slice.
+    chunk_size = max(1, (1 << 22) // width)
+    for chunk_start in range(0, num_queries, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_queries)
+        first, last = np.searchsorted(queries, [chunk_start, chunk_end])
+        matrix_index = (queries[first:last] - chunk_start, positions[first:last])
+        chunk_rows = np.full((chunk_end - chunk_start, width), -1, dtype=np.int64)
+        chunk_dists = np.full((chunk_end - chunk_start, width), np.inf)
+        chunk_rows[matrix_index] = rows[first:last]
+        chunk_dists[matrix_index] = dists[first:last]
+
+        # A stable sort keeps the candidates at the same distance in row order
+        nearest = np.argsort(chunk_dists, axis=1, kind="stable")[:, :k]
+        found = min(k, width)
+        nearest_rows[chunk_start:chunk_end, :found] = np.take_along_axis(
+            chunk_rows, nearest, axis=1
+        )
+        nearest_dists[chunk_start:chunk_end, :found] = np.take_along_axis(
+            chunk_dists, nearest, axis=1
+        )
+    return nearest_rows, nearest_dists
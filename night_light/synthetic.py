@@ -0,0 +1,184 @@
+import math
+import os
+from typing import Dict, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+## Generates synthetic cities for benchmarks. A city is a square grid of blocks with a
+## street segment along every block edge, crosswalks near both ends of every segment
+## and streetlights along the segments. Geometries are built with vectorized shapely
+## functions, so cities with millions of features take seconds to generate.
+
+# Average number of crosswalks and streetlights per street segment, see generate_city
+CROSSWALKS_PER_SEGMENT = 2 * 0.8
+STREETLIGHTS_PER_SEGMENT = 3 * 0.7
+
+
+def blocks_for_crosswalks(num_crosswalks: int) -> int:
+    """
+    Number of blocks per side of a city with about `num_crosswalks` crosswalks.
+
+    Args:
+        num_crosswalks: Target number of crosswalks.
+
+    Returns:
+        Blocks per side of the grid, at least 1.
+    """
+    # A grid of n x n blocks has 2n(n + 1) street segments
+    num_segments = num_crosswalks / CROSSWALKS_PER_SEGMENT
+    return max(1, round((-1 + math.sqrt(1 + 2 * num_segments)) / 2))
+
+
+def generate_city(
+    num_crosswalks: int = 1000,
+    block_size: float = 100,
+    oneway_share: float = 0.3,
+    seed: int = 0,
+    center: Tuple[float, float] = (-71.06, 42.35),
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Generate the crosswalks, streetlights and street segments of a synthetic city.
+
+    The city is a grid of square blocks around `center`, with densities close to
+    downtown Boston:
+
+    - Every block edge is a street segment; `oneway_share` of them are one-way
+      (`ONEWAY` is "FT", otherwise "TW").
+    - Each end of a segment has a crosswalk with a probability of 80%. Crosswalks are
+      12 m by 3 m rectangles rotated by up to 6 degrees, and 30% of them have an extra
+      vertex like hand-drawn polygons.
+    - Each segment has up to 3 streetlights within 8 m of the street.
+
+    Args:
+        num_crosswalks: Approximate number of crosswalks.
+        block_size: Width of a block, in meters.
+        oneway_share: Share of one-way street segments.
+        seed: Seed of the random generator.
+        center: Longitude and latitude of the south-west corner of the city.
+
+    Returns:
+        Dict[str, GeoDataFrame]: GeoDataFrames in EPSG:4326 keyed by table name:
+            "crosswalks", "streetlights" and "street_segments".
+    """
+    rng = np.random.default_rng(seed)
+    n = blocks_for_crosswalks(num_crosswalks)
+
+    # Street segments: vertical ones first, then horizontal ones
+    i, j = np.meshgrid(np.arange(n + 1), np.arange(n), indexing="ij")
+    i, j = i.ravel(), j.ravel()
+    start = np.concatenate(
+        [np.column_stack([i, j]), np.column_stack([j, i])]
+    ) * block_size
+    is_vertical = np.arange(len(start)) < len(i)
+    direction = np.where(is_vertical[:, None], [0.0, 1.0], [1.0, 0.0])
+    end = start + direction * block_size
+    num_segments = len(start)
+
+    # Crosswalks near both ends of every segment, across the street
+    offsets = np.array([8.0, block_size - 11.0])
+    anchor = (start[:, None, :] + direction[:, None, :] * offsets[None, :, None]).reshape(
+        -1, 2
+    )
+    anchor_vertical = np.repeat(is_vertical, 2)
+    keep = rng.random(len(anchor)) < 0.8
+    anchor, anchor_vertical = anchor[keep], anchor_vertical[keep]
+    num_cw = len(anchor)
+
+    # Rectangle corners in the frame of a vertical street, rotated for horizontal ones
+    corners = np.array([[-6.0, 0.0], [6.0, 0.0], [6.0, 3.0], [-6.0, 3.0]])
+    corners = np.where(
+        anchor_vertical[:, None, None], corners[None], corners[None][..., ::-1]
+    )
+    angle = rng.uniform(-0.1, 0.1, num_cw)
+    cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    rings = np.stack(
+        [
+            anchor[:, None, 0] + corners[..., 0] * cos - corners[..., 1] * sin,
+            anchor[:, None, 1] + corners[..., 0] * sin + corners[..., 1] * cos,
+        ],
+        axis=-1,
+    )
+    # Hand-drawn crosswalks get a fifth vertex bulging out of their second side
+    has_extra_vertex = rng.random(num_cw) < 0.3
+    extra = (rings[:, 1] + rings[:, 2]) / 2 + [0.3, 0.0]
+    five = np.concatenate(
+        [rings[:, :2], extra[:, None], rings[:, 2:]], axis=1
+    )[has_extra_vertex]
+    crosswalk_geoms = np.empty(num_cw, dtype=object)
+    crosswalk_geoms[~has_extra_vertex] = shapely.polygons(
+        _to_lon_lat(rings[~has_extra_vertex], center)
+    )
+    crosswalk_geoms[has_extra_vertex] = shapely.polygons(_to_lon_lat(five, center))
+
+    # Streetlights along every segment, jittered off the street
+    positions = np.array([0.15, 0.45, 0.75])
+    lights = (
+        start[:, None, :] + (end - start)[:, None, :] * positions[None, :, None]
+    ).reshape(-1, 2)
+    lights = lights[rng.random(len(lights)) < 0.7]
+    lights = lights + rng.uniform(-8, 8, lights.shape)
+
+    segments = np.stack([start, end], axis=1)
+    return {
+        "crosswalks": gpd.GeoDataFrame(
+            {"OBJECTID": np.arange(1, num_cw + 1)},
+            geometry=crosswalk_geoms,
+            crs="EPSG:4326",
+        ),
+        "streetlights": gpd.GeoDataFrame(
+            {"OBJECTID": np.arange(1, len(lights) + 1)},
+            geometry=shapely.points(_to_lon_lat(lights, center)),
+            crs="EPSG:4326",
+        ),
+        "street_segments": gpd.GeoDataFrame(
+            {
+                "OBJECTID": np.arange(1, num_segments + 1),
+                "ONEWAY": np.where(
+                    rng.random(num_segments) < oneway_share, "FT", "TW"
+                ),
+            },
+            geometry=shapely.linestrings(_to_lon_lat(segments, center)),
+            crs="EPSG:4326",
+        ),
+    }
+
+
+def write_city(
+    city: Dict[str, gpd.GeoDataFrame], output_dir: str, extension: str = ".parquet"
+) -> Dict[str, str]:
+    """
+    Write a synthetic city to one file per table.
+
+    Args:
+        city: GeoDataFrames keyed by table name, see `generate_city`.
+        output_dir: Directory of the files. Created if it does not exist.
+        extension: ".parquet" for GeoParquet, or any extension GeoPandas can write,
+            e.g. ".geojson".
+
+    Returns:
+        Dict[str, str]: Path of the file of every table.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for table_name, gdf in city.items():
+        paths[table_name] = os.path.join(output_dir, f"{table_name}{extension}")
+        if extension == ".parquet":
+            gdf.to_parquet(paths[table_name])
+        else:
+            gdf.to_file(paths[table_name])
+    return paths
+
+
+def _to_lon_lat(coords: np.ndarray, center: Tuple[float, float]) -> np.ndarray:
+    """Convert coordinates in meters from `center` to longitude and latitude."""
+    longitude, latitude = center
+    meters_per_degree = 111320
+    scale = np.array(
+        [
+            1 / (meters_per_degree * math.cos(math.radians(latitude))),
+            1 / meters_per_degree,
+        ]
+    )
+    return np.asarray([longitude, latitude]) + coords * scale
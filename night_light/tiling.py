@@ -0,0 +1,317 @@
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+
+import duckdb
+
+from night_light.analyzer import (
+    calculate_contrast,
+    calculate_percieved_brightness,
+    classify_edges_by_intersection,
+    create_crosswalk_centers_lights,
+    decompose_crosswalk_edges,
+    find_crosswalk_centers,
+    find_streetlights_crosswalk_centers,
+    identify_vehicle_direction,
+    simplify_crosswalk_polygon_to_box,
+)
+from night_light.util_duckdb import (
+    ConnectionProfile,
+    connect_to_duckdb,
+    load_multiple_datasets,
+    project_to_local_crs,
+)
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
+
+## Runs the analyzer over large study areas by splitting the crosswalks into square
+## tiles and processing every tile in its own process with its own DuckDB connection.
+## Each tile also receives the streets and streetlights in a halo around it, so the
+## results match a single run over the whole area.
+
+INPUT_TABLES = ["crosswalks", "streetlights", "street_segments"]
+RESULT_TABLES = [
+    "crosswalk_segments",
+    "crosswalk_centers",
+    "crosswalk_centers_lights",
+    "classified_streetlights",
+    "crosswalk_centers_heuristics",
+    "crosswalk_centers_contrast",
+]
+
+
+def run_tiled_pipeline(
+    con: duckdb.DuckDBPyConnection,
+    datasets: List[Tuple[Union[str, "GeoDataFrame"], str]],
+    tile_size: float = 5000,
+    dist: float = 20,
+    threshold: float = 0.01,
+    max_workers: Optional[int] = None,
+    threads_per_worker: int = 1,
+    memory_limit: Optional[str] = None,
+) -> int:
+    """
+    Run the analyzer steps tile by tile in a pool of worker processes.
+
+    The datasets are loaded into `con` and projected to the local UTM zone, so tiles
+    are measured in meters. Every crosswalk belongs to the tile that contains its
+    centroid. A tile's worker gets its crosswalks plus the streets and streetlights
+    within a halo of the search distance and the largest crosswalk size, and writes its
+    results to parquet. The results are then merged into the tables of `con`. Since
+    every crosswalk is processed by exactly one tile, the merged tables contain each
+    crosswalk once.
+
+    Args:
+        con: Connection to the DuckDB database that receives the merged results.
+        datasets: List of (data_source, table_name) tuples, see
+            `load_multiple_datasets`.
+        tile_size: Width of the square tiles, in meters.
+        dist: Meters to search for streetlights near each crosswalk center.
+        threshold: Threshold of the contrast heuristic classification.
+        max_workers: Number of worker processes. Default is the number of CPUs.
+        threads_per_worker: DuckDB threads of each worker's connection.
+        memory_limit: DuckDB memory limit of each worker's connection, e.g. "2GB".
+            Default is DuckDB's default.
+
+    Returns:
+        Number of tiles that were processed.
+    """
+    for _, table_name in datasets:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    con.execute("DROP TABLE IF EXISTS pipeline_crs")
+    load_multiple_datasets(con, datasets)
+    crs = project_to_local_crs(con, [table_name for _, table_name in datasets])
+    simplify_crosswalk_polygon_to_box(con)
+
+    work_dir = tempfile.mkdtemp(prefix="night_light_tiles_")
+    try:
+        tile_ids = _write_tile_inputs(con, work_dir, tile_size, dist)
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(
+                ConnectionProfile(
+                    threads=threads_per_worker, memory_limit=memory_limit
+                ),
+            ),
+        ) as executor:
+            # list() re-raises the first exception of a worker
+            list(
+                executor.map(
+                    _run_tile,
+                    [os.path.join(work_dir, "inputs") for _ in tile_ids],
+                    [os.path.join(work_dir, "results") for _ in tile_ids],
+                    tile_ids,
+                    [crs] * len(tile_ids),
+                    [dist] * len(tile_ids),
+                    [threshold] * len(tile_ids),
+                )
+            )
+        _merge_tile_results(con, os.path.join(work_dir, "results"), dist, threshold)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # The tables no longer come from run_pipeline, so its checkpoints are stale
+    con.execute("DROP TABLE IF EXISTS pipeline_state")
+    return len(tile_ids)
+
+
+def _write_tile_inputs(
+    con: duckdb.DuckDBPyConnection, work_dir: str, tile_size: float, dist: float
+) -> List[int]:
+    """
+    Split the input tables into per-tile parquet files.
+
+    Every input table is written once with `PARTITION_BY`, to
+    `<work_dir>/inputs/<table>/tile_id=<id>/`, along with an empty
+    `<table>_schema.parquet` file that lets workers create empty tables.
+
+    Returns:
+        IDs of the tiles that contain at least one crosswalk.
+    """
+    # The halo must reach every streetlight within `dist` of a crosswalk center and
+    # every street crossing a crosswalk, wherever the crosswalk sits in the tile
+    max_crosswalk_size = con.execute(
+        """
+        SELECT COALESCE(MAX(GREATEST(
+            ST_XMax(geometry) - ST_XMin(geometry),
+            ST_YMax(geometry) - ST_YMin(geometry)
+        )), 0)
+        FROM crosswalks
+        """
+    ).fetchone()[0]
+    halo = dist + max_crosswalk_size
+
+    con.execute(
+        """
+        CREATE OR REPLACE TEMP TABLE crosswalk_tiles AS
+        SELECT
+            OBJECTID AS crosswalk_id,
+            DENSE_RANK() OVER (ORDER BY tile_x, tile_y) AS tile_id,
+            tile_x,
+            tile_y
+        FROM (
+            SELECT
+                OBJECTID,
+                CAST(FLOOR(ST_X(ST_Centroid(geometry)) / $tile_size) AS BIGINT) AS tile_x,
+                CAST(FLOOR(ST_Y(ST_Centroid(geometry)) / $tile_size) AS BIGINT) AS tile_y
+            FROM crosswalks
+        )
+        """,
+        {"tile_size": tile_size},
+    )
+    con.execute(
+        """
+        CREATE OR REPLACE TEMP TABLE tiles AS
+        SELECT DISTINCT
+            tile_id,
+            ST_MakeEnvelope(
+                tile_x * $tile_size - $halo,
+                tile_y * $tile_size - $halo,
+                (tile_x + 1) * $tile_size + $halo,
+                (tile_y + 1) * $tile_size + $halo
+            ) AS halo_geom
+        FROM crosswalk_tiles
+        """,
+        {"tile_size": tile_size, "halo": halo},
+    )
+
+    queries = {
+        "crosswalks": """
+            SELECT t.tile_id, cw.*
+            FROM crosswalks cw
+            JOIN crosswalk_tiles t ON t.crosswalk_id = cw.OBJECTID
+        """,
+        "streetlights": """
+            SELECT t.tile_id, s.*
+            FROM streetlights s
+            JOIN tiles t ON ST_Intersects(s.geometry, t.halo_geom)
+        """,
+        "street_segments": """
+            SELECT t.tile_id, s.*
+            FROM street_segments s
+            JOIN tiles t ON ST_Intersects(s.geometry, t.halo_geom)
+        """,
+    }
+    for table_name, query in queries.items():
+        table_dir = os.path.join(work_dir, "inputs", table_name)
+        os.makedirs(table_dir)
+        con.execute(
+            f"""
+            COPY ({query}) TO '{table_dir}'
+            (FORMAT PARQUET, PARTITION_BY (tile_id))
+            """
+        )
+        con.execute(
+            f"""
+            COPY (SELECT * FROM {table_name} LIMIT 0)
+            TO '{os.path.join(work_dir, "inputs", f"{table_name}_schema.parquet")}'
+            (FORMAT PARQUET)
+            """
+        )
+
+    tile_ids = [
+        row[0]
+        for row in con.execute("SELECT tile_id FROM tiles ORDER BY tile_id").fetchall()
+    ]
+    con.execute("DROP TABLE crosswalk_tiles; DROP TABLE tiles;")
+    return tile_ids
+
+
+# Connection of a worker process, shared by the tiles it processes
+_worker_con = None
+
+
+def _init_worker(profile: ConnectionProfile):
+    """Open the DuckDB connection of a worker process."""
+    global _worker_con
+    # Loading the spatial extension takes about a second, so it is done once per
+    # process rather than once per tile
+    _worker_con = connect_to_duckdb(":memory:", profile)
+
+
+def _run_analyzer_steps(con: duckdb.DuckDBPyConnection, dist: float, threshold: float):
+    """Run the analyzer steps that follow the crosswalk simplification."""
+    decompose_crosswalk_edges(con)
+    classify_edges_by_intersection(con)
+    find_crosswalk_centers(con)
+    identify_vehicle_direction(con)
+    create_crosswalk_centers_lights(con)
+    find_streetlights_crosswalk_centers(con, dist)
+    calculate_contrast(con, threshold)
+    calculate_percieved_brightness(con)
+
+
+def _run_tile(
+    input_dir: str,
+    result_dir: str,
+    tile_id: int,
+    crs: str,
+    dist: float,
+    threshold: float,
+):
+    """Run the analyzer steps on one tile in a fresh in-memory database."""
+    con = _worker_con
+    con.execute(f"ATTACH ':memory:' AS tile_{tile_id}")
+    con.execute(f"USE tile_{tile_id}")
+    try:
+        con.execute("CREATE TABLE pipeline_crs AS SELECT ? AS crs", [crs])
+        for table_name in INPUT_TABLES:
+            files = glob.glob(
+                os.path.join(input_dir, table_name, f"tile_id={tile_id}", "*.parquet")
+            )
+            files.append(os.path.join(input_dir, f"{table_name}_schema.parquet"))
+            con.execute(
+                f"""
+                CREATE TABLE {table_name} AS
+                SELECT * FROM read_parquet(
+                    $files, hive_partitioning = false, union_by_name = true
+                )
+                """,
+                {"files": files},
+            )
+
+        _run_analyzer_steps(con, dist, threshold)
+        for table_name in RESULT_TABLES:
+            table_dir = os.path.join(result_dir, table_name)
+            os.makedirs(table_dir, exist_ok=True)
+            con.execute(
+                f"""
+                COPY {table_name}
+                TO '{os.path.join(table_dir, f"tile_{tile_id}.parquet")}'
+                (FORMAT PARQUET)
+                """
+            )
+    finally:
+        con.execute("USE memory")
+        con.execute(f"DETACH DATABASE tile_{tile_id}")
+
+
+def _merge_tile_results(
+    con: duckdb.DuckDBPyConnection, result_dir: str, dist: float, threshold: float
+):
+    """
+    Combine the results of every tile into the tables of `con`.
+
+    Without crosswalks there is no tile and no result file to read, so the steps run
+    on the empty tables of `con` instead, which creates empty result tables.
+    """
+    if not glob.glob(os.path.join(result_dir, "*", "*.parquet")):
+        _run_analyzer_steps(con, dist, threshold)
+        return
+    for table_name in RESULT_TABLES:
+        con.execute(
+            f"""
+            CREATE OR REPLACE TABLE {table_name} AS
+            SELECT * FROM read_parquet($path, union_by_name = true)
+            ORDER BY crosswalk_id
+            """,
+            {"path": os.path.join(result_dir, table_name, "*.parquet")},
+        )
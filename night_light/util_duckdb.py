@@ -1,43 +1,214 @@
-import inspect
+import functools
+import json
 import os
+import queue
+import sys
 import duckdb
-import geopandas as gpd
-from geopandas import GeoDataFrame
-from typing import List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
-from pandas import DataFrame
+from night_light.profiling import in_current_span, profiled
 
+# geopandas and pandas take most of the import time of the package, so they are
+# imported by the functions that need them, and commands that only run SQL never load
+# them
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from geopandas import GeoDataFrame
+    from pandas import DataFrame
 
-def connect_to_duckdb(db_path: str) -> duckdb.DuckDBPyConnection:
+# Rows per row group of spatially sorted parquet files. Each group then covers a
+# neighborhood of a city, so small area queries read a few groups, while groups stay
+# large enough to compress well
+SPATIAL_ROW_GROUP_SIZE = 16384
+
+
+@dataclass(frozen=True)
+class ConnectionProfile:
+    """
+    Settings of a DuckDB connection. Settings left as None keep DuckDB's defaults.
+
+    Attributes:
+        threads: Number of threads DuckDB runs queries with.
+        memory_limit: Memory DuckDB may use before spilling to disk, e.g. "4GB".
+        temp_directory: Directory DuckDB spills to when a query exceeds the memory
+            limit.
+        preserve_insertion_order: Whether query results keep the order rows were
+            inserted in. Turning it off lets large queries use less memory.
+        extension_directory: Directory DuckDB installs and loads extensions from.
+        offline: Never download the spatial extension; it must already be installed
+            in `extension_directory`.
+        read_only: Open the database file read-only, so several processes can read
+            it at once.
+    """
+
+    threads: Optional[int] = None
+    memory_limit: Optional[str] = None
+    temp_directory: Optional[str] = None
+    preserve_insertion_order: Optional[bool] = None
+    extension_directory: Optional[str] = None
+    offline: bool = False
+    read_only: bool = False
+
+    def config(self) -> Dict[str, Any]:
+        """
+        DuckDB configuration of the profile.
+
+        Returns:
+            Dict[str, Any]: Options for `duckdb.connect`.
+        """
+        config = {
+            "threads": self.threads,
+            "memory_limit": self.memory_limit,
+            "temp_directory": self.temp_directory,
+            "preserve_insertion_order": self.preserve_insertion_order,
+            "extension_directory": self.extension_directory,
+        }
+        config = {name: value for name, value in config.items() if value is not None}
+        if self.offline:
+            config["autoinstall_known_extensions"] = False
+        if self.read_only:
+            config["access_mode"] = "READ_ONLY"
+        return config
+
+
+def connect_to_duckdb(
+    db_path: str = ":memory:", profile: Optional[ConnectionProfile] = None
+) -> duckdb.DuckDBPyConnection:
     """
     Establish a connection to a DuckDB database and load the spatial extension.
 
+    The spatial extension is installed only if loading it fails.
+
     Args:
-        db_path (str): Path to the DuckDB database file.
+        db_path (str): Path to the DuckDB database file, or ":memory:" for an
+            in-memory database. Default is ":memory:".
+        profile (Optional[ConnectionProfile]): Settings of the connection. Default
+            is DuckDB's defaults.
 
     Returns:
         duckdb.DuckDBPyConnection: Connection to the DuckDB database.
     """
-    con = duckdb.connect(db_path)
-    is_spatial_installed = con.execute(
-        """SELECT EXISTS (
-        SELECT 1
-        FROM duckdb_extensions()
-        WHERE extension_name = 'spatial' AND installed
-        )
-        """
-    ).fetchone()[0]
-    if not is_spatial_installed:
+    profile = profile or ConnectionProfile()
+    con = duckdb.connect(db_path, config=profile.config())
+    try:
+        con.load_extension("spatial")
+    except duckdb.IOException:
+        if profile.offline:
+            raise RuntimeError(
+                "The spatial extension is not installed in "
+                f"{profile.extension_directory or 'the default extension directory'}. "
+                "Connect once with offline=False to install it."
+            )
         con.install_extension("spatial")
-    con.load_extension("spatial")
+        con.load_extension("spatial")
     return con
 
 
+class ConnectionPool:
+    """
+    Fixed set of read-only connections to a DuckDB database, shared by threads.
+
+    The connections are cursors of one database instance, so the spatial extension is
+    loaded once and they share DuckDB's buffer cache.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        size: int = 4,
+        profile: Optional[ConnectionProfile] = None,
+    ):
+        """
+        Open the connections.
+
+        Args:
+            db_path (str): Path to the DuckDB database file.
+            size (int): Number of connections, i.e. of queries that run at once.
+            profile (Optional[ConnectionProfile]): Settings of the connections. The
+                database is always opened read-only.
+        """
+        profile = replace(profile or ConnectionProfile(), read_only=True)
+        self._con = connect_to_duckdb(db_path, profile)
+        self._cursors = queue.Queue()
+        for _ in range(size):
+            self._cursors.put(self._con.cursor())
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection, waiting until one is free.
+
+        Yields:
+            duckdb.DuckDBPyConnection: The connection, returned to the pool on exit.
+        """
+        cursor = self._cursors.get()
+        try:
+            yield cursor
+        finally:
+            self._cursors.put(cursor)
+
+    def close(self):
+        """Close every connection of the pool."""
+        while not self._cursors.empty():
+            self._cursors.get().close()
+        self._con.close()
+
+
+@profiled
+def persist_tables(
+    con: duckdb.DuckDBPyConnection,
+    db_path: str,
+    table_names: Optional[List[str]] = None,
+):
+    """
+    Copy tables into a DuckDB database file.
+
+    Lets a run work in an in-memory database and write its results to disk only at
+    the end. The file is attached for the copy and detached afterwards; existing
+    tables with the same names are replaced.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        db_path (str): Path to the DuckDB database file. Created if it does not
+            exist.
+        table_names (Optional[List[str]]): Names of the tables to copy. Default is
+            every table of the current database.
+    """
+    if table_names is None:
+        table_names = [
+            row[0]
+            for row in con.execute(
+                """
+                SELECT table_name FROM duckdb_tables()
+                WHERE database_name = current_database()
+                AND schema_name = current_schema()
+                AND NOT temporary
+                ORDER BY table_name
+                """
+            ).fetchall()
+        ]
+    escaped_path = db_path.replace("'", "''")
+    con.execute(f"ATTACH '{escaped_path}' AS persisted_results")
+    try:
+        for table_name in table_names:
+            con.execute(
+                f"""
+                CREATE OR REPLACE TABLE persisted_results.{table_name} AS
+                SELECT * FROM {table_name}
+                """
+            )
+    finally:
+        con.execute("DETACH persisted_results")
+
+
 def _query_table_to_df(
     con: duckdb.DuckDBPyConnection,
     table_name: str,
     query: str = None,
-) -> DataFrame:
+) -> "DataFrame":
     """
     Query a DuckDB table and return the results as a pandas DataFrame.
 
@@ -51,17 +222,90 @@ def _query_table_to_df(
     """
     if query is None:
         query = "SELECT * FROM {table_name} LIMIT 10".format(table_name=table_name)
-    return con.execute(query).fetchdf()
+    return con.execute(
+        _export_geometry_query(con, query, source_crs=get_local_crs(con))
+    ).fetchdf()
+
 
+def _geometry_columns(con: duckdb.DuckDBPyConnection, query: str) -> List[str]:
+    """
+    Find the columns of a query result that are native GEOMETRY columns.
 
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        query (str): SQL query whose result columns are inspected.
+
+    Returns:
+        List[str]: Names of the GEOMETRY columns.
+    """
+    rel = con.sql(query)
+    return [
+        column
+        for column, column_type in zip(rel.columns, rel.types)
+        if str(column_type) == "GEOMETRY"
+    ]
+
+
+def _export_geometry_query(
+    con: duckdb.DuckDBPyConnection,
+    query: str,
+    wkb_columns: List[str] = (),
+    source_crs: Optional[str] = None,
+    native_columns: List[str] = (),
+) -> str:
+    """
+    Wrap a query so that its GEOMETRY columns are converted for export.
+
+    Geometries are stored natively inside DuckDB and are only converted to text
+    when they leave the database. By default every GEOMETRY column becomes a WKT
+    string.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        query (str): SQL query to wrap.
+        wkb_columns (List[str]): GEOMETRY columns to export as WKB instead of WKT.
+        source_crs (Optional[str]): CRS of the geometries. If given, they are
+            reprojected to EPSG:4326 before being converted.
+        native_columns (List[str]): GEOMETRY columns to keep as GEOMETRY, e.g. for
+            writers that encode geometries themselves.
+
+    Returns:
+        str: SQL query with every GEOMETRY column converted.
+    """
+    query = query.strip().rstrip(";")
+    geometry_columns = _geometry_columns(con, query)
+    if not geometry_columns:
+        return query
+    replacements = []
+    for column in geometry_columns:
+        expression = f'"{column}"'
+        if source_crs is not None:
+            expression = (
+                f"ST_Transform({expression}, '{source_crs}', 'EPSG:4326', "
+                "always_xy := true)"
+            )
+        if column in wkb_columns:
+            expression = f"ST_AsWKB({expression})"
+        elif column not in native_columns:
+            expression = f"ST_AsText({expression})"
+        replacements.append(f'{expression} AS "{column}"')
+    replacements = ", ".join(replacements)
+    return f"SELECT * REPLACE ({replacements}) FROM ({query})"
+
+
+@profiled
 def query_table_to_gdf(
     con: duckdb.DuckDBPyConnection,
     table_name: str,
     query: str = None,
-) -> GeoDataFrame:
+) -> "GeoDataFrame":
     """
     Query a DuckDB table and return the results as a GeoPandas DataFrame.
 
+    The GeoDataFrame is in the CRS the tables are stored in, see `get_local_crs`.
+    Only the `geometry` column is decoded; other GEOMETRY columns are returned as WKT
+    strings. See `read_table_to_gdf` to read whole tables faster.
+
     Args:
         con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
         table_name (str): Name of the table to query.
@@ -70,73 +314,459 @@ def query_table_to_gdf(
     Returns:
         GeoDataFrame: Results of the query.
     """
-    df = _query_table_to_df(con, table_name, query)
+    import geopandas as gpd
+
+    if query is None:
+        query = "SELECT * FROM {table_name} LIMIT 10".format(table_name=table_name)
+    crs = get_local_crs(con) or "EPSG:4326"
+    if "geometry" in _geometry_columns(con, query):
+        return _arrow_to_gdf(
+            con.execute(
+                _export_geometry_query(con, query, wkb_columns=["geometry"])
+            ).arrow(),
+            ["geometry"],
+            crs,
+        )
+
+    df = con.execute(_export_geometry_query(con, query)).fetchdf()
     if "geometry" in df:
-        # Assume that the geometry column is in WKT format, NOT in geometry objects
+        # Tables from older databases store the geometry column as WKT text
         df["geometry"] = gpd.GeoSeries.from_wkt(df["geometry"])
-    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
+    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs=crs)
     return gdf
 
 
+@profiled
+def read_table_to_gdf(
+    con: duckdb.DuckDBPyConnection,
+    table_name: str,
+    columns: Optional[List[str]] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    bbox_crs: Optional[str] = None,
+) -> "GeoDataFrame":
+    """
+    Read a DuckDB table, or part of it, into a GeoDataFrame through Arrow.
+
+    Every GEOMETRY column leaves DuckDB as WKB in an Arrow table and is decoded
+    with GeoArrow, so no geometry is ever converted to text, and every one becomes
+    a GeoSeries. The columns and the bounding box are applied in SQL, so only the
+    requested rows and columns are transferred.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        table_name (str): Name of the table to read.
+        columns (Optional[List[str]]): Columns to read. The `geometry` column is
+            always read. Default is every column.
+        bbox (Optional[Tuple[float, float, float, float]]): Only read the rows whose
+            geometry's bounding box intersects (minx, miny, maxx, maxy).
+        bbox_crs (Optional[str]): CRS of `bbox`, e.g. "EPSG:4326" for longitudes
+            and latitudes. Default is the CRS the tables are stored in.
+
+    Returns:
+        GeoDataFrame: Rows of the table, in the CRS the tables are stored in, see
+            `get_local_crs`.
+    """
+    relation = con.table(table_name)
+    column_types = dict(zip(relation.columns, map(str, relation.types)))
+    if "geometry" not in column_types:
+        raise ValueError(f"Table '{table_name}' has no geometry column.")
+    if columns is None:
+        columns = list(column_types)
+    elif "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+    missing = [column for column in columns if column not in column_types]
+    if missing:
+        raise ValueError(f"Table '{table_name}' has no columns {missing}.")
+
+    def native(column: str) -> str:
+        # Tables from older databases store the geometry column as WKT text
+        if column_types[column] == "VARCHAR":
+            return f'ST_GeomFromText("{column}")'
+        return f'"{column}"'
+
+    wkb_columns = [
+        column
+        for column in columns
+        if column_types[column] == "GEOMETRY" or column == "geometry"
+    ]
+    select = ", ".join(
+        f'ST_AsWKB({native(column)}) AS "{column}"'
+        if column in wkb_columns
+        else f'"{column}"'
+        for column in columns
+    )
+    query = f"SELECT {select} FROM {table_name}"
+    params = []
+    crs = get_local_crs(con) or "EPSG:4326"
+    if bbox is not None:
+        envelope = "ST_MakeEnvelope(?, ?, ?, ?)"
+        if bbox_crs is not None and bbox_crs != crs:
+            envelope = (
+                f"ST_Transform({envelope}, '{bbox_crs}', '{crs}', always_xy := true)"
+            )
+        query += f" WHERE ST_Intersects_Extent({native('geometry')}, {envelope})"
+        params = list(bbox)
+
+    return _arrow_to_gdf(con.execute(query, params).arrow(), wkb_columns, crs)
+
+
+def _arrow_to_gdf(
+    table: "pa.Table", wkb_columns: List[str], crs: str
+) -> "GeoDataFrame":
+    """
+    Build a GeoDataFrame from an Arrow table with WKB geometry columns.
+
+    The WKB columns are tagged as GeoArrow WKB, so GeoPandas decodes each one with a
+    single vectorized call, without going through pandas objects first.
+
+    Args:
+        table (pa.Table): Query result with the WKB columns as binary columns.
+        wkb_columns (List[str]): Columns to decode, including `geometry`.
+        crs (str): CRS of the geometries.
+
+    Returns:
+        GeoDataFrame: The table, with `geometry` as its active geometry column.
+    """
+    import geopandas as gpd
+    import pyarrow as pa
+
+    metadata = {
+        b"ARROW:extension:name": b"geoarrow.wkb",
+        b"ARROW:extension:metadata": json.dumps({"crs": crs}).encode(),
+    }
+    schema = pa.schema(
+        [
+            field.with_metadata(metadata) if field.name in wkb_columns else field
+            for field in table.schema
+        ]
+    )
+    return gpd.GeoDataFrame.from_arrow(
+        pa.Table.from_arrays(table.columns, schema=schema), geometry="geometry"
+    )
+
+
+def is_geodataframe(data_source: Any) -> bool:
+    """
+    Check whether a data source is a GeoDataFrame without importing geopandas.
+
+    A GeoDataFrame can only exist once geopandas has been imported, so data sources
+    given as file paths never load it.
+
+    Args:
+        data_source (Any): File path or GeoDataFrame.
+
+    Returns:
+        bool: True if the data source is a GeoDataFrame.
+    """
+    geopandas = sys.modules.get("geopandas")
+    return geopandas is not None and isinstance(data_source, geopandas.GeoDataFrame)
+
+
+def table_exists(con: duckdb.DuckDBPyConnection, table_name: str) -> bool:
+    """
+    Check whether a table exists in the current database and schema.
+
+    Tables of other attached databases with the same name are ignored.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        table_name (str): Name of the table.
+
+    Returns:
+        bool: True if the table exists.
+    """
+    return (
+        con.execute(
+            """
+            SELECT 1
+            FROM duckdb_tables()
+            WHERE database_name = current_database()
+            AND schema_name = current_schema()
+            AND table_name = ?
+            """,
+            [table_name],
+        ).fetchone()
+        is not None
+    )
+
+
+@profiled
 def load_data_to_table(
     con: duckdb.DuckDBPyConnection,
-    data_source: Union[str, GeoDataFrame],
+    data_source: Union[str, "GeoDataFrame"],
     table_name: str,
 ) -> None:
     """
-    Load GeoJSON or GeoDataFrame into DuckDB.
+    Load a spatial file or GeoDataFrame into DuckDB.
+
+    Files are streamed straight into the table by DuckDB: GeoParquet with
+    `read_parquet`, and GeoJSON, FlatGeobuf and every other GDAL format with
+    `ST_Read`. The data never goes through pandas, so memory use does not grow with
+    the size of the file.
+
+    The geometry column is stored as a native GEOMETRY column. Geometries are only
+    converted to WKT when a table is exported.
 
     Args:
         con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
-        data_source (Union[str, GeoDataFrame]): Path to a GeoJSON file or a
-            GeoDataFrame.
+        data_source (Union[str, GeoDataFrame]): Path to a GeoJSON, GeoParquet or
+            FlatGeobuf file, or a GeoDataFrame.
         table_name (str): Name of the target table.
     """
-    if con.execute(
-        f"SELECT 1 FROM information_schema.tables WHERE table_name = '{table_name}'"
-    ).fetchone():
+    if table_exists(con, table_name):
         print(f"Table '{table_name}' already exists. Skipping data load.")
+        _ensure_native_geometry(con, table_name)
         return
 
-    gdf = (
-        gpd.read_file(data_source)
-        if isinstance(data_source, str) and os.path.isfile(data_source)
-        else data_source
-    )
-    if not isinstance(gdf, gpd.GeoDataFrame):
+    if isinstance(data_source, str) and os.path.isfile(data_source):
+        _stream_file_to_table(con, data_source, table_name)
+        return
+    gdf = data_source
+    if not is_geodataframe(gdf):
         raise ValueError(
-            "data_source must be a valid GeoJSON file path or GeoDataFrame."
+            "data_source must be a valid spatial file path or GeoDataFrame."
+        )
+    from pandas import DataFrame
+
+    # Convert geometry to WKB so DuckDB can store it as a native GEOMETRY column
+    has_geometry = "geometry" in gdf
+    df = gdf.to_wkb() if has_geometry else DataFrame(gdf)
+    df = df.astype(
+        {
+            col: "string"
+            for col in df.select_dtypes("object").columns
+            if col != "geometry"
+        }
+    )
+
+    con.register("temp_gdf", df)
+    if has_geometry:
+        con.execute(
+            f"""
+            CREATE TABLE {table_name} AS
+            SELECT * REPLACE (ST_GeomFromWKB(geometry) AS geometry) FROM temp_gdf
+            """
         )
+    else:
+        con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM temp_gdf")
+    con.unregister("temp_gdf")
+
 
-    # Convert geometry to WKT and ensure compatibility with DuckDB
-    if "geometry" in gdf:
-        gdf["geometry"] = gdf["geometry"].to_wkt()
-    gdf = gdf.astype({col: "string" for col in gdf.select_dtypes("object").columns})
+def _stream_file_to_table(
+    con: duckdb.DuckDBPyConnection, path: str, table_name: str
+) -> None:
+    """
+    Stream a spatial file into a new DuckDB table without loading it into Python.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        path (str): Path to a GeoParquet file or any file GDAL can read.
+        table_name (str): Name of the target table.
+    """
+    if path.lower().endswith((".parquet", ".geoparquet")):
+        reader = "read_parquet($path)"
+    else:
+        reader = "ST_Read($path)"
+
+    source = con.sql(f"SELECT * FROM {reader}", params={"path": path})
+    column_types = dict(zip(source.columns, map(str, source.types)))
+    # ST_Read names the geometry column "geom"; GeoParquet writers use "geometry"
+    geometry_column = next(
+        (column for column in ("geometry", "geom") if column in column_types), None
+    )
+    if geometry_column is None:
+        select = "*"
+    else:
+        geometry = f'"{geometry_column}"'
+        if column_types[geometry_column] != "GEOMETRY":
+            # Parquet files without GeoParquet metadata store plain WKB blobs
+            geometry = f"ST_GeomFromWKB({geometry})"
+        select = f'* EXCLUDE ("{geometry_column}"), {geometry} AS geometry'
+
+    con.execute(
+        f"CREATE TABLE {table_name} AS SELECT {select} FROM {reader}",
+        {"path": path},
+    )
 
-    con.register("temp_gdf", gdf)
-    con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM temp_gdf")
 
+def _ensure_native_geometry(con: duckdb.DuckDBPyConnection, table_name: str) -> None:
+    """
+    Convert a WKT `geometry` column left by an older database into a GEOMETRY column.
 
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        table_name (str): Name of the table to convert.
+    """
+    column_type = con.execute(
+        """
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_catalog = current_database()
+        AND table_schema = current_schema()
+        AND table_name = ?
+        AND column_name = 'geometry'
+        """,
+        [table_name],
+    ).fetchone()
+    if column_type and column_type[0] == "VARCHAR":
+        con.execute(
+            f"""
+            ALTER TABLE {table_name}
+            ALTER geometry TYPE GEOMETRY USING ST_GeomFromText(geometry)
+            """
+        )
+
+
+@profiled
 def load_multiple_datasets(
-    con: duckdb.DuckDBPyConnection, datasets: List[Tuple[Union[str, GeoDataFrame], str]]
+    con: duckdb.DuckDBPyConnection,
+    datasets: List[Tuple[Union[str, "GeoDataFrame"], str]],
 ) -> None:
     """
-    Load multiple GeoJSON files or GeoDataFrames into DuckDB.
+    Load multiple spatial files or GeoDataFrames into DuckDB.
 
     Args:
         con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
         datasets (List[Tuple[Union[str, GeoDataFrame], str]]): List of tuples where
             each tuple contains:
-            - data_source (Union[str, GeoDataFrame]): Path to a GeoJSON file or a
-            GeoDataFrame.
+            - data_source (Union[str, GeoDataFrame]): Path to a GeoJSON, GeoParquet
+            or FlatGeobuf file, or a GeoDataFrame.
             - table_name (str): Name of the target table.
     """
     for data_source, table_name in datasets:
         load_data_to_table(con, data_source, table_name)
 
 
+def get_local_crs(con: duckdb.DuckDBPyConnection) -> Optional[str]:
+    """
+    Get the projected CRS the tables of the database are stored in.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+
+    Returns:
+        Optional[str]: The projected CRS (e.g. "EPSG:32619"), or None if the tables
+            are still in EPSG:4326.
+    """
+    if not table_exists(con, "pipeline_crs"):
+        return None
+    row = con.execute("SELECT crs FROM pipeline_crs").fetchone()
+    return row[0] if row else None
+
+
+def find_local_crs(
+    con: duckdb.DuckDBPyConnection, table_name: str = "crosswalks"
+) -> str:
+    """
+    Pick the UTM zone that covers the center of a table's extent.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        table_name (str): Name of a table in EPSG:4326 whose extent is used.
+
+    Returns:
+        str: EPSG code of the UTM zone, e.g. "EPSG:32619" for Boston.
+    """
+    longitude, latitude = con.execute(
+        f"""
+        SELECT
+            (MIN(ST_XMin(geometry)) + MAX(ST_XMax(geometry))) / 2,
+            (MIN(ST_YMin(geometry)) + MAX(ST_YMax(geometry))) / 2
+        FROM {table_name}
+        """
+    ).fetchone()
+    zone = int((longitude + 180) // 6) % 60 + 1
+    return f"EPSG:{(32600 if latitude >= 0 else 32700) + zone}"
+
+
+@profiled
+def project_to_local_crs(
+    con: duckdb.DuckDBPyConnection, table_names: List[str], crs: str = None
+) -> str:
+    """
+    Project the input tables from EPSG:4326 to a local metric CRS.
+
+    The analyzers then work in meters with planar math, and geometries are only
+    reprojected back to EPSG:4326 when tables are exported. The CRS is recorded in
+    the `pipeline_crs` table, so projecting a database twice does nothing.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        table_names (List[str]): Names of the input tables to project.
+        crs (Optional[str]): Projected CRS to use. Default is the UTM zone of the
+            first table, see `find_local_crs`.
+
+    Returns:
+        str: The CRS the tables are stored in.
+    """
+    local_crs = get_local_crs(con)
+    if local_crs is not None:
+        print(f"Tables are already projected to {local_crs}. Skipping projection.")
+        return local_crs
+
+    crs = crs or find_local_crs(con, table_names[0])
+    for table_name in table_names:
+        con.execute(
+            f"""
+            UPDATE {table_name}
+            SET geometry = ST_Transform(geometry, 'EPSG:4326', ?, always_xy := true)
+            """,
+            [crs],
+        )
+    con.execute("CREATE OR REPLACE TABLE pipeline_crs AS SELECT ? AS crs", [crs])
+    return crs
+
+
+def _export_table_query(
+    con: duckdb.DuckDBPyConnection,
+    table_name: str,
+    columns: Optional[List[str]] = None,
+    native_columns: List[str] = (),
+) -> str:
+    """
+    Build the query that selects a table for export in EPSG:4326.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        table_name (str): Name of the table to export.
+        columns (Optional[List[str]]): Columns to export. Default is all columns.
+        native_columns (List[str]): GEOMETRY columns to keep as GEOMETRY; the other
+            GEOMETRY columns are exported as WKT.
+
+    Returns:
+        str: SQL query for the export.
+    """
+    select = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+    return _export_geometry_query(
+        con,
+        f"SELECT {select} FROM {table_name}",
+        source_crs=get_local_crs(con),
+        native_columns=native_columns,
+    )
+
+
+def _copy_query_to_file(
+    con: duckdb.DuckDBPyConnection, query: str, filename: str, options: str
+) -> None:
+    """
+    Write the result of a query straight from DuckDB to a file with COPY.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        query (str): SQL query to write.
+        filename (str): Path to the output file.
+        options (str): Options of the COPY statement, e.g. "FORMAT PARQUET".
+    """
+    filename = filename.replace("'", "''")
+    con.execute(f"COPY ({query}) TO '{filename}' ({options})")
+
+
+@profiled
 def save_table_to_geojson(
-    con: duckdb.DuckDBPyConnection, table_name: str, filename: str
+    con: duckdb.DuckDBPyConnection,
+    table_name: str,
+    filename: str,
+    columns: Optional[List[str]] = None,
 ) -> None:
     """
     Save a DuckDB table to a GeoJSON file.
@@ -145,28 +775,113 @@ def save_table_to_geojson(
         con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
         table_name (str): Name of the table to save.
         filename (str): Path to the output GeoJSON file.
+        columns (Optional[List[str]]): Columns to save. Default is all columns.
     """
-    gdf = query_table_to_gdf(con, table_name, f"SELECT * FROM {table_name}")
-    gdf.to_file(filename, driver="GeoJSON")
+    query = _export_table_query(con, table_name, columns, native_columns=["geometry"])
+    # GDAL refuses to overwrite an existing GeoJSON file
+    if os.path.exists(filename):
+        os.remove(filename)
+    _copy_query_to_file(
+        con, query, filename, "FORMAT GDAL, DRIVER 'GeoJSON', SRS 'EPSG:4326'"
+    )
 
 
+@profiled
 def save_table_to_parquet(
-    con: duckdb.DuckDBPyConnection, table_name: str, filename: str
+    con: duckdb.DuckDBPyConnection,
+    table_name: str,
+    filename: str,
+    columns: Optional[List[str]] = None,
+    compression: str = "zstd",
+    row_group_size: Optional[int] = None,
+    spatial_sort: bool = False,
 ) -> None:
     """
     Save a DuckDB table to a parquet file.
 
+    The table is written directly by DuckDB. If it has a `geometry` column, the
+    file is a GeoParquet file with WKB geometries and `geo` metadata that GIS tools
+    and kepler.gl read without parsing text. Other GEOMETRY columns are written as
+    WKT strings.
+
+    With `spatial_sort`, the rows of a table with a `geometry` column are sorted
+    along a Hilbert curve over the extent of the geometries, and every row gets a
+    `bbox` struct column with the xmin, ymin, xmax and ymax of its geometry, like
+    the bounding box covering of GeoParquet 1.1. Every row group then covers a small
+    area, and readers that filter on `bbox` skip the other row groups by their
+    statistics.
+
     Args:
         con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
         table_name (str): Name of the table to save.
         filename (str): Path to the output parquet file.
+        columns (Optional[List[str]]): Columns to save. Default is all columns.
+        compression (str): Parquet compression codec, e.g. "zstd", "snappy" or
+            "uncompressed".
+        row_group_size (Optional[int]): Number of rows per row group. Default is
+            `SPATIAL_ROW_GROUP_SIZE` for spatially sorted files, and DuckDB's
+            default otherwise.
+        spatial_sort (bool): Whether to sort the rows by location and add the
+            `bbox` column. Off by default, since it changes the row order and the
+            columns of the file.
+    """
+    query = _export_table_query(con, table_name, columns, native_columns=["geometry"])
+    if spatial_sort and "geometry" in _geometry_columns(con, query):
+        query = _spatially_sorted_query(con, query)
+        if row_group_size is None:
+            row_group_size = SPATIAL_ROW_GROUP_SIZE
+    options = f"FORMAT PARQUET, COMPRESSION '{compression}'"
+    if row_group_size is not None:
+        options += f", ROW_GROUP_SIZE {int(row_group_size)}"
+    _copy_query_to_file(con, query, filename, options)
+
+
+def _spatially_sorted_query(con: duckdb.DuckDBPyConnection, query: str) -> str:
     """
-    df = _query_table_to_df(con, table_name, f"SELECT * FROM {table_name}")
-    df.to_parquet(filename)
+    Sort the rows of a query with a `geometry` column along a Hilbert curve, and add
+    the bounding box of every geometry as a `bbox` column.
 
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        query (str): SQL query to sort.
 
+    Returns:
+        str: SQL query of the sorted rows.
+    """
+    extent = con.execute(
+        f"SELECT ST_Extent(ST_Extent_Agg(geometry)) FROM ({query})"
+    ).fetchone()[0]
+    bbox = """
+        {
+            'xmin': ST_XMin(geometry),
+            'ymin': ST_YMin(geometry),
+            'xmax': ST_XMax(geometry),
+            'ymax': ST_YMax(geometry)
+        } AS bbox
+        """
+    if extent is None:
+        # Every geometry is NULL or empty, so there is nothing to sort by
+        return f"SELECT *, {bbox} FROM ({query})"
+    box = (
+        f"{{'min_x': {extent['min_x']!r}, 'min_y': {extent['min_y']!r}, "
+        f"'max_x': {extent['max_x']!r}, 'max_y': {extent['max_y']!r}}}::BOX_2D"
+    )
+    # ST_Hilbert rejects empty geometries, which sort last with the NULL ones
+    return f"""
+        SELECT *, {bbox}
+        FROM ({query})
+        ORDER BY CASE
+            WHEN NOT ST_IsEmpty(geometry) THEN ST_Hilbert(geometry, {box})
+        END
+        """
+
+
+@profiled
 def save_table_to_csv(
-    con: duckdb.DuckDBPyConnection, table_name: str, filename: str
+    con: duckdb.DuckDBPyConnection,
+    table_name: str,
+    filename: str,
+    columns: Optional[List[str]] = None,
 ) -> None:
     """
     Save a DuckDB table to a csv file.
@@ -175,9 +890,89 @@ def save_table_to_csv(
         con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
         table_name (str): Name of the table to save.
         filename (str): Path to the output csv file.
+        columns (Optional[List[str]]): Columns to save. Default is all columns.
+    """
+    query = _export_table_query(con, table_name, columns)
+    _copy_query_to_file(con, query, filename, "FORMAT CSV, HEADER")
+
+
+@profiled
+def save_tables(
+    con: duckdb.DuckDBPyConnection,
+    outputs: List[Tuple[str, str]],
+    max_workers: Optional[int] = None,
+    spatial_sort: bool = False,
+) -> None:
     """
-    df = _query_table_to_df(con, table_name, f"SELECT * FROM {table_name}")
-    df.to_csv(filename, index=False)
+    Save several DuckDB tables in parallel.
+
+    Every table is written on its own cursor. The format is picked from the file
+    extension: .parquet, .csv or .geojson.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        outputs (List[Tuple[str, str]]): List of tuples where each tuple contains:
+            - table_name (str): Name of the table to save.
+            - filename (str): Path to the output file.
+        max_workers (Optional[int]): Maximum number of tables written at once.
+            Default is one per table.
+        spatial_sort (bool): Whether to sort the parquet files by location, see
+            `save_table_to_parquet`.
+    """
+    writers = {
+        ".parquet": functools.partial(save_table_to_parquet, spatial_sort=spatial_sort),
+        ".csv": save_table_to_csv,
+        ".geojson": save_table_to_geojson,
+    }
+    for _, filename in outputs:
+        if os.path.splitext(filename)[1].lower() not in writers:
+            raise ValueError(f"Unsupported output file type: {filename}")
+
+    def save(output: Tuple[str, str]) -> None:
+        table_name, filename = output
+        writer = writers[os.path.splitext(filename)[1].lower()]
+        cursor = con.cursor()
+        try:
+            writer(cursor, table_name, filename)
+        finally:
+            cursor.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(outputs) or 1) as executor:
+        # Consume the results so that errors from the workers are raised here
+        list(executor.map(in_current_span(save), outputs))
+
+
+# Tables saved at the end of a run and the file each one is written to
+RESULT_OUTPUTS = [
+    ("crosswalk_centers_contrast", "crosswalk_centers_contrast.parquet"),
+    ("classified_streetlights", "classified_streetlights.csv"),
+    ("crosswalk_centers_lights", "crosswalk_centers_lights.parquet"),
+    ("streetlights", "streetlights.parquet"),
+]
+
+
+def save_results(
+    con: duckdb.DuckDBPyConnection, output_dir: str, spatial_sort: bool = False
+) -> None:
+    """
+    Save the result tables of a run to `output_dir`, in parallel.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the DuckDB database.
+        output_dir (str): Directory of the output files. Created if it does not
+            exist.
+        spatial_sort (bool): Whether to sort the parquet files by location, see
+            `save_table_to_parquet`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    save_tables(
+        con,
+        [
+            (table_name, os.path.join(output_dir, filename))
+            for table_name, filename in RESULT_OUTPUTS
+        ],
+        spatial_sort=spatial_sort,
+    )
 
 
 def abs_path(relative_path: str) -> str:
@@ -190,7 +985,9 @@ def abs_path(relative_path: str) -> str:
     Returns:
         A string that is a full file path in the user's directory
     """
-    caller_file = inspect.stack()[1].filename  # Get the caller's frame
+    # Only the caller's frame is needed; inspect.stack() would also read the source
+    # lines of every frame of the stack
+    caller_file = sys._getframe(1).f_code.co_filename
     caller_dir = os.path.dirname(
         os.path.abspath(caller_file)
     )  # Get the directory of the caller's script
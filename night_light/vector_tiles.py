@@ -0,0 +1,673 @@
+import gzip
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import duckdb
+import numpy as np
+
+from night_light.profiling import profiled
+from night_light.service import CENTER_PROPERTIES
+from night_light.spatial_index import GridIndex
+from night_light.util_duckdb import get_local_crs
+
+## Exports the results of a run as a pyramid of Mapbox Vector Tiles, so web maps fetch
+## only the features on screen instead of loading whole parquet files. The features
+## are read once from DuckDB into arrays of Web Mercator coordinates, and worker
+## processes encode batches of tiles from grid indexes over those arrays. Below the
+## deepest zoom level, points are thinned to one per small cell of the tile and
+## segments shorter than a cell are dropped.
+
+# Coordinates per side of a tile
+EXTENT = 4096
+
+# Cells per side of a tile in which points are thinned below the deepest zoom level
+THINNING_CELLS = 64
+
+# Coordinates a tile reaches beyond its edges, one thinning cell, so symbols on the
+# edges are drawn whole
+BUFFER = EXTENT // THINNING_CELLS
+
+# Tiles encoded by a worker per task
+TILES_PER_TASK = 256
+
+# Largest latitude of Web Mercator
+MAX_LATITUDE = 85.0511287798
+
+# Layers of the tiles, in drawing order: name, geometry type (1 for points, 2 for
+# lines), the properties of their features and the lowest zoom level they appear at
+LAYERS = [
+    (
+        "streetlight_lines",
+        2,
+        ["crosswalk_id", "center_id", "streetlight_id", "side", "dist"],
+        15,
+    ),
+    ("streetlights", 1, ["streetlight_id", "num_centers"], 13),
+    ("crosswalk_centers", 1, CENTER_PROPERTIES, 0),
+]
+
+
+@profiled
+def export_vector_tiles(
+    con: duckdb.DuckDBPyConnection,
+    output: str,
+    min_zoom: int = 10,
+    max_zoom: int = 16,
+    max_workers: Optional[int] = None,
+) -> int:
+    """
+    Export the results of a run as a pyramid of Mapbox Vector Tiles.
+
+    The tiles have three layers: the crosswalk centers with their contrast class and
+    heuristics, the streetlights with the number of centers they light, and the
+    lines from every center to its classified streetlights. Streetlights appear from
+    zoom 13 and lines from zoom 15. Below `max_zoom`, the points of a layer are
+    thinned to one per 4-pixel cell, with the number of points it stands for in the
+    `point_count` property, and lines shorter than a cell are dropped.
+
+    Args:
+        con: Connection to a DuckDB database with the crosswalk_centers_contrast,
+            crosswalk_centers_lights, classified_streetlights and streetlights
+            tables.
+        output: Path of an MBTiles file if it ends with ".mbtiles", otherwise of a
+            directory of `<z>/<x>/<y>.pbf` tiles and a metadata.json file.
+        min_zoom: Lowest zoom level of the pyramid.
+        max_zoom: Deepest zoom level of the pyramid, where every feature is kept.
+        max_workers: Number of worker processes. Default is the number of CPUs.
+
+    Returns:
+        Number of tiles written.
+    """
+    work_dir = tempfile.mkdtemp(prefix="night_light_vector_tiles_")
+    try:
+        metadata = _write_layers(con, work_dir, min_zoom, max_zoom)
+        tiles = _list_tiles(work_dir, min_zoom, max_zoom)
+        tasks = [
+            tiles[start : start + TILES_PER_TASK]
+            for start in range(0, len(tiles), TILES_PER_TASK)
+        ]
+        writer = _TileWriter(output, metadata)
+        try:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(
+                max_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(work_dir, max_zoom),
+            ) as executor:
+                # map() re-raises the first exception of a worker
+                for encoded_tiles in executor.map(_encode_tiles, tasks):
+                    for z, x, y, data in encoded_tiles:
+                        writer.write(z, x, y, data)
+        finally:
+            writer.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return writer.num_tiles
+
+
+def _lonlat_sql(column: str, crs: Optional[str]) -> str:
+    """SQL expression of a geometry column in EPSG:4326."""
+    if crs is None:
+        return column
+    return f"ST_Transform({column}, '{crs}', 'EPSG:4326', always_xy := true)"
+
+
+def _write_layers(
+    con: duckdb.DuckDBPyConnection, work_dir: str, min_zoom: int, max_zoom: int
+) -> Dict[str, Any]:
+    """
+    Write the coordinates and properties of every layer to .npy files.
+
+    Coordinates are Web Mercator coordinates scaled to [0, 1], with Y pointing south
+    like in tiles. String properties are stored as codes into a list of categories,
+    and other properties as floats with NaN for NULL. The description of the columns
+    is written to layers.json.
+
+    Returns:
+        Metadata of the tileset, in the format of the MBTiles metadata table.
+    """
+    crs = get_local_crs(con)
+    queries = {
+        "crosswalk_centers": f"""
+            WITH center_points AS (
+                SELECT crosswalk_id, center_id, ANY_VALUE(geometry) AS geometry
+                FROM crosswalk_centers_lights
+                GROUP BY crosswalk_id, center_id
+            )
+            SELECT
+                {", ".join(f"c.{name}" for name in CENTER_PROPERTIES)},
+                {_lonlat_sql("g.geometry", crs)} AS point
+            FROM crosswalk_centers_contrast c
+            JOIN center_points g
+                ON g.crosswalk_id = c.crosswalk_id
+                AND g.center_id IS NOT DISTINCT FROM c.center_id
+            """,
+        "streetlights": f"""
+            WITH lit_centers AS (
+                SELECT streetlight_id, COUNT(*) AS num_centers
+                FROM classified_streetlights
+                GROUP BY streetlight_id
+            )
+            SELECT
+                s.OBJECTID AS streetlight_id,
+                COALESCE(l.num_centers, 0) AS num_centers,
+                {_lonlat_sql("s.geometry", crs)} AS point
+            FROM streetlights s
+            LEFT JOIN lit_centers l ON l.streetlight_id = s.OBJECTID
+            """,
+        "streetlight_lines": f"""
+            SELECT
+                crosswalk_id,
+                center_id,
+                streetlight_id,
+                side,
+                dist,
+                {_lonlat_sql("line_geom", crs)} AS line
+            FROM classified_streetlights
+            """,
+    }
+    # Features come first in their layer, and win the thinning, in this order
+    orders = {
+        "crosswalk_centers": "crosswalk_id, center_id",
+        "streetlights": "streetlight_id",
+        "streetlight_lines": "crosswalk_id, center_id, dist, streetlight_id",
+    }
+
+    layers = {}
+    bounds = [math.inf, math.inf, -math.inf, -math.inf]
+    for name, geometry_type, properties, layer_min_zoom in LAYERS:
+        if geometry_type == 1:
+            coordinates = "ST_X(point) AS x1, ST_Y(point) AS y1"
+            source = "point"
+        else:
+            coordinates = """
+                ST_X(ST_StartPoint(line)) AS x1,
+                ST_Y(ST_StartPoint(line)) AS y1,
+                ST_X(ST_EndPoint(line)) AS x2,
+                ST_Y(ST_EndPoint(line)) AS y2
+                """
+            source = "line"
+        data = con.execute(
+            f"""
+            SELECT * EXCLUDE ({source}), {coordinates}
+            FROM ({queries[name]})
+            WHERE {source} IS NOT NULL
+            ORDER BY {orders[name]};
+            """
+        ).fetchnumpy()
+
+        columns = {}
+        for column in properties:
+            values = data[column]
+            if values.dtype == object:
+                categories = sorted({value for value in values if value is not None})
+                lookup = {category: code for code, category in enumerate(categories)}
+                codes = np.array(
+                    [lookup.get(value, -1) for value in values], dtype=np.int32
+                )
+                np.save(os.path.join(work_dir, f"{name}.{column}.npy"), codes)
+                columns[column] = {"kind": "string", "categories": categories}
+            else:
+                kind = "float" if values.dtype.kind == "f" else "int"
+                values = np.ma.filled(
+                    np.ma.asarray(values).astype(np.float64), np.nan
+                )
+                np.save(os.path.join(work_dir, f"{name}.{column}.npy"), values)
+                columns[column] = {"kind": kind}
+
+        ends = ["1", "2"] if geometry_type == 2 else ["1"]
+        for end in ends:
+            lon = np.asarray(data[f"x{end}"], dtype=np.float64)
+            lat = np.asarray(data[f"y{end}"], dtype=np.float64)
+            if len(lon):
+                bounds = [
+                    min(bounds[0], lon.min()),
+                    min(bounds[1], lat.min()),
+                    max(bounds[2], lon.max()),
+                    max(bounds[3], lat.max()),
+                ]
+            x, y = _world_coordinates(lon, lat)
+            np.save(os.path.join(work_dir, f"{name}.x{end}.npy"), x)
+            np.save(os.path.join(work_dir, f"{name}.y{end}.npy"), y)
+        layers[name] = {
+            "count": len(data["x1"]),
+            "columns": columns,
+            "minzoom": max(layer_min_zoom, min_zoom),
+        }
+    with open(os.path.join(work_dir, "layers.json"), "w") as f:
+        json.dump(layers, f)
+
+    if not math.isfinite(bounds[0]):
+        bounds = [-180.0, -MAX_LATITUDE, 180.0, MAX_LATITUDE]
+    vector_layers = []
+    for name, geometry_type, properties, _ in LAYERS:
+        fields = {
+            column: "String" if spec["kind"] == "string" else "Number"
+            for column, spec in layers[name]["columns"].items()
+        }
+        if geometry_type == 1:
+            fields["point_count"] = "Number"
+        vector_layers.append(
+            {
+                "id": name,
+                "fields": fields,
+                "minzoom": layers[name]["minzoom"],
+                "maxzoom": max_zoom,
+            }
+        )
+    return {
+        "name": "night-light",
+        "format": "pbf",
+        "type": "overlay",
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "bounds": bounds,
+        "center": [
+            (bounds[0] + bounds[2]) / 2,
+            (bounds[1] + bounds[3]) / 2,
+            min_zoom,
+        ],
+        "vector_layers": vector_layers,
+    }
+
+
+def _world_coordinates(
+    lon: np.ndarray, lat: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Web Mercator coordinates of points, scaled to [0, 1] with Y pointing south."""
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (lon + 180) / 360
+    y = (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2
+    return x, y
+
+
+def _list_tiles(
+    work_dir: str, min_zoom: int, max_zoom: int
+) -> List[Tuple[int, int, int]]:
+    """
+    List the tiles that hold a feature, or the buffer of one, at every zoom level.
+
+    Returns:
+        (z, x, y) of the tiles, by zoom level and then by column and row.
+    """
+    with open(os.path.join(work_dir, "layers.json")) as f:
+        layers = json.load(f)
+    points = [
+        (
+            layers[name]["minzoom"],
+            np.load(os.path.join(work_dir, f"{name}.x{end}.npy")),
+            np.load(os.path.join(work_dir, f"{name}.y{end}.npy")),
+        )
+        for name, geometry_type, _, _ in LAYERS
+        for end in (["1", "2"] if geometry_type == 2 else ["1"])
+    ]
+    tiles = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        scale = 2**zoom
+        buffer = BUFFER / EXTENT / scale
+        keys = []
+        for layer_min_zoom, x, y in points:
+            if zoom >= layer_min_zoom:
+                # The corners of a point's buffer reach every tile that holds it
+                for offset_x in [-buffer, buffer]:
+                    for offset_y in [-buffer, buffer]:
+                        tile_x = np.clip(
+                            np.floor((x + offset_x) * scale), 0, scale - 1
+                        ).astype(np.int64)
+                        tile_y = np.clip(
+                            np.floor((y + offset_y) * scale), 0, scale - 1
+                        ).astype(np.int64)
+                        keys.append(np.unique(tile_x * scale + tile_y))
+        if keys:
+            for key in np.unique(np.concatenate(keys)).tolist():
+                tiles.append((zoom, key // scale, key % scale))
+    return tiles
+
+
+# Layers of a worker process: their arrays, grid indexes and column descriptions
+_worker_layers = None
+_worker_max_zoom = None
+
+
+def _init_worker(work_dir: str, max_zoom: int):
+    """Load the layers of an export and index them, once per worker process."""
+    global _worker_layers, _worker_max_zoom
+    with open(os.path.join(work_dir, "layers.json")) as f:
+        layers = json.load(f)
+    _worker_layers = {}
+    for name, geometry_type, properties, _ in LAYERS:
+        layer = dict(layers[name])
+
+        def load(column: str) -> np.ndarray:
+            path = os.path.join(work_dir, f"{name}.{column}.npy")
+            return np.load(path, mmap_mode="r")
+
+        layer["x1"], layer["y1"] = load("x1"), load("y1")
+        layer["values"] = {column: load(column) for column in properties}
+        if geometry_type == 1:
+            layer["index"] = GridIndex(layer["x1"], layer["y1"])
+            layer["reach"] = 0.0
+        else:
+            layer["x2"], layer["y2"] = load("x2"), load("y2")
+            # Lines are indexed by their midpoint, and searched as far as half of the
+            # longest one beyond a tile
+            half_x = np.abs(layer["x2"] - layer["x1"]) / 2
+            half_y = np.abs(layer["y2"] - layer["y1"]) / 2
+            layer["index"] = GridIndex(
+                (layer["x1"] + layer["x2"]) / 2, (layer["y1"] + layer["y2"]) / 2
+            )
+            layer["reach"] = (
+                float(max(half_x.max(), half_y.max())) if len(half_x) else 0.0
+            )
+        _worker_layers[name] = layer
+    _worker_max_zoom = max_zoom
+
+
+def _encode_tiles(
+    tiles: List[Tuple[int, int, int]],
+) -> List[Tuple[int, int, int, bytes]]:
+    """Encode a batch of tiles, skipping the ones left without features."""
+    encoded_tiles = []
+    for z, x, y in tiles:
+        data = _encode_tile(z, x, y)
+        if data:
+            encoded_tiles.append((z, x, y, data))
+    return encoded_tiles
+
+
+def _encode_tile(z: int, x: int, y: int) -> bytes:
+    """Encode the layers of one tile as a Mapbox Vector Tile."""
+    scale = 2**z
+    buffer = BUFFER / EXTENT / scale
+    min_x, min_y = x / scale - buffer, y / scale - buffer
+    max_x, max_y = (x + 1) / scale + buffer, (y + 1) / scale + buffer
+    thin = z < _worker_max_zoom
+
+    tile = bytearray()
+    for name, geometry_type, properties, _ in LAYERS:
+        layer = _worker_layers[name]
+        if z < layer["minzoom"] or layer["count"] == 0:
+            continue
+        reach = layer["reach"]
+        rows = layer["index"].within(
+            min_x - reach, min_y - reach, max_x + reach, max_y + reach
+        )
+        # Tile coordinates of the features
+        x1 = np.round((layer["x1"][rows] * scale - x) * EXTENT).astype(np.int64)
+        y1 = np.round((layer["y1"][rows] * scale - y) * EXTENT).astype(np.int64)
+        point_count = None
+
+        if geometry_type == 1:
+            if thin:
+                # Keep the first point of every cell, which is the same at every zoom
+                # level where the cell is whole
+                cell_size = EXTENT // THINNING_CELLS
+                # The buffer adds one cell on every side
+                cells = (np.floor_divide(x1, cell_size) + 1) * (THINNING_CELLS + 3) + (
+                    np.floor_divide(y1, cell_size) + 1
+                )
+                _, first, point_count = np.unique(
+                    cells, return_index=True, return_counts=True
+                )
+                order = np.argsort(first, kind="stable")
+                first, point_count = first[order], point_count[order]
+                rows, x1, y1 = rows[first], x1[first], y1[first]
+            # Command 9 moves to one point, and 10 draws a line to one point
+            geometries = np.column_stack(
+                [np.full(len(rows), 9), _zigzag(x1), _zigzag(y1)]
+            )
+        else:
+            x2 = np.round((layer["x2"][rows] * scale - x) * EXTENT).astype(np.int64)
+            y2 = np.round((layer["y2"][rows] * scale - y) * EXTENT).astype(np.int64)
+            # Keep the lines that cross the buffered tile and are long enough to draw
+            low, high = -BUFFER, EXTENT + BUFFER
+            min_length = EXTENT // THINNING_CELLS if thin else 1
+            keep = (
+                (np.maximum(x1, x2) >= low)
+                & (np.minimum(x1, x2) <= high)
+                & (np.maximum(y1, y2) >= low)
+                & (np.minimum(y1, y2) <= high)
+                & (np.maximum(np.abs(x2 - x1), np.abs(y2 - y1)) >= min_length)
+            )
+            rows, x1, y1, x2, y2 = rows[keep], x1[keep], y1[keep], x2[keep], y2[keep]
+            geometries = np.column_stack(
+                [
+                    np.full(len(rows), 9),
+                    _zigzag(x1),
+                    _zigzag(y1),
+                    np.full(len(rows), 10),
+                    _zigzag(x2 - x1),
+                    _zigzag(y2 - y1),
+                ]
+            )
+        if len(rows) == 0:
+            continue
+
+        values = {column: layer["values"][column][rows] for column in properties}
+        columns = dict(layer["columns"])
+        if point_count is not None:
+            values["point_count"] = point_count.astype(np.float64)
+            columns["point_count"] = {"kind": "int"}
+        layer_data = _encode_layer(name, geometry_type, geometries, values, columns)
+        tile += b"\x1a" + _varint(len(layer_data)) + layer_data
+    return bytes(tile)
+
+
+def _encode_layer(
+    name: str,
+    geometry_type: int,
+    geometries: np.ndarray,
+    values: Dict[str, np.ndarray],
+    columns: Dict[str, Dict[str, Any]],
+) -> bytes:
+    """
+    Encode a layer of a vector tile.
+
+    Args:
+        name: Name of the layer.
+        geometry_type: 1 for points, 2 for lines.
+        geometries: Encoded geometry commands of every feature, one row per feature.
+        values: Property values of every feature, by column.
+        columns: Kind of every column, and the categories of string columns.
+
+    Returns:
+        The Layer message.
+    """
+    num_features = len(geometries)
+    # Pairs of key and value indices of every feature, -1 where a value is NULL
+    tags = np.full((num_features, 2 * len(values)), -1, dtype=np.int64)
+    # Value messages of every column, each with its field key and length
+    encoded_values = []
+    num_values = 0
+    for key, (column, column_values) in enumerate(values.items()):
+        spec = columns[column]
+        if spec["kind"] == "string":
+            valid = column_values >= 0
+        else:
+            valid = ~np.isnan(column_values)
+        unique, inverse = np.unique(column_values[valid], return_inverse=True)
+        tags[valid, 2 * key] = key
+        tags[valid, 2 * key + 1] = num_values + inverse.reshape(-1)
+        num_values += len(unique)
+        if spec["kind"] == "string":
+            for code in unique.tolist():
+                encoded = spec["categories"][code].encode()
+                message = b"\x0a" + _varint(len(encoded)) + encoded
+                encoded_values.append(b"\x22" + _varint(len(message)) + message)
+        elif spec["kind"] == "int":
+            # sint64 values: the field key and a zigzag varint
+            zigzag = _zigzag(unique.astype(np.int64))
+            messages = np.column_stack(
+                [
+                    np.full(len(unique), 0x22),
+                    1 + _varint_sizes(zigzag),
+                    np.full(len(unique), 0x30),
+                    zigzag,
+                ]
+            )
+            encoded_values.append(_varints(messages.ravel()))
+        else:
+            # double values: the field key and 8 little-endian bytes
+            messages = np.zeros((len(unique), 11), dtype=np.uint8)
+            messages[:, :3] = [0x22, 9, 0x19]
+            messages[:, 3:] = unique.astype("<f8").view(np.uint8).reshape(-1, 8)
+            encoded_values.append(messages.tobytes())
+
+    layer = bytearray(b"\x78\x02")
+    encoded_name = name.encode()
+    layer += b"\x0a" + _varint(len(encoded_name)) + encoded_name
+    # The features are encoded all at once: every field key, length and packed value
+    # of a feature is one varint of a row, and the missing tags are dropped
+    tag_sizes = np.where(tags >= 0, _varint_sizes(np.maximum(tags, 0)), 0).sum(axis=1)
+    geometry_sizes = _varint_sizes(geometries).sum(axis=1)
+    feature_sizes = (
+        1
+        + _varint_sizes(tag_sizes)
+        + tag_sizes
+        + 2
+        + 1
+        + _varint_sizes(geometry_sizes)
+        + geometry_sizes
+    )
+    fields = np.column_stack(
+        [
+            np.full(num_features, 0x12),
+            feature_sizes,
+            np.full(num_features, 0x12),
+            tag_sizes,
+            tags,
+            np.full(num_features, 0x18),
+            np.full(num_features, geometry_type),
+            np.full(num_features, 0x22),
+            geometry_sizes,
+            geometries,
+        ]
+    ).ravel()
+    layer += _varints(fields[fields >= 0])
+    for column in values:
+        encoded_key = column.encode()
+        layer += b"\x1a" + _varint(len(encoded_key)) + encoded_key
+    layer += b"".join(encoded_values)
+    layer += b"\x28" + _varint(EXTENT)
+    return bytes(layer)
+
+
+def _varint(value: int) -> bytes:
+    """Encode a non-negative integer as a protobuf varint."""
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _varint_sizes(values: np.ndarray) -> np.ndarray:
+    """Number of bytes of the varints of non-negative integers."""
+    sizes = np.ones(values.shape, dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += values >= 1 << shift
+    return sizes
+
+
+def _varints(values: np.ndarray) -> bytes:
+    """Encode non-negative integers as consecutive protobuf varints."""
+    values = values.astype(np.uint64)
+    sizes = _varint_sizes(values)
+    starts = np.cumsum(sizes) - sizes
+    encoded = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    for index in range(int(sizes.max(initial=0))):
+        has_byte = sizes > index
+        byte = (values[has_byte] >> np.uint64(7 * index)) & np.uint64(0x7F)
+        # Every byte but the last of a varint has its high bit set
+        byte |= np.where(sizes[has_byte] > index + 1, 0x80, 0).astype(np.uint64)
+        encoded[starts[has_byte] + index] = byte
+    return encoded.tobytes()
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    """Map signed integers to non-negative ones, like protobuf's sint types."""
+    return (values << 1) ^ (values >> 63)
+
+
+class _TileWriter:
+    """Writes encoded tiles to an MBTiles file or to a directory of tiles."""
+
+    def __init__(self, output: str, metadata: Dict[str, Any]):
+        self.num_tiles = 0
+        self._db = None
+        self._output = output
+        if output.endswith(".mbtiles"):
+            if os.path.exists(output):
+                os.remove(output)
+            self._db = sqlite3.connect(output)
+            self._db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+            self._db.execute(
+                """
+                CREATE TABLE tiles (
+                    zoom_level INTEGER,
+                    tile_column INTEGER,
+                    tile_row INTEGER,
+                    tile_data BLOB
+                )
+                """
+            )
+            self._db.execute(
+                """
+                CREATE UNIQUE INDEX tile_index
+                ON tiles (zoom_level, tile_column, tile_row)
+                """
+            )
+            # MBTiles stores lists as comma-separated text and the layers as JSON
+            self._db.executemany(
+                "INSERT INTO metadata VALUES (?, ?)",
+                [
+                    (
+                        key,
+                        ",".join(map(str, value))
+                        if isinstance(value, list)
+                        else str(value),
+                    )
+                    for key, value in metadata.items()
+                    if key != "vector_layers"
+                ]
+                + [
+                    (
+                        "json",
+                        json.dumps({"vector_layers": metadata["vector_layers"]}),
+                    )
+                ],
+            )
+        else:
+            os.makedirs(output, exist_ok=True)
+            with open(os.path.join(output, "metadata.json"), "w") as f:
+                json.dump(metadata, f, indent=2)
+
+    def write(self, z: int, x: int, y: int, data: bytes):
+        """Write one tile."""
+        if self._db is not None:
+            # MBTiles tiles are gzipped, and their rows count from the south
+            self._db.execute(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                (z, x, 2**z - 1 - y, gzip.compress(data)),
+            )
+        else:
+            tile_dir = os.path.join(self._output, str(z), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            with open(os.path.join(tile_dir, f"{y}.pbf"), "wb") as f:
+                f.write(data)
+        self.num_tiles += 1
+
+    def close(self):
+        """Finish writing the tiles."""
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+
+from night_light.batch import load_manifest, run_batch, run_region
+from night_light.synthetic import generate_city, write_city
+
+DATASETS = {
+    "crosswalks": "data/crosswalks.geojson",
+    "streetlights": "data/streetlights.geojson",
+    "street_segments": "/abs/street_segments.geojson",
+}
+
+
+@pytest.fixture(scope="module")
+def city_paths(tmp_path_factory):
+    return write_city(generate_city(200), str(tmp_path_factory.mktemp("city")))
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, "manifest.json")
+    with open(path, "w") as file:
+        json.dump(manifest, file)
+    return path
+
+
+def test_load_manifest_fills_defaults_and_paths(tmp_path):
+    path = write_manifest(
+        tmp_path,
+        {
+            "defaults": {"dist": 15, "search_dist": 40},
+            "regions": [{"name": "a", **DATASETS, "threshold": 0.02}],
+        },
+    )
+
+    manifest = load_manifest(path)
+
+    assert manifest["output_dir"] == os.path.join(tmp_path, "output")
+    [region] = manifest["regions"]
+    assert region["crosswalks"] == os.path.join(tmp_path, "data", "crosswalks.geojson")
+    assert region["street_segments"] == "/abs/street_segments.geojson"
+    assert region["dist"] == 15
+    assert region["search_dist"] == 40
+    assert region["threshold"] == 0.02
+    assert region["contrast_engine"] == "sql"
+    assert region["nearest"] is None
+
+
+@pytest.mark.parametrize(
+    "regions, message",
+    [
+        ([{"name": "a", "crosswalks": "c.geojson"}], "missing: streetlights"),
+        ([{"name": "a", **DATASETS}, {"name": "a", **DATASETS}], "used twice"),
+    ],
+    ids=["missing", "duplicate"],
+)
+def test_load_manifest_rejects_invalid_regions(tmp_path, regions, message):
+    path = write_manifest(tmp_path, {"regions": regions})
+
+    with pytest.raises(ValueError, match=message):
+        load_manifest(path)
+
+
+def test_run_region_reuses_the_search(tmp_path, city_paths):
+    manifest = {
+        "defaults": {"search_dist": 40},
+        "regions": [{"name": "city", **city_paths}],
+    }
+    [region] = load_manifest(write_manifest(tmp_path, manifest))["regions"]
+    output_dir = str(tmp_path / "output")
+
+    first = run_region(region, output_dir)
+    assert first["status"] == "ok", first.get("error")
+    assert first["crosswalk_centers_contrast"] > 0
+
+    # Another dist within search_dist picks the streetlights from the stored search:
+    # lights, contrast, label and brightness re-run, but not search
+    second = run_region({**region, "dist": 30}, output_dir)
+    assert second["status"] == "ok", second.get("error")
+    assert second["stages_run"] == 4
+
+
+def test_failed_region_does_not_stop_the_batch(tmp_path, city_paths):
+    broken = {**city_paths, "streetlights": "missing.geojson"}
+    path = write_manifest(
+        tmp_path,
+        {
+            "regions": [
+                {"name": "good", **city_paths},
+                {"name": "broken", **broken},
+            ]
+        },
+    )
+
+    summary = run_batch(path, max_workers=1)
+
+    statuses = dict(zip(summary["region"], summary["status"]))
+    assert statuses == {"good": "ok", "broken": "failed"}
+    error = summary.set_index("region").loc["broken", "error"]
+    assert "missing.geojson" in error
+    assert os.path.exists(tmp_path / "output" / "summary.csv")
+    assert os.path.exists(tmp_path / "output" / "good" / "streetlights.parquet")
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from night_light.cli import CONTRAST_ENGINE_NAMES, build_parser
+from night_light.pipeline import CONTRAST_ENGINES, run_pipeline
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import RESULT_OUTPUTS, connect_to_duckdb
+
+
+def test_engine_choices_match_the_pipeline():
+    assert CONTRAST_ENGINE_NAMES == list(CONTRAST_ENGINES)
+
+
+def test_unknown_engine_is_rejected():
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(
+            [
+                "run",
+                "--crosswalks=a",
+                "--streetlights=b",
+                "--street-segments=c",
+                "--engine=gpu",
+            ]
+        )
+
+
+def test_export_does_not_import_the_analyzer(tmp_path):
+    city = generate_city(200)
+    db = str(tmp_path / "city.duckdb")
+    con = connect_to_duckdb(db)
+    run_pipeline(
+        con,
+        [
+            (city[table_name], table_name)
+            for table_name in ["crosswalks", "streetlights", "street_segments"]
+        ],
+    )
+    con.close()
+
+    output = tmp_path / "output"
+    script = (
+        "import sys\n"
+        "from night_light.cli import main\n"
+        f"main(['export', {db!r}, {str(output)!r}])\n"
+        "print(sorted(m for m in sys.modules if m.startswith('night_light.analyzer')))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
+    assert sorted(path.name for path in output.iterdir()) == sorted(
+        filename for _, filename in RESULT_OUTPUTS
+    )
@@ -0,0 +1,37 @@
+import pytest
+
+from night_light.benchmark import compare_contrast_engines
+from night_light.pipeline import STAGES, run_pipeline
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import connect_to_duckdb
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["geographic", "local_crs"])
+def con(request):
+    """Connection to a synthetic city on which the stages up to lights have run."""
+    city = generate_city(300, seed=1)
+    datasets = [
+        (city[table_name], table_name)
+        for table_name in ["crosswalks", "streetlights", "street_segments"]
+    ]
+    con = connect_to_duckdb(":memory:")
+    stages = STAGES[: [stage.name for stage in STAGES].index("lights") + 1]
+    run_pipeline(con, datasets, local_crs=request.param, stages=stages)
+    yield con
+    con.close()
+
+
+@pytest.mark.parametrize("threshold", [0.01, 0.05, 0, -0.01])
+def test_engines_produce_the_same_tables(con, threshold):
+    report = compare_contrast_engines(con, threshold)
+
+    assert report["mismatches"] == {
+        "numpy": {
+            "classified_streetlights": 0,
+            "crosswalk_centers_heuristics": 0,
+            "crosswalk_centers_contrast": 0,
+        }
+    }
+    # The comparison is only meaningful if the engines classified something
+    for table_name in ["classified_streetlights", "crosswalk_centers_contrast"]:
+        assert con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0] > 0
@@ -0,0 +1,48 @@
+import pytest
+
+from night_light.analyzer import search_streetlights_crosswalk_centers
+from night_light.pipeline import STAGES, run_pipeline
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import connect_to_duckdb
+
+
+@pytest.mark.parametrize(
+    "center", [(-71.06, 42.35), (18.9, 69.65)], ids=["boston", "tromso"]
+)
+@pytest.mark.parametrize("dist", [10, 40])
+def test_geographic_search_matches_a_spheroid_join(center, dist):
+    city = generate_city(200, center=center)
+    con = connect_to_duckdb(":memory:")
+    stages = STAGES[: [stage.name for stage in STAGES].index("direction") + 1]
+    run_pipeline(
+        con,
+        [
+            (city[table_name], table_name)
+            for table_name in ["crosswalks", "streetlights", "street_segments"]
+        ],
+        stages=stages,
+    )
+
+    search_streetlights_crosswalk_centers(con, dist)
+
+    found = con.execute(
+        """
+        SELECT crosswalk_id, center_id, street_segment_id, UNNEST(streetlight_id)
+        FROM streetlight_search
+        ORDER BY ALL
+        """
+    ).fetchall()
+    expected = con.execute(
+        """
+        SELECT c.crosswalk_id, c.center_id, c.street_segment_id, s.OBJECTID
+        FROM crosswalk_centers c
+        JOIN streetlights s
+            ON ST_DWithin_Spheroid(
+                ST_FlipCoordinates(s.geometry), ST_FlipCoordinates(c.geometry), ?
+            )
+        ORDER BY ALL
+        """,
+        [dist],
+    ).fetchall()
+    assert found == expected
+    assert len(found) > 0
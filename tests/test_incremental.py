@@ -0,0 +1,76 @@
+import pandas as pd
+import pytest
+from shapely.affinity import translate
+
+from night_light.incremental import (
+    STREET_TABLES,
+    apply_street_segment_delta,
+    apply_streetlight_delta,
+)
+from night_light.pipeline import run_pipeline
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import connect_to_duckdb
+
+TABLES = ["streetlights", "street_segments"] + STREET_TABLES
+
+
+def datasets(city):
+    return [
+        (city[table_name], table_name)
+        for table_name in ["crosswalks", "streetlights", "street_segments"]
+    ]
+
+
+def rows(con, table_name):
+    """Rows of a table in a canonical order, with floats rounded."""
+    columns = con.execute(f"DESCRIBE {table_name}").fetchall()
+    select = ", ".join(
+        f"ROUND({name}, 9)" if column_type in ("FLOAT", "DOUBLE") else name
+        for name, column_type, *_ in columns
+    )
+    return con.execute(f"SELECT {select} FROM {table_name} ORDER BY ALL").fetchall()
+
+
+@pytest.mark.parametrize("local_crs", [False, True], ids=["geographic", "local_crs"])
+def test_deltas_match_a_full_run(local_crs):
+    city = generate_city(200)
+    con = connect_to_duckdb(":memory:")
+    run_pipeline(con, datasets(city), local_crs=local_crs)
+
+    # Move two streetlights by about 5 m, add one and delete two
+    lights = city["streetlights"]
+    moved = lights.iloc[[0, 10]].copy()
+    moved["geometry"] = moved.geometry.apply(lambda point: translate(point, 5e-5))
+    added = moved.iloc[[0]].copy()
+    added["OBJECTID"] = lights["OBJECTID"].max() + 1
+    added["geometry"] = added.geometry.apply(lambda point: translate(point, 0, 1e-4))
+    light_upserts = pd.concat([moved, added], ignore_index=True)
+    deleted_lights = lights["OBJECTID"].iloc[[20, 30]].tolist()
+
+    # Flip the direction of two street segments and delete one
+    segments = city["street_segments"]
+    edited = segments.iloc[[0, 5]].copy()
+    edited["ONEWAY"] = edited["ONEWAY"].map({"FT": "TW", "TW": "FT"})
+    deleted_segments = [int(segments["OBJECTID"].iloc[8])]
+
+    assert apply_streetlight_delta(con, light_upserts, deleted_lights)
+    assert apply_street_segment_delta(con, edited, deleted_segments)
+
+    edited_lights = pd.concat(
+        [lights[~lights["OBJECTID"].isin(light_upserts["OBJECTID"])], light_upserts]
+    )
+    edited_lights = edited_lights[~edited_lights["OBJECTID"].isin(deleted_lights)]
+    edited_segments = pd.concat(
+        [segments[~segments["OBJECTID"].isin(edited["OBJECTID"])], edited]
+    )
+    edited_segments = edited_segments[
+        ~edited_segments["OBJECTID"].isin(deleted_segments)
+    ]
+    edited_city = dict(
+        city, streetlights=edited_lights, street_segments=edited_segments
+    )
+    fresh = connect_to_duckdb(":memory:")
+    run_pipeline(fresh, datasets(edited_city), local_crs=local_crs)
+
+    for table_name in TABLES:
+        assert rows(con, table_name) == rows(fresh, table_name), table_name
@@ -0,0 +1,55 @@
+import dataclasses
+
+import pytest
+
+from night_light.pipeline import STAGES, run_pipeline
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import connect_to_duckdb
+
+
+@pytest.fixture
+def datasets():
+    city = generate_city(200)
+    return [
+        (city[table_name], table_name)
+        for table_name in ["crosswalks", "streetlights", "street_segments"]
+    ]
+
+
+def test_interrupted_stage_reruns(datasets):
+    con = connect_to_duckdb(":memory:")
+    run_pipeline(con, datasets, threshold=0.01)
+    expected = con.execute("SELECT COUNT(*) FROM crosswalk_centers_contrast").fetchone()
+
+    # The label stage of a run with another threshold stops after rewriting part of
+    # its table
+    def interrupted(con, params):
+        con.execute("DELETE FROM crosswalk_centers_contrast")
+        raise KeyboardInterrupt
+
+    stages = [
+        dataclasses.replace(stage, run=interrupted) if stage.name == "label" else stage
+        for stage in STAGES
+    ]
+    with pytest.raises(KeyboardInterrupt):
+        run_pipeline(con, datasets, threshold=0.05, stages=stages)
+
+    # Back to the first threshold, the stage no longer matches its old checkpoint
+    assert run_pipeline(con, datasets, threshold=0.01) == ["label", "brightness"]
+    assert (
+        con.execute("SELECT COUNT(*) FROM crosswalk_centers_contrast").fetchone()
+        == expected
+    )
+
+
+def test_threshold_only_relabels(datasets):
+    con = connect_to_duckdb(":memory:")
+    run_pipeline(con, datasets, threshold=0.01)
+
+    assert run_pipeline(con, datasets, threshold=0.05) == ["label", "brightness"]
+    query = "SELECT * FROM crosswalk_centers_contrast ORDER BY ALL"
+    relabeled = con.execute(query).fetchall()
+
+    fresh = connect_to_duckdb(":memory:")
+    run_pipeline(fresh, datasets, threshold=0.05)
+    assert fresh.execute(query).fetchall() == relabeled
@@ -0,0 +1,58 @@
+import json
+
+from night_light.cli import main
+from night_light.profiling import profile_run
+from night_light.synthetic import generate_city, write_city
+from night_light.util_duckdb import (
+    connect_to_duckdb,
+    load_multiple_datasets,
+    save_tables,
+)
+
+
+def events(trace_path):
+    with open(trace_path) as file:
+        return json.load(file)["traceEvents"]
+
+
+def test_rows_of_worker_threads_count_towards_the_span(tmp_path):
+    city = generate_city(200)
+    con = connect_to_duckdb(":memory:")
+    load_multiple_datasets(con, [(gdf, table_name) for table_name, gdf in city.items()])
+    outputs = [
+        ("crosswalks", str(tmp_path / "crosswalks.parquet")),
+        ("streetlights", str(tmp_path / "streetlights.csv")),
+    ]
+
+    trace_path = tmp_path / "trace.json"
+    with profile_run(str(trace_path)):
+        save_tables(con, outputs)
+
+    by_name = {event["name"]: event for event in events(trace_path)}
+    rows = len(city["crosswalks"]) + len(city["streetlights"])
+    save_event = by_name["night_light.util_duckdb.save_tables"]
+    assert save_event["args"]["rows_out"] == rows
+    assert by_name["run"]["args"]["rows_out"] == rows
+    # The tables were written on the threads of the pool
+    for name in ["save_table_to_parquet", "save_table_to_csv"]:
+        event = by_name[f"night_light.util_duckdb.{name}"]
+        assert event["tid"] != save_event["tid"]
+        assert event["args"]["rows_out"] > 0
+
+
+def test_run_command_writes_a_trace(tmp_path):
+    paths = write_city(generate_city(100), str(tmp_path / "city"))
+    trace_path = tmp_path / "trace.json"
+
+    main(
+        [
+            "run",
+            f"--crosswalks={paths['crosswalks']}",
+            f"--streetlights={paths['streetlights']}",
+            f"--street-segments={paths['street_segments']}",
+            f"--profile={trace_path}",
+        ]
+    )
+
+    names = {event["name"] for event in events(trace_path)}
+    assert {"run", "stage contrast", "stage label"} <= names
@@ -0,0 +1,193 @@
+import json
+
+import pytest
+
+from night_light.pipeline import run_pipeline
+from night_light.service import (
+    DETAIL_ZOOM,
+    MAX_NEAREST_DIST,
+    MAX_NEAREST_K,
+    ContrastService,
+)
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import connect_to_duckdb
+
+# The synthetic city spans about 700 m north-east of this corner
+CORNER = (-71.06, 42.35)
+CITY_BBOX = "-71.07,42.34,-71.04,42.37"
+
+
+def write_run(db_path):
+    city = generate_city(200, center=CORNER)
+    con = connect_to_duckdb(db_path)
+    run_pipeline(
+        con,
+        [
+            (city[table_name], table_name)
+            for table_name in ["crosswalks", "streetlights", "street_segments"]
+        ],
+    )
+    return con
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp("service") / "run.db")
+    write_run(db_path).close()
+    service = ContrastService(db_path, pool_size=2)
+    yield service
+    service.close()
+
+
+def get(service, path, **params):
+    status, body = service.handle(path, params)
+    return status, json.loads(body)
+
+
+def test_centers_in_detail(service):
+    status, body = get(service, "/centers", bbox=CITY_BBOX, zoom=str(DETAIL_ZOOM))
+
+    assert status == 200
+    assert len(body["features"]) == service.num_centers > 0
+    properties = body["features"][0]["properties"]
+    assert {"crosswalk_id", "center_id", "contrast_heuristic"} <= properties.keys()
+
+
+def test_centers_in_part_of_the_city(service):
+    bbox = [CORNER[0], CORNER[1], CORNER[0] + 0.003, CORNER[1] + 0.003]
+    status, body = get(service, "/centers", bbox=",".join(map(str, bbox)))
+
+    assert status == 200
+    assert 0 < len(body["features"]) < service.num_centers
+    for feature in body["features"]:
+        lon, lat = feature["geometry"]["coordinates"]
+        assert bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]
+
+
+@pytest.mark.parametrize("zoom", [DETAIL_ZOOM - 1, 12, 0])
+def test_centers_are_clustered_below_detail_zoom(service, zoom):
+    status, body = get(service, "/centers", bbox=CITY_BBOX, zoom=str(zoom))
+
+    assert status == 200
+    clusters = [feature["properties"] for feature in body["features"]]
+    assert len(clusters) < service.num_centers
+    assert sum(cluster["count"] for cluster in clusters) == service.num_centers
+    for cluster in clusters:
+        assert sum(cluster["contrast"].values()) == cluster["count"]
+
+
+def test_nearest_centers(service):
+    status, body = get(service, "/nearest", lon="-71.058", lat="42.352", k="3")
+
+    assert status == 200
+    dists = [feature["properties"]["dist"] for feature in body["features"]]
+    assert len(dists) == 3
+    assert dists == sorted(dists)
+
+
+def test_nearest_centers_are_bounded(service):
+    # k above the number of centers is capped, and max_dist bounds the search
+    status, body = get(
+        service, "/nearest", lon="-71.058", lat="42.352", k=str(MAX_NEAREST_K)
+    )
+    assert status == 200
+    assert len(body["features"]) == min(MAX_NEAREST_K, service.num_centers)
+
+    status, body = get(service, "/nearest", lon="-71.058", lat="42.352", max_dist="0")
+    assert status == 200
+    assert body["features"] == []
+
+    # About 55 km away from the city
+    status, body = get(service, "/nearest", lon="-71.06", lat="42.85")
+    assert status == 200
+    assert body["features"] == []
+
+
+@pytest.mark.parametrize(
+    "path, params",
+    [
+        ("/centers", {}),
+        ("/centers", {"bbox": "1,2,3"}),
+        ("/centers", {"bbox": "1,2,3,nan"}),
+        ("/centers", {"bbox": CITY_BBOX, "zoom": "-1"}),
+        ("/centers", {"bbox": CITY_BBOX, "zoom": "high"}),
+        ("/nearest", {"lon": "-71.06"}),
+        ("/nearest", {"lon": "-71.06", "lat": "42.35", "k": "0"}),
+        ("/nearest", {"lon": "-71.06", "lat": "42.35", "k": "-3"}),
+        ("/nearest", {"lon": "-71.06", "lat": "42.35", "k": str(MAX_NEAREST_K + 1)}),
+        ("/nearest", {"lon": "-71.06", "lat": "42.35", "max_dist": "-1"}),
+        (
+            "/nearest",
+            {"lon": "-71.06", "lat": "42.35", "max_dist": str(MAX_NEAREST_DIST + 1)},
+        ),
+        ("/crosswalk", {}),
+        ("/crosswalk", {"id": "one"}),
+    ],
+)
+def test_invalid_parameters(service, path, params):
+    status, body = get(service, path, **params)
+
+    assert status == 400
+    assert "error" in body
+
+
+def test_crosswalk(service):
+    _, centers = get(service, "/centers", bbox=CITY_BBOX)
+    crosswalk_id = centers["features"][0]["properties"]["crosswalk_id"]
+
+    status, body = get(service, "/crosswalk", id=str(crosswalk_id))
+
+    assert status == 200
+    assert body["crosswalk_id"] == crosswalk_id
+    assert len(body["centers"]["features"]) > 0
+    for feature in body["streetlights"]["features"]:
+        assert feature["properties"]["side"] in ("to", "from")
+
+
+@pytest.mark.parametrize(
+    "path, params", [("/crosswalk", {"id": "-1"}), ("/unknown", {})]
+)
+def test_not_found(service, path, params):
+    status, body = get(service, path, **params)
+
+    assert status == 404
+    assert "error" in body
+
+
+def test_stats(service):
+    status, body = get(service, "/stats")
+
+    assert status == 200
+    assert body["num_centers"] == service.num_centers
+    assert body["crs"] == "EPSG:4326"
+
+
+def test_unexpected_error(service, monkeypatch):
+    def fail():
+        raise RuntimeError("the database is gone")
+
+    monkeypatch.setattr(service, "stats", fail)
+    status, body = get(service, "/stats")
+
+    assert status == 500
+    assert body == {"error": "RuntimeError"}
+
+
+def test_database_without_centers(tmp_path):
+    db_path = str(tmp_path / "run.db")
+    con = write_run(db_path)
+    con.execute("DELETE FROM crosswalk_centers_contrast")
+    con.close()
+
+    service = ContrastService(db_path)
+    try:
+        assert service.num_centers == 0
+        assert get(service, "/nearest", lon="-71.06", lat="42.35") == (
+            200,
+            {"type": "FeatureCollection", "features": []},
+        )
+        status, body = get(service, "/centers", bbox=CITY_BBOX, zoom="10")
+        assert status == 200
+        assert body["features"] == []
+    finally:
+        service.close()
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from night_light.spatial_index import GridIndex
+
+
+def brute_force_nearest(points_x, points_y, x, y, k, max_dist=None):
+    """The k nearest points of every query point, by sorting every distance."""
+    dists = np.hypot(points_x[None, :] - x[:, None], points_y[None, :] - y[:, None])
+    if max_dist is not None:
+        dists[dists > max_dist] = np.inf
+    # Fewer than k points leave missing neighbors
+    if k > dists.shape[1]:
+        dists = np.pad(dists, ((0, 0), (0, k - dists.shape[1])), constant_values=np.inf)
+    # A stable sort orders the points at the same distance by their index
+    order = np.argsort(dists, axis=1, kind="stable")[:, :k]
+    nearest_dists = np.take_along_axis(dists, order, axis=1)
+    rows = np.where(np.isfinite(nearest_dists), order, -1)
+    return rows, nearest_dists
+
+
+@pytest.mark.parametrize("max_dist", [None, 5.0])
+@pytest.mark.parametrize("k", [1, 3, 20])
+def test_nearest_matches_brute_force(k, max_dist):
+    rng = np.random.default_rng(0)
+    points_x, points_y = rng.uniform(0, 100, (2, 500))
+    x, y = rng.uniform(-50, 150, (2, 200))
+    index = GridIndex(points_x, points_y)
+
+    rows, dists = index.nearest(x, y, k, max_dist)
+    expected_rows, expected_dists = brute_force_nearest(
+        points_x, points_y, x, y, k, max_dist
+    )
+    np.testing.assert_array_equal(rows, expected_rows)
+    np.testing.assert_allclose(dists, expected_dists)
+
+
+def test_nearest_on_elongated_grid_far_from_points():
+    # A grid of thousands of columns and a single row, queried from far away
+    # without max_dist, must not build the whole square of cells around a query
+    rng = np.random.default_rng(1)
+    points_x = rng.uniform(0, 6436, 300)
+    points_y = rng.uniform(0, 0.5, 300)
+    index = GridIndex(points_x, points_y, cell_size=1.0)
+    assert index.num_cols > 6000 and index.num_rows == 1
+    x = np.concatenate([rng.uniform(-20000, 30000, 40), [-1e6, 1e6]])
+    y = np.concatenate([rng.uniform(-20000, 20000, 40), [1e6, -1e6]])
+
+    for k in [1, 5, 300, 400]:
+        rows, dists = index.nearest(x, y, k)
+        expected_rows, expected_dists = brute_force_nearest(
+            points_x, points_y, x, y, k
+        )
+        np.testing.assert_array_equal(rows, expected_rows)
+        np.testing.assert_allclose(dists, expected_dists)
+
+
+def test_within_matches_brute_force():
+    rng = np.random.default_rng(2)
+    points_x, points_y = rng.uniform(0, 100, (2, 1000))
+    index = GridIndex(points_x, points_y)
+    for _ in range(100):
+        min_x, max_x = np.sort(rng.uniform(-20, 120, 2))
+        min_y, max_y = np.sort(rng.uniform(-20, 120, 2))
+        expected = np.flatnonzero(
+            (points_x >= min_x)
+            & (points_x <= max_x)
+            & (points_y >= min_y)
+            & (points_y <= max_y)
+        )
+        np.testing.assert_array_equal(
+            index.within(min_x, min_y, max_x, max_y), expected
+        )
@@ -0,0 +1,52 @@
+from night_light.analyzer import simplify_crosswalk_polygon_to_box
+from night_light.pipeline import run_pipeline
+from night_light.synthetic import generate_city
+from night_light.tiling import RESULT_TABLES, _merge_tile_results, run_tiled_pipeline
+from night_light.util_duckdb import (
+    connect_to_duckdb,
+    load_multiple_datasets,
+    project_to_local_crs,
+)
+
+
+def datasets(city):
+    return [
+        (city[table_name], table_name)
+        for table_name in ["crosswalks", "streetlights", "street_segments"]
+    ]
+
+
+def rows(con, table_name):
+    """Rows of a table in a canonical order, with floats rounded."""
+    columns = con.execute(f"DESCRIBE {table_name}").fetchall()
+    select = ", ".join(
+        f"ROUND({name}, 9)" if column_type in ("FLOAT", "DOUBLE") else name
+        for name, column_type, *_ in columns
+    )
+    return con.execute(f"SELECT {select} FROM {table_name} ORDER BY ALL").fetchall()
+
+
+def test_tiled_run_matches_a_single_run():
+    city = generate_city(300)
+    con = connect_to_duckdb(":memory:")
+    # Tiles of 250 m split the city of about 900 m into a dozen tiles
+    assert run_tiled_pipeline(con, datasets(city), tile_size=250, max_workers=2) > 4
+
+    single = connect_to_duckdb(":memory:")
+    run_pipeline(single, datasets(city), local_crs=True)
+    for table_name in RESULT_TABLES:
+        assert rows(con, table_name) == rows(single, table_name), table_name
+
+
+def test_merge_without_tiles(tmp_path):
+    city = generate_city(100)
+    con = connect_to_duckdb(":memory:")
+    load_multiple_datasets(con, datasets(city))
+    project_to_local_crs(con, [table_name for _, table_name in datasets(city)])
+    simplify_crosswalk_polygon_to_box(con)
+    con.execute("DELETE FROM crosswalks")
+
+    # No crosswalk means no tile, so there is no result file to merge
+    _merge_tile_results(con, str(tmp_path), dist=20, threshold=0.01)
+    for table_name in RESULT_TABLES:
+        assert con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0] == 0
@@ -0,0 +1,77 @@
+import pytest
+
+from night_light.util_duckdb import connect_to_duckdb, save_table_to_parquet
+
+# DuckDB writes row groups of at least 2048 rows
+ROW_GROUP_SIZE = 2048
+WINDOW = (-71.05, 42.35, -71.04, 42.36)
+
+
+@pytest.fixture
+def con():
+    con = connect_to_duckdb(":memory:")
+    # Points in random order over a box of about 8 km by 11 km
+    con.execute("SELECT setseed(0.5)")
+    con.execute(
+        """
+        CREATE TABLE points AS
+        SELECT
+            i AS id,
+            ST_Point(-71.1 + random() * 0.1, 42.3 + random() * 0.1) AS geometry
+        FROM range(100000) AS t(i)
+        """
+    )
+    yield con
+    con.close()
+
+
+def test_default_export_keeps_the_table(con, tmp_path):
+    path = str(tmp_path / "points.parquet")
+    save_table_to_parquet(con, "points", path)
+
+    columns = [row[0] for row in con.execute(f"DESCRIBE '{path}'").fetchall()]
+    assert columns == ["id", "geometry"]
+    ids = [row[0] for row in con.execute(f"SELECT id FROM '{path}'").fetchall()]
+    assert ids == list(range(100000))
+
+
+def test_bbox_statistics_prune_row_groups(con, tmp_path):
+    path = str(tmp_path / "points.parquet")
+    save_table_to_parquet(
+        con, "points", path, row_group_size=ROW_GROUP_SIZE, spatial_sort=True
+    )
+
+    # Row groups whose bbox statistics overlap the window; readers skip the others
+    groups = con.execute(
+        f"""
+        SELECT
+            row_group_id,
+            MIN(stats_min_value::DOUBLE) FILTER (path_in_schema = 'bbox, xmin') AS xmin,
+            MIN(stats_min_value::DOUBLE) FILTER (path_in_schema = 'bbox, ymin') AS ymin,
+            MAX(stats_max_value::DOUBLE) FILTER (path_in_schema = 'bbox, xmax') AS xmax,
+            MAX(stats_max_value::DOUBLE) FILTER (path_in_schema = 'bbox, ymax') AS ymax
+        FROM parquet_metadata('{path}')
+        WHERE path_in_schema LIKE 'bbox, %'
+        GROUP BY row_group_id
+        """
+    ).fetchall()
+    min_x, min_y, max_x, max_y = WINDOW
+    overlapping = {
+        group_id
+        for group_id, xmin, ymin, xmax, ymax in groups
+        if xmin <= max_x and xmax >= min_x and ymin <= max_y and ymax >= min_y
+    }
+    assert len(groups) >= 45
+    assert len(overlapping) <= len(groups) // 10
+
+    # Every point of the window is in one of those row groups
+    rows = con.execute(
+        f"""
+        SELECT file_row_number
+        FROM read_parquet('{path}', file_row_number = true)
+        WHERE ST_Intersects(geometry, ST_MakeEnvelope(?, ?, ?, ?))
+        """,
+        list(WINDOW),
+    ).fetchall()
+    assert len(rows) > 0
+    assert {row // ROW_GROUP_SIZE for row, in rows} <= overlapping
@@ -0,0 +1,329 @@
+import gzip
+import os
+import sqlite3
+import struct
+
+import numpy as np
+import pytest
+
+from night_light.pipeline import run_pipeline
+from night_light.synthetic import generate_city
+from night_light.util_duckdb import connect_to_duckdb
+from night_light.vector_tiles import (
+    EXTENT,
+    _encode_layer,
+    _world_coordinates,
+    _zigzag,
+    export_vector_tiles,
+)
+
+MIN_ZOOM = 13
+MAX_ZOOM = 16
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def read_fields(data):
+    """Field numbers and values of a protobuf message, in their order."""
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos : pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value, pos = data[pos : pos + length], pos + length
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type}")
+        fields.append((field, value))
+    return fields
+
+
+def read_packed(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_value(data):
+    [(field, value)] = read_fields(data)
+    if field == 1:
+        return value.decode()
+    if field == 3:
+        return struct.unpack("<d", value)[0]
+    if field == 6:
+        return unzigzag(value)
+    raise ValueError(f"Unexpected value field {field}")
+
+
+def decode_geometry(commands):
+    """Commands of a geometry, with the absolute coordinates of their points."""
+    geometry = []
+    x = y = 0
+    pos = 0
+    while pos < len(commands):
+        command, count = commands[pos] & 7, commands[pos] >> 3
+        pos += 1
+        if command == 7:
+            geometry.append(("ClosePath", []))
+            continue
+        points = []
+        for _ in range(count):
+            x += unzigzag(commands[pos])
+            y += unzigzag(commands[pos + 1])
+            pos += 2
+            points.append((x, y))
+        geometry.append(({1: "MoveTo", 2: "LineTo"}[command], points))
+    return geometry
+
+
+def decode_layer(data):
+    layer = {"keys": [], "values": [], "features": []}
+    raw_features = []
+    for field, value in read_fields(data):
+        if field == 15:
+            layer["version"] = value
+        elif field == 1:
+            layer["name"] = value.decode()
+        elif field == 2:
+            raw_features.append(value)
+        elif field == 3:
+            layer["keys"].append(value.decode())
+        elif field == 4:
+            layer["values"].append(decode_value(value))
+        elif field == 5:
+            layer["extent"] = value
+        else:
+            raise ValueError(f"Unexpected layer field {field}")
+    for raw_feature in raw_features:
+        feature = {"properties": {}}
+        for field, value in read_fields(raw_feature):
+            if field == 2:
+                tags = read_packed(value)
+                for key, index in zip(tags[::2], tags[1::2]):
+                    feature["properties"][layer["keys"][key]] = layer["values"][index]
+            elif field == 3:
+                feature["type"] = value
+            elif field == 4:
+                feature["geometry"] = decode_geometry(read_packed(value))
+            else:
+                raise ValueError(f"Unexpected feature field {field}")
+        layer["features"].append(feature)
+    return layer
+
+
+def decode_tile(data):
+    layers = {}
+    for field, value in read_fields(data):
+        assert field == 3
+        layer = decode_layer(value)
+        layers[layer["name"]] = layer
+    return layers
+
+
+def test_point_layer_round_trip():
+    # Coordinates in the buffer, beyond the extent and of multi-byte varints
+    x = np.array([0, -64, 4159, 300])
+    y = np.array([0, 4100, -5, 1_000_000])
+    geometries = np.column_stack([np.full(len(x), 9), _zigzag(x), _zigzag(y)])
+    values = {
+        "side": np.array([0, -1, 1, 0], dtype=np.int32),
+        "count": np.array([1, np.nan, -300, 2**40]),
+        "dist": np.array([0.5, np.nan, np.nan, -1e-3]),
+    }
+    columns = {
+        "side": {"kind": "string", "categories": ["from", "to"]},
+        "count": {"kind": "int"},
+        "dist": {"kind": "float"},
+    }
+
+    layer = decode_layer(_encode_layer("points", 1, geometries, values, columns))
+
+    assert layer["version"] == 2
+    assert layer["name"] == "points"
+    assert layer["extent"] == EXTENT
+    assert layer["keys"] == ["side", "count", "dist"]
+    assert [feature["type"] for feature in layer["features"]] == [1, 1, 1, 1]
+    assert [feature["geometry"] for feature in layer["features"]] == [
+        [("MoveTo", [(0, 0)])],
+        [("MoveTo", [(-64, 4100)])],
+        [("MoveTo", [(4159, -5)])],
+        [("MoveTo", [(300, 1_000_000)])],
+    ]
+    # NULL values have no tags
+    assert [feature["properties"] for feature in layer["features"]] == [
+        {"side": "from", "count": 1, "dist": 0.5},
+        {},
+        {"side": "to", "count": -300},
+        {"side": "from", "count": 2**40, "dist": -1e-3},
+    ]
+    # Values are shared between the features
+    assert len(layer["values"]) == 2 + 3 + 2
+
+
+def test_line_layer_round_trip():
+    x1, y1 = np.array([10, 4000]), np.array([20, -30])
+    x2, y2 = np.array([200, 3000]), np.array([20, 5000])
+    geometries = np.column_stack(
+        [
+            np.full(2, 9),
+            _zigzag(x1),
+            _zigzag(y1),
+            np.full(2, 10),
+            _zigzag(x2 - x1),
+            _zigzag(y2 - y1),
+        ]
+    )
+    values = {"streetlight_id": np.array([7.0, 8.0])}
+    columns = {"streetlight_id": {"kind": "int"}}
+
+    layer = decode_layer(_encode_layer("lines", 2, geometries, values, columns))
+
+    assert [feature["type"] for feature in layer["features"]] == [2, 2]
+    assert [feature["geometry"] for feature in layer["features"]] == [
+        [("MoveTo", [(10, 20)]), ("LineTo", [(200, 20)])],
+        [("MoveTo", [(4000, -30)]), ("LineTo", [(3000, 5000)])],
+    ]
+    assert [feature["properties"] for feature in layer["features"]] == [
+        {"streetlight_id": 7},
+        {"streetlight_id": 8},
+    ]
+
+
+@pytest.fixture(scope="module")
+def export(tmp_path_factory):
+    city = generate_city(200)
+    con = connect_to_duckdb(":memory:")
+    run_pipeline(
+        con,
+        [
+            (city[table_name], table_name)
+            for table_name in ["crosswalks", "streetlights", "street_segments"]
+        ],
+    )
+    center_rows = con.execute(
+        """
+        SELECT crosswalk_id, center_id, ST_X(geometry), ST_Y(geometry)
+        FROM (
+            SELECT crosswalk_id, center_id, ANY_VALUE(geometry) AS geometry
+            FROM crosswalk_centers_lights
+            GROUP BY crosswalk_id, center_id
+        )
+        SEMI JOIN crosswalk_centers_contrast USING (crosswalk_id, center_id)
+        """
+    ).fetchall()
+    centers = {
+        (crosswalk_id, center_id): (lon, lat)
+        for crosswalk_id, center_id, lon, lat in center_rows
+    }
+
+    output_dir = tmp_path_factory.mktemp("tiles")
+    mbtiles = str(output_dir / "tiles.mbtiles")
+    directory = str(output_dir / "tiles")
+    num_tiles = export_vector_tiles(con, mbtiles, MIN_ZOOM, MAX_ZOOM, max_workers=1)
+    assert export_vector_tiles(con, directory, MIN_ZOOM, MAX_ZOOM, 1) == num_tiles
+    db = sqlite3.connect(mbtiles)
+    rows = db.execute("SELECT * FROM tiles").fetchall()
+    db.close()
+    assert len(rows) == num_tiles > 0
+
+    # MBTiles rows count from the south, so y flips back to the XYZ row
+    tiles = {
+        (z, x, 2**z - 1 - row): gzip.decompress(data) for z, x, row, data in rows
+    }
+    return centers, tiles, directory
+
+
+def interior_centers(tiles, zoom):
+    """Centers of the tiles of a zoom level outside of their buffer."""
+    for (z, x, y), data in tiles.items():
+        layers = decode_tile(data)
+        if z != zoom or "crosswalk_centers" not in layers:
+            continue
+        for feature in layers["crosswalk_centers"]["features"]:
+            [(command, [(tile_x, tile_y)])] = feature["geometry"]
+            assert command == "MoveTo"
+            if 0 <= tile_x < EXTENT and 0 <= tile_y < EXTENT:
+                world_x = (x + tile_x / EXTENT) / 2**z
+                world_y = (y + tile_y / EXTENT) / 2**z
+                yield world_x, world_y, feature["properties"]
+
+
+def test_directory_tiles_match_mbtiles(export):
+    _, tiles, directory = export
+
+    for (z, x, y), data in tiles.items():
+        with open(os.path.join(directory, str(z), str(x), f"{y}.pbf"), "rb") as f:
+            assert f.read() == data
+    assert os.path.exists(os.path.join(directory, "metadata.json"))
+
+
+def test_deepest_zoom_keeps_every_center_in_place(export):
+    centers, tiles, _ = export
+
+    found = {}
+    for world_x, world_y, properties in interior_centers(tiles, MAX_ZOOM):
+        assert "point_count" not in properties
+        key = (properties["crosswalk_id"], properties.get("center_id"))
+        assert key not in found
+        found[key] = (world_x, world_y)
+    assert found.keys() == centers.keys()
+
+    # Within a tile coordinate of where the center is
+    tolerance = 1 / EXTENT / 2**MAX_ZOOM
+    for key, (world_x, world_y) in found.items():
+        expected_x, expected_y = _world_coordinates(*map(np.array, centers[key]))
+        assert abs(world_x - expected_x) < tolerance
+        assert abs(world_y - expected_y) < tolerance
+
+
+@pytest.mark.parametrize("zoom", range(MIN_ZOOM, MAX_ZOOM))
+def test_thinned_centers_count_every_center(export, zoom):
+    centers, tiles, _ = export
+
+    point_counts = [
+        properties["point_count"]
+        for _, _, properties in interior_centers(tiles, zoom)
+    ]
+    assert sum(point_counts) == len(centers)
+    assert len(point_counts) < len(centers)
+
+
+def test_layers_appear_from_their_zoom_level(export):
+    _, tiles, _ = export
+
+    names = {zoom: set() for zoom in range(MIN_ZOOM, MAX_ZOOM + 1)}
+    for (z, _, _), data in tiles.items():
+        layers = decode_tile(data)
+        names[z] |= layers.keys()
+        for feature in layers.get("streetlight_lines", {}).get("features", []):
+            assert [command for command, _ in feature["geometry"]] == [
+                "MoveTo",
+                "LineTo",
+            ]
+    assert names[13] == names[14] == {"crosswalk_centers", "streetlights"}
+    assert names[15] == names[16] == {
+        "crosswalk_centers",
+        "streetlights",
+        "streetlight_lines",
+    }